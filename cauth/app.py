@@ -15,21 +15,41 @@
 # under the License.
 
 from pecan import make_app
-from cauth import model
-from pecan.hooks import TransactionHook
+from cauth import model, plugins, settings
+from cauth.hooks import ProfilingHook, TimingHook
+from cauth.model import store
+from cauth.utils import clients, common, health, loginpage, memory, metrics
+from cauth.utils import profiling, provisioning, revocation
 
 
 def setup_app(config):
-    model.init_model()
+    current = settings.load(config)
+    # the database only holds the GitHub OAuth states of the sql store,
+    # the provisioned users index and the provisioning outbox, the
+    # sessions are opened by cauth.model.db when it is used
+    database = current.state_store.backend == 'sql' or \
+        current.provisioning.index or current.provisioning.outbox
+    if database:
+        model.init_model()
+    common.setup(current.app)
+    store.setup(current)
+    plugins.setup(config)
+    clients.setup(current)
+    provisioning.setup(current.provisioning)
+    metrics.setup(current.metrics)
+    profiling.setup(current.profiling)
+    memory.setup(current.memory)
+    revocation.setup(current.revocation)
+    health.setup(current, database)
     app_conf = dict(config.app)
+    # compiled now rather than by the first request
+    loginpage.setup(app_conf['template_path'])
 
     return make_app(
         app_conf.pop('root'),
+        hooks=[TimingHook(current.tracing.slow_request,
+                          current.tracing.trace_file),
+               ProfilingHook()],
         logging=getattr(config, 'logging', {}),
-        hooks=[TransactionHook(model.start,
-                               model.start,
-                               model.commit,
-                               model.rollback,
-                               model.clear)],
         **app_conf
     )
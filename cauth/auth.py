@@ -16,48 +16,82 @@
 
 
 import crypt
-import ldap
+import functools
 import logging
 import requests
-import urllib
+import time
 
-from basicauth import encode
+from cauth.utils import metrics
 
 logger = logging.getLogger(__name__)
 
+BACKEND_SECONDS = metrics.Histogram(
+    'cauth_auth_backend_seconds',
+    'Duration of the credentials checks per backend', ('backend', ))
+BACKEND_CHECKS = metrics.Counter(
+    'cauth_auth_backend_checks_total',
+    'Credentials checks per backend and result', ('backend', 'result'))
 
-def check_static_user(config, username, password):
-    user = config.auth.get('users', {}).get(username)
+
+def instrumented(backend):
+    """Record the duration and the result (accepted, rejected or error)
+    of a credentials check."""
+    def decorator(check):
+        @functools.wraps(check)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                result = check(*args, **kwargs)
+            except Exception:
+                BACKEND_CHECKS.inc(backend, 'error')
+                raise
+            finally:
+                BACKEND_SECONDS.observe(time.time() - start, backend)
+            BACKEND_CHECKS.inc(backend, 'accepted' if result else 'rejected')
+            return result
+        return wrapper
+    return decorator
+
+
+@instrumented('static')
+def check_static_user(settings, username, password):
+    user = settings.users.get(username)
     if user:
-        salted_password = user.get('password')
+        salted_password, mail, lastname = user
         if salted_password == crypt.crypt(password, salted_password):
-            return user.get('mail'), user.get('lastname'), []
+            return mail, lastname, []
 
 
-def check_db_user(config, username, password):
-    localdb = config.auth.get('localdb')
+@instrumented('localdb')
+def check_db_user(settings, username, password):
+    localdb = settings.localdb
     if localdb:
-        bind_url = urllib.basejoin(localdb['managesf_url'], '/manage/bind')
+        from basicauth import encode
         headers = {"Authorization": encode(username, password)}
-        response = requests.get(bind_url, headers=headers)
+        response = requests.get(localdb.bind_url, headers=headers)
 
         if response.status_code > 399:
-            logger.error('localdb auth failed: %s' % response)
+            logger.error('localdb auth failed: %s', response)
             return None
         infos = response.json()
         return infos['email'], infos['fullname'], [{'key': infos['sshkey']}, ]
 
 
-def check_ldap_user(config, username, password):
-    config = config.auth.ldap
+@instrumented('ldap')
+def check_ldap_user(settings, username, password):
+    config = settings.ldap
+    if not config:
+        return None
+    # python-ldap is only needed by the deployments using it
+    import ldap
     try:
-        conn = ldap.initialize(config['host'])
+        conn = ldap.initialize(config.host)
         conn.set_option(ldap.OPT_REFERRALS, 0)
     except ldap.LDAPError:
         logger.error('Client unable to bind on LDAP unexpected behavior.')
         return None
 
-    who = config['dn'] % {'username': username}
+    who = config.dn % {'username': username}
     try:
         conn.simple_bind_s(who, password)
     except (ldap.INVALID_CREDENTIALS, ldap.SERVER_DOWN):
@@ -65,11 +99,11 @@ def check_ldap_user(config, username, password):
         return None
 
     result = conn.search_s(who, ldap.SCOPE_SUBTREE, '(cn=*)',
-                           attrlist=[config['sn'], config['mail']])
+                           attrlist=list(config.attrlist))
     if len(result) == 1:
         user = result[0]  # user is a tuple
-        mail = user[1].get(config['mail'], [None])
-        lastname = user[1].get(config['sn'], [None])
+        mail = user[1].get(config.mail, [None])
+        lastname = user[1].get(config.sn, [None])
         return mail[0], lastname[0], []
 
     logger.error('LDAP client search failed')
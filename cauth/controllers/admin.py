@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from pecan import expose, request, abort
+
+from cauth import settings
+from cauth.utils import memory, profiling
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_allowed():
+    if request.remote_addr not in settings.get().admin.allowed_ips:
+        logger.error('Admin request from %s refused.', request.remote_addr)
+        abort(403)
+
+
+class AdminController(object):
+    """Operations endpoints, only served to the allowed_ips of the admin
+    section."""
+
+    @expose('json')
+    def profiling(self, enabled=None, rate=None):
+        """Return the profiling status, a POST with enabled=1 or 0 toggles
+        it in all the processes."""
+        check_allowed()
+        profiler = profiling.get()
+        if profiler is None:
+            abort(404)
+        if request.method == 'POST' and enabled is not None:
+            if enabled in ('1', 'true', 'on'):
+                try:
+                    profiler.enable(rate and float(rate))
+                except ValueError:
+                    abort(400)
+            else:
+                profiler.disable()
+        return {'enabled': profiler.enabled, 'rate': profiler.rate,
+                'directory': profiler.directory,
+                'endpoints': sorted(profiler.stacks)}
+
+    @expose('json')
+    def memory(self):
+        """Return the memory usage of the process serving the request and
+        its growth since the last snapshot. A POST also takes a snapshot,
+        the reference of the next report."""
+        check_allowed()
+        return memory.get().report(keep=request.method == 'POST')
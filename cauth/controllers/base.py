@@ -16,26 +16,50 @@
 
 import logging
 
-from pecan import expose, response, conf, abort, render
+from pecan import expose, request, response, abort
 from pecan.rest import RestController
 
-from cauth.utils import common
+from cauth import plugins, settings
+from cauth.utils import common, loginpage, tracing
 
 
 logger = logging.getLogger(__name__)
 
 
+def login_page(back, message=''):
+    return loginpage.get().render(back, message)[0]
+
+
+def already_authenticated(back, method):
+    """Redirect to back when the client sends a valid ticket, without
+    asking for its credentials again."""
+    ticket = common.current_ticket()
+    if ticket is None:
+        return False
+    logger.info('Client %s is already authenticated.', ticket['uid'])
+    common.log_login(method, ticket['uid'])
+    common.redirect_back(back)
+    return True
+
+
 class BaseLoginController(RestController):
     def __init__(self, *args, **kwargs):
-        self.conf = conf
-        self.auth_methods = []
+        # the configured backends, unless some are registered
+        self.auth_methods = None
 
     def register(self, auth_method):
-        self.auth_methods.append(auth_method)
+        if self.auth_methods is None:
+            self.auth_methods = []
+        self.auth_methods.append((auth_method.__name__, auth_method))
 
     def check_valid_user(self, username, password):
-        for auth_method in self.auth_methods:
-            authenticated = auth_method(self.conf, username, password)
+        current = settings.get()
+        auth_methods = self.auth_methods
+        if auth_methods is None:
+            auth_methods = plugins.backends()
+        for name, auth_method in auth_methods:
+            with tracing.span(name):
+                authenticated = auth_method(current, username, password)
             if authenticated:
                 return authenticated
 
@@ -54,20 +78,32 @@ class BaseLoginController(RestController):
             if not valid_user:
                 logger.error('Client requests authentication with wrong'
                              ' credentials.')
+                common.log_login('password', username, 'wrong credentials')
                 response.status = 401
-                return render('login.html',
-                              dict(back=back, message='Authorization failed.'))
+                return login_page(back, 'Authorization failed.')
             email, lastname, sshkey = valid_user
-            logger.info('Client requests authentication success %s' % username)
+            logger.info('Client requests authentication success %s', username)
+            common.log_login('password', username)
             common.setup_response(username, back, email, lastname, sshkey)
         else:
             logger.error('Client requests authentication without credentials.')
+            common.log_login('password', username, 'missing credentials')
             response.status = 401
-            return render('login.html', dict(back=back,
-                                             message='Authorization failed.'))
+            return login_page(back, 'Authorization failed.')
 
-    @expose(template='login.html')
+    @expose()
     def get(self, **kwargs):
         back = kwargs.get('back', '/auth/logout')
+        # the page is only served without a valid cookie, it must not be
+        # reused once the browser has one
+        response.vary = ('Cookie', )
+        if 'back' in kwargs and already_authenticated(back, 'ticket'):
+            return
         logger.info('Client requests the login page.')
-        return dict(back=back, message='')
+        body, etag = loginpage.get().render(back)
+        response.etag = etag
+        response.cache_control = 'private, max-age=%d' % loginpage.MAX_AGE
+        if etag in request.if_none_match:
+            response.status = 304
+            return ''
+        return body
@@ -16,13 +16,14 @@
 
 import urllib
 import logging
-import requests
 from requests.exceptions import ConnectionError
 
-from pecan import expose, response, conf, abort
+from pecan import expose, response, abort
 
-from cauth.model import db
-from cauth.utils import common
+from cauth import settings
+from cauth.controllers import base
+from cauth.model import store
+from cauth.utils import common, githubapi, tracing
 
 
 logger = logging.getLogger(__name__)
@@ -34,21 +35,15 @@ class PersonalAccessTokenGithubController(object):
     token has at least the following rights:
     'user:email, read:public_key, read:org'"""
 
-    def organization_allowed(self, token):
-        allowed_orgs = conf.auth['github'].get('allowed_organizations')
-
-        if allowed_orgs:
-            basic_auth = requests.auth.HTTPBasicAuth(token,
-                                                     'x-oauth-basic')
-            resp = requests.get("https://api.github.com/user/orgs",
-                                auth=basic_auth)
-            user_orgs = resp.json()
-            user_orgs = [org['login'] for org in user_orgs]
-
-            allowed_orgs = allowed_orgs.split(',')
-            allowed_orgs = filter(None, allowed_orgs)
-            allowed = set(user_orgs) & set(allowed_orgs)
-            if not allowed:
+    def organization_allowed(self, token, user_orgs=None):
+        github = settings.get().github
+
+        if github.allowed_organizations:
+            if user_orgs is None:
+                user_orgs = github.resolver.organizations(token,
+                                                          basic_auth=True)
+
+            if github.allowed_organizations.isdisjoint(user_orgs):
                 return False
         return True
 
@@ -62,37 +57,38 @@ class PersonalAccessTokenGithubController(object):
             logger.error('Client requests authentication without token.')
             abort(422)
         token = kwargs['token']
-        resp = requests.get("https://api.github.com/user",
-                            auth=requests.auth.HTTPBasicAuth(token,
-                                                             'x-oauth-basic'))
-        data = resp.json()
-        login = data.get('login')
-        email = data.get('email')
-        name = data.get('name')
-        resp = requests.get("https://api.github.com/user/keys",
-                            auth=requests.auth.HTTPBasicAuth(token,
-                                                             'x-oauth-basic'))
-        ssh_keys = resp.json()
-
-        if not self.organization_allowed(token):
+        resolver = settings.get().github.resolver
+        with tracing.span('github_resolve'):
+            login, email, name, ssh_keys, orgs = resolver.resolve(
+                token, basic_auth=True)
+
+        if not login:
+            common.log_login('github_token', None, 'unknown token')
+            abort(401)
+        with tracing.span('github_organizations'):
+            allowed = self.organization_allowed(token, orgs)
+        if not allowed:
+            common.log_login('github_token', login, 'organization')
             abort(401)
         msg = 'Client %s (%s) auth with Github Personal Access token success.'
-        logger.info(msg % (login, email))
+        logger.info(msg, login, email)
+        common.log_login('github_token', login)
         common.setup_response(login, back, email, name, ssh_keys)
 
 
 class GithubController(object):
     def get_access_token(self, code):
-        github = conf.auth['github']
+        github = settings.get().github
         url = "https://github.com/login/oauth/access_token"
         params = {
-            "client_id": github['client_id'],
-            "client_secret": github['client_secret'],
+            "client_id": github.client_id,
+            "client_secret": github.client_secret,
             "code": code,
-            "redirect_uri": github['redirect_uri']}
+            "redirect_uri": github.redirect_uri}
         headers = {'Accept': 'application/json'}
         try:
-            resp = requests.post(url, params=params, headers=headers)
+            resp = githubapi.request('access_token', 'POST', url,
+                                     params=params, headers=headers)
         except ConnectionError:
             return None
 
@@ -100,33 +96,27 @@ class GithubController(object):
         if 'access_token' in jresp:
             return jresp['access_token']
         elif 'error' in jresp:
-            logger.error("An error occured (%s): %s" % (
-                jresp.get('error', None),
-                jresp.get('error_description', None)))
+            logger.error("An error occured (%s): %s",
+                         jresp.get('error', None),
+                         jresp.get('error_description', None))
         return None
 
-    def organization_allowed(self, token):
-        allowed_orgs = conf.auth['github'].get('allowed_organizations')
-        if allowed_orgs:
-            resp = requests.get("https://api.github.com/user/orgs",
-                                headers={'Authorization': 'token ' + token})
+    def organization_allowed(self, token, user_orgs=None):
+        github = settings.get().github
+        if github.allowed_organizations:
+            if user_orgs is None:
+                user_orgs = github.resolver.organizations(token)
 
-            user_orgs = resp.json()
-            user_orgs = [org['login'] for org in user_orgs]
-
-            allowed_orgs = allowed_orgs.split(',')
-            allowed_orgs = filter(None, allowed_orgs)
-            allowed = set(user_orgs) & set(allowed_orgs)
-            if not allowed:
+            if github.allowed_organizations.isdisjoint(user_orgs):
                 return False
         return True
 
     @expose()
     def callback(self, **kwargs):
         if 'error' in kwargs:
-            logger.error('GITHUB callback called with an error (%s): %s' % (
-                kwargs.get('error', None),
-                kwargs.get('error_description', None)))
+            logger.error('GITHUB callback called with an error (%s): %s',
+                         kwargs.get('error', None),
+                         kwargs.get('error_description', None))
         state = kwargs.get('state', None)
         code = kwargs.get('code', None)
         if not state or not code:
@@ -135,33 +125,37 @@ class GithubController(object):
             abort(400)
 
         # Verify the state previously put in the db
-        back = db.get_url(state)
+        with tracing.span('state'):
+            back = store.get().get_url(state)
         if not back:
             logger.error('GITHUB callback called with an unknown state.')
+            common.log_login('github', None, 'unknown state')
             abort(401)
 
-        token = self.get_access_token(code)
+        with tracing.span('github_token'):
+            token = self.get_access_token(code)
         if not token:
             logger.error('Unable to request a token on GITHUB.')
+            common.log_login('github', None, 'no token')
             abort(401)
 
-        resp = requests.get("https://api.github.com/user",
-                            headers={'Authorization': 'token ' + token})
-        data = resp.json()
-        login = data.get('login')
-        email = data.get('email')
-        name = data.get('name')
-
-        resp = requests.get("https://api.github.com/users/%s/keys" % login,
-                            headers={'Authorization': 'token ' + token})
-        ssh_keys = resp.json()
+        resolver = settings.get().github.resolver
+        with tracing.span('github_resolve'):
+            login, email, name, ssh_keys, orgs = resolver.resolve(token)
 
-        if not self.organization_allowed(token):
+        if not login:
+            common.log_login('github', None, 'unknown user')
+            abort(401)
+        with tracing.span('github_organizations'):
+            allowed = self.organization_allowed(token, orgs)
+        if not allowed:
+            common.log_login('github', login, 'organization')
             abort(401)
 
         logger.info(
-            'Client (username: %s, email: %s) auth on GITHUB success.'
-            % (login, email))
+            'Client (username: %s, email: %s) auth on GITHUB success.',
+            login, email)
+        common.log_login('github', login)
         common.setup_response(login, back, email, name, ssh_keys)
 
     @expose()
@@ -172,15 +166,14 @@ class GithubController(object):
                 'without back in params.')
             abort(422)
         back = kwargs['back']
-        state = db.put_url(back)
-        scope = 'user:email, read:public_key, read:org'
-        github = conf.auth['github']
+        if base.already_authenticated(back, 'ticket'):
+            return
+        with tracing.span('state'):
+            state = store.get().put_url(back)
+        github = settings.get().github
         logger.info(
             'Client requests authentication via GITHUB -' +
-            'redirect to %s.' % github['redirect_uri'])
+            'redirect to %s.', github.redirect_uri)
         response.status_code = 302
-        response.location = github['auth_url'] + "?" + \
-            urllib.urlencode({'client_id': github['client_id'],
-                              'redirect_uri': github['redirect_uri'],
-                              'state': state,
-                              'scope': scope})
+        response.location = github.authorize_url + "&" + \
+            urllib.urlencode({'state': state})
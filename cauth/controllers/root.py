@@ -15,12 +15,15 @@
 # under the License.
 
 import logging
+import time
+import urllib
 
-from pecan import expose, response, conf
+from pecan import expose, request, response, abort
 from pecan.rest import RestController
 
-from cauth import auth
-from cauth.controllers import base, github
+from cauth import settings
+from cauth.controllers import admin, base, github
+from cauth.utils import common, health, logs, metrics
 
 
 # TODO(mhu) This should be in the app config, and i18n'zed
@@ -30,19 +33,68 @@ logger = logging.getLogger(__name__)
 
 
 class LogoutController(RestController):
-    @expose(template='login.html')
+    @expose()
     def get(self, **kwargs):
-        response.delete_cookie('auth_pubtkt', domain=conf.app.cookie_domain)
-        return dict(back='/', message=LOGOUT_MSG)
+        # refused by cauth until it expires, even if it was copied
+        ticket = common.revoke_ticket()
+        response.delete_cookie('auth_pubtkt',
+                               domain=settings.get().app.cookie_domain)
+        logs.event('logout', username=ticket and ticket['uid'],
+                   remote_addr=request.remote_addr)
+        return base.login_page('/', LOGOUT_MSG)
+
+
+class RenewController(RestController):
+    """Signs a new ticket for the client when its ticket expires within
+    the renew window, without checking its credentials again."""
+
+    @expose('json')
+    def get(self, **kwargs):
+        back = kwargs.get('back')
+        ticket = common.current_ticket()
+        if ticket is None:
+            if back:
+                # the client has to log in again
+                response.status_code = 303
+                response.location = '/auth/login?' + urllib.urlencode(
+                    {'back': back})
+                return response
+            abort(401)
+        uid = ticket['uid']
+        validuntil = ticket['validuntil']
+        renewed = validuntil - time.time() <= settings.get().app.renew_window
+        if renewed:
+            validuntil = common.set_ticket(uid)
+            logs.event('renew', username=uid,
+                       remote_addr=request.remote_addr)
+        if back:
+            common.redirect_back(back)
+            return response
+        return {'uid': uid, 'validuntil': validuntil, 'renewed': renewed}
 
 
 class RootController(object):
     login = base.BaseLoginController()
-    login.register(auth.check_static_user)
-    login.register(auth.check_db_user)
-    login.register(auth.check_ldap_user)
 
     login.github = github.GithubController()
     login.githubAPIkey = github.PersonalAccessTokenGithubController()
 
     logout = LogoutController()
+    renew = RenewController()
+    admin = admin.AdminController()
+
+    @expose(content_type='text/plain')
+    def metrics(self):
+        return metrics.collect()
+
+    @expose('json')
+    def health(self):
+        # the process serves requests
+        return {'status': 'ok'}
+
+    @expose('json')
+    def ready(self):
+        status = health.status()
+        if not status['ready']:
+            response.status = 503
+        return status
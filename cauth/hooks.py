@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import os
+import threading
+
+from pecan.hooks import PecanHook
+
+from cauth.utils import profiling, tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+class TraceFile(object):
+    """Appends the traces to a file in the Chrome trace event format, which
+    chrome://tracing and Perfetto load. The events of each process are
+    told apart by their pid."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def event(self, name, start, duration, trace, args=None):
+        return {'name': name, 'cat': 'cauth', 'ph': 'X',
+                'ts': int(start * 1000000), 'dur': int(duration * 1000000),
+                'pid': os.getpid(), 'tid': trace.thread, 'args': args or {}}
+
+    def write(self, trace):
+        events = [self.event('%s %s' % (trace.method, trace.path),
+                             trace.start, trace.duration, trace)]
+        events.extend(self.event(name, start, duration, trace)
+                      for name, start, duration in trace.spans)
+        data = ''.join('%s,\n' % json.dumps(e) for e in events)
+        with self.lock:
+            # a single write per trace, the file is opened in append mode
+            # so that the processes do not overwrite each other
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0644)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    # the closing bracket is optional in this format
+                    data = '[\n' + data
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+
+class TimingHook(PecanHook):
+    """Records the duration of the phases of each request, logs the
+    requests slower than slow_request seconds with their breakdown and
+    optionally exports all the traces to trace_file."""
+
+    def __init__(self, slow_request=1.0, trace_file=None):
+        self.slow_request = slow_request
+        self.trace_file = TraceFile(trace_file) if trace_file else None
+
+    def on_route(self, state):
+        tracing.start(state.request.method, state.request.path)
+
+    def after(self, state):
+        trace = tracing.stop()
+        if trace is None:
+            return
+        if self.slow_request and trace.duration >= self.slow_request:
+            logger.warning('Slow request %s %s took %.3fs: %s',
+                           trace.method, trace.path, trace.duration,
+                           trace.breakdown() or 'no phase recorded')
+        if self.trace_file:
+            try:
+                self.trace_file.write(trace)
+            except (IOError, OSError) as e:
+                logger.error('Unable to write the trace: %s', e)
+
+
+def endpoint(controller):
+    """Return the name of the controller method serving a request."""
+    name = getattr(controller, '__name__', type(controller).__name__)
+    owner = getattr(controller, '__self__', None)
+    if owner is None:
+        return name
+    return '%s.%s' % (type(owner).__name__, name)
+
+
+class ProfilingHook(PecanHook):
+    """Lets the profiler sample the requests while it is enabled. The
+    samples are counted per controller, the requests which are not routed
+    to one are not sampled."""
+
+    def before(self, state):
+        profiler = profiling.get()
+        if profiler is not None:
+            profiler.track(endpoint(state.controller))
+
+    def untrack(self):
+        profiler = profiling.get()
+        if profiler is not None:
+            profiler.untrack()
+
+    def after(self, state):
+        self.untrack()
+
+    def on_error(self, state, e):
+        # some versions of pecan do not run the after hooks when the
+        # controller raises
+        self.untrack()
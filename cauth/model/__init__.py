@@ -16,7 +16,7 @@
 
 from sqlalchemy import create_engine
 from pecan import conf
-from db import Session, Base, reset
+from db import Session, Base, reset, upgrade
 
 
 def create_from_conf():
@@ -29,25 +29,9 @@ def init_model():
     engine = create_from_conf()
     conf.sqlalchemy.engine = engine
     engine.connect()
+    Session.configure(bind=engine)
+    upgrade(engine)
     # create the tables if not existing
     Base.metadata.create_all(engine)
 
-    start()
     reset()
-    clear()
-
-
-def start():
-    Session.bind = conf.sqlalchemy.engine
-
-
-def commit():
-    Session.commit()
-
-
-def rollback():
-    Session.rollback()
-
-
-def clear():
-    Session.remove()
@@ -14,17 +14,25 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import string
+import contextlib
+import logging
 import random
+import string
+import threading
+import time
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Text, inspect
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 Session = scoped_session(sessionmaker())
 
 STATE_LEN = 16
+DEFAULT_TTL = 600
+
+logger = logging.getLogger(__name__)
 
 
 def gen_state(len):
@@ -37,27 +45,230 @@ class state_mapping(Base):
     __tablename__ = 'state_mapping'
 
     index = Column(Integer, primary_key=True)
-    state = Column(String(STATE_LEN))
+    state = Column(String(STATE_LEN), unique=True, index=True)
     url = Column(String)
+    created_at = Column(Integer, nullable=False, index=True)
+
+
+class provisioned_user(Base):
+    __tablename__ = 'provisioned_user'
+
+    username = Column(String(255), primary_key=True)
+    fingerprint = Column(String(40), nullable=False)
+    updated_at = Column(Integer, nullable=False)
+
+
+class provisioning_step(Base):
+    __tablename__ = 'provisioning_outbox'
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(40), unique=True, nullable=False)
+    step = Column(String(16), nullable=False)
+    username = Column(String(255), nullable=False, index=True)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    # NULL once the step is given up
+    next_attempt_at = Column(Integer, index=True)
+    last_error = Column(Text)
+    created_at = Column(Integer, nullable=False)
+
+
+def upgrade(engine):
+    """Drop a state_mapping table created without the created_at column,
+    it is then recreated by create_all. The states are only valid during
+    an authentication, nothing is lost."""
+    inspector = inspect(engine)
+    if 'state_mapping' not in inspector.get_table_names():
+        return
+    columns = [c['name'] for c in inspector.get_columns('state_mapping')]
+    if 'created_at' not in columns:
+        state_mapping.__table__.drop(engine)
+
+
+@contextlib.contextmanager
+def transaction():
+    """Provide a session for the duration of one transaction. Sessions are
+    only created by the code actually using the database."""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
 
 
 def put_url(url):
     state = gen_state(STATE_LEN)
-    cm = state_mapping(state=state, url=url)
-    Session.add(cm)
-    Session.commit()
+    with transaction() as session:
+        session.add(state_mapping(state=state, url=url,
+                                  created_at=int(time.time())))
 
     return state
 
 
-def get_url(state):
-    ci = Session.query(state_mapping).filter_by(state=state)
-    ret = None if ci.first() is None else ci.first().url
-    if ci:
-        ci.delete()
+def get_url(state, ttl=DEFAULT_TTL):
+    with transaction() as session:
+        row = session.query(state_mapping.index, state_mapping.url,
+                            state_mapping.created_at).filter_by(
+                                state=state).first()
+        if row is None:
+            return None
+        # Only the request which actually deletes the row may use the state
+        deleted = session.query(state_mapping).filter_by(
+            index=row.index).delete(synchronize_session=False)
+    if not deleted or row.created_at < time.time() - ttl:
+        return None
+    return row.url
+
+
+def get_fingerprint(username):
+    with transaction() as session:
+        row = session.query(provisioned_user.fingerprint).filter_by(
+            username=username).first()
+    return row.fingerprint if row else None
+
+
+def set_fingerprint(username, fingerprint):
+    try:
+        with transaction() as session:
+            session.merge(provisioned_user(username=username,
+                                           fingerprint=fingerprint,
+                                           updated_at=int(time.time())))
+    except IntegrityError:
+        # inserted at the same time by another worker
+        pass
+
+
+def add_step(key, step, username, payload, next_attempt_at, error=None):
+    """Record a failed provisioning step. The steps recorded before for
+    the same user and service are superseded, and a step given up with
+    the same key is scheduled again."""
+    with transaction() as session:
+        session.query(provisioning_step).filter(
+            provisioning_step.username == username,
+            provisioning_step.step == step,
+            provisioning_step.key != key).delete(synchronize_session=False)
+    try:
+        with transaction() as session:
+            session.add(provisioning_step(key=key, step=step,
+                                          username=username, payload=payload,
+                                          attempts=1, last_error=error,
+                                          next_attempt_at=next_attempt_at,
+                                          created_at=int(time.time())))
+    except IntegrityError:
+        with transaction() as session:
+            session.query(provisioning_step).filter(
+                provisioning_step.key == key,
+                provisioning_step.next_attempt_at.is_(None)).update(
+                    {'attempts': 1, 'next_attempt_at': next_attempt_at,
+                     'last_error': error}, synchronize_session=False)
+
+
+def claim_steps(now, lease, limit):
+    """Return up to limit steps due at now. They are postponed by lease
+    seconds, so that the other workers skip them while they are
+    replayed."""
+    claimed = []
+    with transaction() as session:
+        rows = session.query(
+            provisioning_step.id, provisioning_step.step,
+            provisioning_step.username, provisioning_step.payload,
+            provisioning_step.attempts,
+            provisioning_step.next_attempt_at).filter(
+                provisioning_step.next_attempt_at <= now).order_by(
+                    provisioning_step.next_attempt_at).limit(limit).all()
+        for row in rows:
+            if session.query(provisioning_step).filter_by(
+                    id=row.id, next_attempt_at=row.next_attempt_at).update(
+                        {'next_attempt_at': now + lease},
+                        synchronize_session=False):
+                claimed.append(row)
+    return claimed
+
+
+def finish_step(id):
+    """Delete a replayed step and return the amount of steps still
+    recorded for its user."""
+    with transaction() as session:
+        row = session.query(provisioning_step.username).filter_by(
+            id=id).first()
+        if row is None:
+            return 0
+        session.query(provisioning_step).filter_by(id=id).delete(
+            synchronize_session=False)
+        return session.query(provisioning_step).filter_by(
+            username=row.username).count()
+
+
+def retry_step(id, attempts, next_attempt_at, error):
+    with transaction() as session:
+        session.query(provisioning_step).filter_by(id=id).update(
+            {'attempts': attempts, 'next_attempt_at': next_attempt_at,
+             'last_error': error}, synchronize_session=False)
+
+
+def outbox_stats(now):
+    """Return the amounts of steps waiting, due and given up."""
+    with transaction() as session:
+        query = session.query(provisioning_step)
+        waiting = query.filter(
+            provisioning_step.next_attempt_at.isnot(None)).count()
+        due = query.filter(provisioning_step.next_attempt_at <= now).count()
+        given_up = query.filter(
+            provisioning_step.next_attempt_at.is_(None)).count()
+    return {'waiting': waiting, 'due': due, 'given_up': given_up}
+
+
+def sweep(session, ttl, batch_size=500):
+    """Delete the expired states, batch_size rows per transaction, and
+    return the amount of deleted rows."""
+    limit = int(time.time()) - ttl
+    total = 0
+    while True:
+        indexes = [r.index for r in
+                   session.query(state_mapping.index).filter(
+                       state_mapping.created_at < limit).limit(batch_size)]
+        if indexes:
+            session.query(state_mapping).filter(
+                state_mapping.index.in_(indexes)).delete(
+                    synchronize_session=False)
+            session.commit()
+            total += len(indexes)
+        if len(indexes) < batch_size:
+            return total
+
+
+class Sweeper(threading.Thread):
+    """Periodically deletes the states of the abandoned authentications."""
+
+    def __init__(self, ttl, interval, batch_size=500):
+        super(Sweeper, self).__init__(name='state-sweeper')
+        self.daemon = True
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            session = Session.session_factory()
+            try:
+                deleted = sweep(session, self.ttl, self.batch_size)
+                if deleted:
+                    logger.info('Removed %d expired states.', deleted)
+            except Exception as e:
+                session.rollback()
+                logger.error('Unable to remove the expired states: %s', e)
+            finally:
+                session.close()
 
-    return ret
+    def stop(self):
+        self.stopped.set()
 
 
 def reset():
-    Session.query(state_mapping).delete()
+    with transaction() as session:
+        session.query(state_mapping).delete()
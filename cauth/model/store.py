@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Stores for the GitHub OAuth state -> back url mapping."""
+
+import base64
+import collections
+import errno
+import hashlib
+import hmac
+import os
+import re
+import threading
+import time
+import uuid
+
+from cauth.model import db
+
+
+DEFAULT_TTL = db.DEFAULT_TTL
+
+STATE_RE = re.compile('^[A-Za-z0-9]{%d}$' % db.STATE_LEN)
+
+_store = None
+
+
+class StateStore(object):
+    """The states of the OAuth logins. A store provides put_url(url),
+    storing url and returning the state identifying it, and get_url(state),
+    returning the url stored for state, or None if it is unknown or
+    expired. A state can only be used once."""
+
+    def reset(self):
+        pass
+
+
+class SQLStateStore(StateStore):
+    """The state_mapping table of the SQLAlchemy model. The expired states
+    are deleted every sweep_interval seconds by a background thread."""
+
+    def __init__(self, ttl=DEFAULT_TTL, sweep_interval=0, sweep_batch=500):
+        self.ttl = ttl
+        self.sweeper = None
+        if sweep_interval:
+            self.sweeper = db.Sweeper(ttl, sweep_interval, sweep_batch)
+            self.sweeper.start()
+
+    def put_url(self, url):
+        return db.put_url(url)
+
+    def get_url(self, state):
+        return db.get_url(state, self.ttl)
+
+    def reset(self):
+        db.reset()
+
+
+class MemoryStateStore(StateStore):
+    """A dict local to the process. Only usable when the callback is
+    served by the worker that started the authentication."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.states = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def purge(self, now):
+        # states are kept in creation order, so in expiry order too
+        while self.states:
+            state = next(iter(self.states))
+            if self.states[state][1] > now:
+                break
+            del self.states[state]
+
+    def put_url(self, url):
+        state = db.gen_state(db.STATE_LEN)
+        now = time.time()
+        with self.lock:
+            self.purge(now)
+            self.states[state] = (url, now + self.ttl)
+        return state
+
+    def get_url(self, state):
+        with self.lock:
+            url, expires = self.states.pop(state, (None, 0))
+        if expires < time.time():
+            return None
+        return url
+
+    def reset(self):
+        with self.lock:
+            self.states.clear()
+
+
+class ShmStateStore(StateStore):
+    """One file per state in a directory, by default on the /dev/shm
+    tmpfs, shared by all the workers of a host."""
+
+    def __init__(self, path='/dev/shm/cauth', ttl=DEFAULT_TTL,
+                 purge_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.puts = 0
+        try:
+            os.makedirs(path, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def put_url(self, url):
+        self.puts += 1
+        if self.puts % self.purge_every == 0:
+            self.purge()
+        state = db.gen_state(db.STATE_LEN)
+        fd = os.open(os.path.join(self.path, state),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.write(fd, '%f\n%s' % (time.time() + self.ttl,
+                                     url.encode('utf8')))
+        finally:
+            os.close(fd)
+        return state
+
+    def get_url(self, state):
+        if not STATE_RE.match(state):
+            return None
+        # the rename is atomic, only one worker can claim a state
+        claimed = os.path.join(self.path,
+                               '%s.%s' % (state, uuid.uuid4().hex))
+        try:
+            os.rename(os.path.join(self.path, state), claimed)
+        except OSError:
+            return None
+        try:
+            with open(claimed) as f:
+                expires, url = f.read().split('\n', 1)
+        finally:
+            os.unlink(claimed)
+        if float(expires) < time.time():
+            return None
+        return url.decode('utf8')
+
+    def purge(self):
+        """Remove the files of the abandoned authentications."""
+        limit = time.time() - self.ttl
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def reset(self):
+        for name in os.listdir(self.path):
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+class SignedStateStore(StateStore):
+    """Nothing is stored server side: the state holds the url, a nonce and
+    a timestamp, signed with HMAC-SHA256. Any node sharing the secret can
+    verify it. The nonces seen recently are remembered to refuse a replay
+    of the same state on this process."""
+
+    def __init__(self, secret, ttl=DEFAULT_TTL, nonce_cache_size=10000):
+        self.secret = secret
+        self.ttl = ttl
+        self.nonce_cache_size = nonce_cache_size
+        self.nonces = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def put_url(self, url):
+        payload = '%d:%s:%s' % (time.time(), os.urandom(8).encode('hex'),
+                                url.encode('utf8'))
+        return '%s.%s' % (b64encode(payload), b64encode(self.sign(payload)))
+
+    def use_nonce(self, nonce, timestamp):
+        """Return False if nonce was already used, otherwise remember it."""
+        now = time.time()
+        with self.lock:
+            if nonce in self.nonces:
+                return False
+            # forget the nonces of the expired states, then the oldest ones
+            while self.nonces and (
+                    len(self.nonces) >= self.nonce_cache_size or
+                    self.nonces[next(iter(self.nonces))] < now - self.ttl):
+                self.nonces.popitem(last=False)
+            self.nonces[nonce] = timestamp
+        return True
+
+    def get_url(self, state):
+        try:
+            payload, signature = [b64decode(p) for p in state.split('.')]
+            timestamp, nonce, url = payload.split(':', 2)
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            return None
+        if not hmac.compare_digest(self.sign(payload), signature):
+            return None
+        if not time.time() - self.ttl <= timestamp <= time.time():
+            return None
+        if not self.use_nonce(nonce, timestamp):
+            return None
+        return url.decode('utf8')
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def b64decode(data):
+    data = str(data)
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def signing_secret(state_store, priv_key_path):
+    """Return the configured secret, or derive one from the private key
+    signing the tickets, which is shared by all the cauth nodes."""
+    if state_store.secret:
+        return str(state_store.secret)
+    with open(priv_key_path) as f:
+        return hmac.new(f.read(), 'cauth oauth state',
+                        hashlib.sha256).digest()
+
+
+def setup(settings):
+    """Instantiate the state store described by the state_store settings
+    and make it the current one."""
+    global _store
+    state_store = settings.state_store
+    if _store is not None and getattr(_store, 'sweeper', None):
+        _store.sweeper.stop()
+    if state_store.backend == 'signed':
+        secret = signing_secret(state_store, settings.app.priv_key_path)
+        _store = SignedStateStore(secret, state_store.ttl,
+                                  state_store.nonce_cache_size)
+    elif state_store.backend == 'sql':
+        _store = SQLStateStore(state_store.ttl, state_store.sweep_interval,
+                               state_store.sweep_batch)
+    elif state_store.backend == 'shm':
+        _store = ShmStateStore(state_store.path, state_store.ttl)
+    else:
+        _store = MemoryStateStore(state_store.ttl)
+    return _store
+
+
+def get():
+    global _store
+    if _store is None:
+        _store = SQLStateStore()
+    return _store
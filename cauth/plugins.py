@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""The authentication backends and the provisioners, discovered through the
+cauth.backends and cauth.provisioners entry points.
+
+A plugin is named after its configuration section, and only loaded, its
+module with it, when this section is configured: the sections of auth for
+the backends, the top-level sections for the provisioners.
+
+A backend is a function(settings, username, password) returning the
+(email, lastname, keys) of the user when the credentials are valid. A
+provisioner is a function(username, email, lastname, keys) returning True
+once the service knows the user, its failures are replayed from the
+provisioning outbox.
+
+The sections of the plugins unknown to cauth are kept as they are, read-only,
+in the plugins mapping of the settings, by name."""
+
+import importlib
+
+from cauth import settings
+
+
+BACKENDS = 'cauth.backends'
+PROVISIONERS = 'cauth.provisioners'
+
+# the plugins of cauth, also found when it runs from a source checkout;
+# they are tried in this order, before the other plugins
+BUILTIN = {
+    BACKENDS: (('users', 'cauth.auth:check_static_user'),
+               ('localdb', 'cauth.auth:check_db_user'),
+               ('ldap', 'cauth.auth:check_ldap_user')),
+    PROVISIONERS: (('redmine', 'cauth.utils.provisioning:create_redmine_user'),
+                   ('gerrit', 'cauth.utils.provisioning:create_gerrit_user')),
+}
+
+_plugins = {}
+
+
+def resolve(path):
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def entry_points(group):
+    """Return the entry points of group by name, the first one wins."""
+    # pkg_resources is slow to import, only the app setup needs it
+    import pkg_resources
+    points = {}
+    for point in pkg_resources.iter_entry_points(group):
+        points.setdefault(point.name, point)
+    return points
+
+
+def load(group, configured, discover=True):
+    """Return the (name, plugin) of group for which configured(name) is
+    true."""
+    builtin = BUILTIN[group]
+    points = entry_points(group) if discover else {}
+    names = [name for name, path in builtin]
+    names.extend(sorted(set(points) - set(names)))
+    plugins = []
+    for name in names:
+        if not configured(name):
+            continue
+        if name in points:
+            point = points[name]
+            if hasattr(point, 'resolve'):
+                plugin = point.resolve()
+            else:
+                plugin = point.load(require=False)
+        else:
+            plugin = resolve(dict(builtin)[name])
+        plugins.append((name, plugin))
+    return plugins
+
+
+def setup(config):
+    """Load the plugins configured in config."""
+    auth = settings.get_section(config, 'auth')
+    _plugins[BACKENDS] = load(BACKENDS,
+                              lambda name: auth.get(name) is not None)
+    _plugins[PROVISIONERS] = load(
+        PROVISIONERS,
+        lambda name: settings.get_section(config, name, False) is not None)
+    return _plugins
+
+
+def get(group):
+    """Return the plugins of group, the builtin ones configured in the
+    current settings when setup was not called."""
+    if group not in _plugins:
+        current = settings.get()
+        _plugins[group] = load(group, lambda name: getattr(current, name,
+                                                           None),
+                               discover=False)
+    return _plugins[group]
+
+
+def backends():
+    return get(BACKENDS)
+
+
+def provisioners():
+    return get(PROVISIONERS)
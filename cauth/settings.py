@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Immutable snapshot of the configuration used by the request handlers.
+
+The pecan configuration is checked once at startup by load(), and compiled
+into read-only objects holding precomputed values (URLs, sets, ...), so
+that the handlers only read plain attributes and a misconfiguration is
+reported at boot instead of on the first login."""
+
+import urllib
+
+from cauth.utils import githubapi
+
+
+GITHUB_SCOPE = 'user:email, read:public_key, read:org'
+
+STATE_STORES = ('sql', 'memory', 'shm', 'signed')
+
+PROVISIONING_SYNC_MODES = ('never', 'first', 'always')
+
+# the threads of a mod_wsgi daemon process, by default
+WSGI_THREADS = 15
+
+# the sections read by cauth and pecan, the other ones configure plugins
+AUTH_SECTIONS = ('users', 'localdb', 'ldap', 'github')
+SECTIONS = ('app', 'auth', 'gerrit', 'redmine', 'state_store', 'provisioning',
+            'metrics', 'tracing', 'admin', 'profiling', 'memory', 'health',
+            'revocation', 'logout', 'sqlalchemy', 'logging', 'server')
+
+_current = None
+
+
+class ConfigurationError(Exception):
+    pass
+
+
+class FrozenDict(dict):
+    """A dict which cannot be modified."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+
+class Frozen(object):
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (n, getattr(self, n))
+                                     for n in self.__slots__))
+
+
+class AppSettings(Frozen):
+    __slots__ = ('priv_key_path', 'cookie_domain', 'cookie_period',
+                 'renew_window')
+
+
+class GithubSettings(Frozen):
+    __slots__ = ('auth_url', 'redirect_uri', 'client_id', 'client_secret',
+                 'allowed_organizations', 'authorize_url', 'resolver')
+
+
+class LdapSettings(Frozen):
+    __slots__ = ('host', 'dn', 'sn', 'mail', 'attrlist')
+
+
+class LocalDBSettings(Frozen):
+    __slots__ = ('managesf_url', 'bind_url')
+
+
+class GerritSettings(Frozen):
+    __slots__ = ('url', 'accounts_url', 'admin_user', 'admin_password',
+                 'db_host', 'db_name', 'db_user', 'db_password',
+                 'db_pool_size', 'db_pool_recycle', 'sshkeys_workers',
+                 'delete_removed_sshkeys', 'http_pool_size', 'http_timeout',
+                 'account_cache_size')
+
+
+class RedmineSettings(Frozen):
+    __slots__ = ('apihost', 'apiurl', 'apikey', 'http_pool_size',
+                 'http_timeout')
+
+
+class StateStoreSettings(Frozen):
+    __slots__ = ('backend', 'ttl', 'path', 'sweep_interval', 'sweep_batch',
+                 'secret', 'nonce_cache_size')
+
+
+class ProvisioningSettings(Frozen):
+    __slots__ = ('workers', 'sync', 'index', 'outbox', 'outbox_interval',
+                 'outbox_max_attempts', 'outbox_backoff', 'branch_workers')
+
+
+class AdminSettings(Frozen):
+    __slots__ = ('allowed_ips', )
+
+
+class ProfilingSettings(Frozen):
+    __slots__ = ('directory', 'rate', 'interval', 'dump_interval')
+
+
+class HealthSettings(Frozen):
+    __slots__ = ('interval', 'timeout', 'optional')
+
+
+class MemorySettings(Frozen):
+    __slots__ = ('max_snapshots', 'trace_frames')
+
+
+class RevocationSettings(Frozen):
+    __slots__ = ('path', 'capacity', 'error_rate', 'check_interval')
+
+
+class TracingSettings(Frozen):
+    __slots__ = ('slow_request', 'trace_file')
+
+
+class MetricsSettings(Frozen):
+    __slots__ = ('directory', 'flush_interval')
+
+
+class Settings(Frozen):
+    __slots__ = ('app', 'users', 'localdb', 'ldap', 'github',
+                 'gerrit', 'redmine', 'state_store', 'provisioning',
+                 'metrics', 'tracing', 'admin', 'profiling', 'memory',
+                 'health', 'revocation', 'plugins')
+
+
+def to_dict(section):
+    if hasattr(section, 'to_dict'):
+        return section.to_dict()
+    return dict(section)
+
+
+def get_section(config, name, required=True):
+    section = getattr(config, name, None)
+    if section is None:
+        if required:
+            raise ConfigurationError('Missing "%s" section' % name)
+        return None
+    return to_dict(section)
+
+
+def check_keys(name, section, keys):
+    missing = [k for k in keys if section.get(k) in (None, '')]
+    if missing:
+        raise ConfigurationError('Missing %s in "%s" section' %
+                                 (', '.join(missing), name))
+
+
+def get_integers(name, section, defaults):
+    """Return a dict of the integer values of the section, defaults is a
+    sequence of (key, default value)."""
+    values = {}
+    for key, default in defaults:
+        try:
+            values[key] = int(section.get(key, default))
+        except (TypeError, ValueError):
+            raise ConfigurationError('%s %s must be an integer' % (name, key))
+    return values
+
+
+BOOLEANS = {'true': True, 'yes': True, 'on': True, '1': True,
+            'false': False, 'no': False, 'off': False, '0': False}
+
+
+def get_booleans(name, section, defaults):
+    """Return a dict of the boolean values of the section, defaults is a
+    sequence of (key, default value)."""
+    values = {}
+    for key, default in defaults:
+        value = section.get(key, default)
+        if isinstance(value, basestring):
+            value = BOOLEANS.get(value.strip().lower())
+        elif value in (0, 1):
+            value = bool(value)
+        if not isinstance(value, bool):
+            raise ConfigurationError('%s %s must be a boolean' % (name, key))
+        values[key] = value
+    return values
+
+
+def compile_app(app):
+    check_keys('app', app, ('priv_key_path', 'cookie_domain'))
+    cookie_period = get_integers('app', app,
+                                 (('cookie_period', 43200), ))['cookie_period']
+    # the last quarter of the validity of a ticket, by default
+    renew_window = get_integers(
+        'app', app, (('renew_window', cookie_period // 4), ))['renew_window']
+    if not 0 <= renew_window < cookie_period:
+        raise ConfigurationError(
+            'app renew_window must be positive and shorter than the '
+            'cookie_period')
+    return AppSettings(priv_key_path=app['priv_key_path'],
+                       cookie_domain=app['cookie_domain'],
+                       cookie_period=cookie_period,
+                       renew_window=renew_window)
+
+
+def compile_users(users):
+    for username, user in users.items():
+        check_keys('auth users %s' % username, user, ('password', ))
+    return FrozenDict((username, (user['password'], user.get('mail'),
+                                  user.get('lastname')))
+                      for username, user in users.items())
+
+
+def compile_localdb(localdb):
+    check_keys('auth localdb', localdb, ('managesf_url', ))
+    return LocalDBSettings(
+        managesf_url=localdb['managesf_url'],
+        bind_url=urllib.basejoin(localdb['managesf_url'], '/manage/bind'))
+
+
+def compile_ldap(ldap):
+    check_keys('auth ldap', ldap, ('host', 'dn', 'sn', 'mail'))
+    try:
+        ldap['dn'] % {'username': 'username'}
+    except (KeyError, TypeError, ValueError):
+        raise ConfigurationError('auth ldap dn must be a format string '
+                                 'using %(username)s')
+    return LdapSettings(host=ldap['host'], dn=ldap['dn'],
+                        sn=ldap['sn'], mail=ldap['mail'],
+                        attrlist=(ldap['sn'], ldap['mail']))
+
+
+def compile_github(github):
+    check_keys('auth github', github,
+               ('auth_url', 'redirect_uri', 'client_id', 'client_secret'))
+    allowed_orgs = github.get('allowed_organizations') or ()
+    if isinstance(allowed_orgs, basestring):
+        allowed_orgs = allowed_orgs.split(',')
+    allowed_orgs = frozenset(o.strip() for o in allowed_orgs if o.strip())
+    try:
+        resolver = githubapi.get_resolver(github)
+    except ValueError as e:
+        raise ConfigurationError(str(e))
+    authorize_url = github['auth_url'] + '?' + urllib.urlencode(
+        (('client_id', github['client_id']),
+         ('redirect_uri', github['redirect_uri']),
+         ('scope', GITHUB_SCOPE)))
+    return GithubSettings(auth_url=github['auth_url'],
+                          redirect_uri=github['redirect_uri'],
+                          client_id=github['client_id'],
+                          client_secret=github['client_secret'],
+                          allowed_organizations=allowed_orgs,
+                          authorize_url=authorize_url,
+                          resolver=resolver)
+
+
+def compile_gerrit(gerrit):
+    keys = ('url', 'admin_user', 'admin_password',
+            'db_host', 'db_name', 'db_user', 'db_password')
+    check_keys('gerrit', gerrit, keys)
+    values = dict((k, gerrit[k]) for k in keys)
+    values.update(get_integers('gerrit', gerrit,
+                               (('db_pool_size', 5), ('db_pool_recycle', 3600),
+                                ('sshkeys_workers', 4), ('http_pool_size', 10),
+                                ('http_timeout', 10),
+                                ('account_cache_size', 10000))))
+    values.update(get_booleans('gerrit', gerrit,
+                               (('delete_removed_sshkeys', False), )))
+    return GerritSettings(accounts_url='%s/api/a/accounts' % gerrit['url'],
+                          **values)
+
+
+def compile_redmine(redmine):
+    check_keys('redmine', redmine, ('apiurl', 'apikey'))
+    return RedmineSettings(apihost=redmine.get('apihost'),
+                           apiurl=redmine['apiurl'],
+                           apikey=redmine['apikey'],
+                           **get_integers('redmine', redmine,
+                                          (('http_pool_size', 10),
+                                           ('http_timeout', 10))))
+
+
+def compile_state_store(state_store):
+    backend = state_store.get('backend', 'sql')
+    if backend not in STATE_STORES:
+        raise ConfigurationError('Unknown state_store backend "%s", '
+                                 'expected one of %s' %
+                                 (backend, ', '.join(STATE_STORES)))
+    values = get_integers('state_store', state_store,
+                          (('ttl', 600), ('sweep_interval', 60),
+                           ('sweep_batch', 500), ('nonce_cache_size', 10000)))
+    return StateStoreSettings(backend=backend,
+                              path=state_store.get('path', '/dev/shm/cauth'),
+                              secret=state_store.get('secret'),
+                              **values)
+
+
+def compile_provisioning(provisioning):
+    values = get_integers('provisioning', provisioning,
+                          (('workers', 0), ('outbox_interval', 30),
+                           ('outbox_max_attempts', 8),
+                           ('outbox_backoff', 30)))
+    # a login thread or a provisioning worker never waits for another
+    # user's steps
+    values.update(get_integers(
+        'provisioning', provisioning,
+        (('branch_workers', WSGI_THREADS + values['workers']), )))
+    if values['branch_workers'] < 1:
+        raise ConfigurationError(
+            'provisioning branch_workers must be at least 1')
+    sync = provisioning.get('sync', 'first')
+    if sync not in PROVISIONING_SYNC_MODES:
+        raise ConfigurationError('Unknown provisioning sync mode "%s", '
+                                 'expected one of %s' %
+                                 (sync, ', '.join(PROVISIONING_SYNC_MODES)))
+    values.update(get_booleans('provisioning', provisioning,
+                               (('index', True), ('outbox', True))))
+    return ProvisioningSettings(sync=sync, **values)
+
+
+def compile_metrics(metrics):
+    return MetricsSettings(directory=metrics.get('directory'),
+                           **get_integers('metrics', metrics,
+                                          (('flush_interval', 5), )))
+
+
+def compile_tracing(tracing):
+    try:
+        slow_request = float(tracing.get('slow_request', 1.0))
+    except (TypeError, ValueError):
+        raise ConfigurationError('tracing slow_request must be a number')
+    return TracingSettings(slow_request=slow_request,
+                           trace_file=tracing.get('trace_file'))
+
+
+def compile_admin(admin):
+    allowed_ips = admin.get('allowed_ips', ('127.0.0.1', '::1'))
+    if isinstance(allowed_ips, basestring):
+        allowed_ips = allowed_ips.split(',')
+    return AdminSettings(allowed_ips=frozenset(ip.strip()
+                                               for ip in allowed_ips))
+
+
+def compile_profiling(profiling):
+    values = {}
+    for key, default in (('rate', 0.01), ('interval', 0.005)):
+        try:
+            values[key] = float(profiling.get(key, default))
+        except (TypeError, ValueError):
+            raise ConfigurationError('profiling %s must be a number' % key)
+    values.update(get_integers('profiling', profiling,
+                               (('dump_interval', 60), )))
+    return ProfilingSettings(directory=profiling.get('directory'), **values)
+
+
+def compile_health(health):
+    optional = health.get('optional', ())
+    if isinstance(optional, basestring):
+        optional = optional.split(',')
+    return HealthSettings(optional=frozenset(name.strip() for name in optional
+                                             if name.strip()),
+                          **get_integers('health', health,
+                                         (('interval', 10), ('timeout', 2))))
+
+
+def compile_memory(memory):
+    return MemorySettings(**get_integers('memory', memory,
+                                         (('max_snapshots', 10),
+                                          ('trace_frames', 0))))
+
+
+def compile_revocation(revocation):
+    values = {}
+    for key, default in (('error_rate', 0.001), ('check_interval', 1)):
+        try:
+            values[key] = float(revocation.get(key, default))
+        except (TypeError, ValueError):
+            raise ConfigurationError('revocation %s must be a number' % key)
+    if not 0 < values['error_rate'] < 1:
+        raise ConfigurationError(
+            'revocation error_rate must be between 0 and 1')
+    values.update(get_integers('revocation', revocation,
+                               (('capacity', 100000), )))
+    return RevocationSettings(path=revocation.get('path'), **values)
+
+
+def freeze(value):
+    if isinstance(value, dict) or hasattr(value, 'to_dict'):
+        return FrozenDict((k, freeze(v)) for k, v in to_dict(value).items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def compile_plugins(config, auth):
+    """Return the sections of the plugins, the sections of auth and the
+    top-level sections unknown to cauth, by name."""
+    plugins = dict((name, freeze(section))
+                   for name, section in auth.items()
+                   if name not in AUTH_SECTIONS and section is not None)
+    if hasattr(config, 'to_dict'):
+        top_level = config.to_dict()
+    else:
+        top_level = vars(config)
+    for name, section in top_level.items():
+        if name in SECTIONS or name.startswith('_') or \
+                not (isinstance(section, dict) or hasattr(section, 'to_dict')):
+            continue
+        if name in plugins:
+            raise ConfigurationError('The "%s" section is both in auth and '
+                                     'at the top level' % name)
+        plugins[name] = freeze(section)
+    return FrozenDict(plugins)
+
+
+def compile_optional(config, name, compile_section):
+    section = get_section(config, name, False)
+    if section is None:
+        return None
+    return compile_section(section)
+
+
+def compile_settings(config):
+    """Check the configuration and return its Settings snapshot, raise
+    ConfigurationError when it is invalid."""
+    auth = get_section(config, 'auth')
+
+    def optional(name, compile_section):
+        if auth.get(name) is None:
+            return None
+        return compile_section(to_dict(auth[name]))
+
+    return Settings(app=compile_app(get_section(config, 'app')),
+                    users=optional('users', compile_users) or FrozenDict(),
+                    localdb=optional('localdb', compile_localdb),
+                    ldap=optional('ldap', compile_ldap),
+                    github=optional('github', compile_github),
+                    gerrit=compile_gerrit(get_section(config, 'gerrit')),
+                    redmine=compile_optional(config, 'redmine',
+                                             compile_redmine),
+                    state_store=compile_state_store(
+                        get_section(config, 'state_store', False) or {}),
+                    provisioning=compile_provisioning(
+                        get_section(config, 'provisioning', False) or {}),
+                    metrics=compile_metrics(
+                        get_section(config, 'metrics', False) or {}),
+                    tracing=compile_tracing(
+                        get_section(config, 'tracing', False) or {}),
+                    admin=compile_admin(
+                        get_section(config, 'admin', False) or {}),
+                    profiling=compile_profiling(
+                        get_section(config, 'profiling', False) or {}),
+                    memory=compile_memory(
+                        get_section(config, 'memory', False) or {}),
+                    health=compile_health(
+                        get_section(config, 'health', False) or {}),
+                    revocation=compile_revocation(
+                        get_section(config, 'revocation', False) or {}),
+                    plugins=compile_plugins(config, auth))
+
+
+def load(config):
+    """Compile the configuration and make it the current snapshot."""
+    global _current
+    _current = compile_settings(config)
+    return _current
+
+
+def get():
+    if _current is None:
+        raise ConfigurationError('The settings have not been loaded')
+    return _current
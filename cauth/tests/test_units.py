@@ -16,25 +16,42 @@ from unittest import TestCase
 from mock import patch, Mock, ANY
 from M2Crypto import RSA, BIO
 
-from cauth import auth
+from cauth import auth, hooks, plugins, settings
 
 from cauth.utils.userdetails import Gerrit
 from cauth.controllers import root, github
-from cauth.model import db
-from cauth.utils import common
+from cauth.model import db, store
+from cauth.utils import bulkprovision, clients, common, githubapi, health
+from cauth.utils import loginpage, logs, memory, metrics, outbox, pool
+from cauth.utils import profiling, provisioning, revocation, tracing
+from cauth.utils import userdetails
 
 from webtest import TestApp
-from pecan import load_app
+from sqlalchemy import create_engine
+from pecan import configuration, load_app
 from webob.exc import HTTPUnauthorized
 
+import Queue
+import StringIO
 import base64
 import crypt
 import tempfile
 import json
+import logging
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
 
 import httmock
+import requests
+import sqlalchemy
+import threading
+import urllib
 import urlparse
+import BaseHTTPServer
 
 
 def raise_(ex):
@@ -138,7 +155,9 @@ class FunctionalTest(TestCase):
                   'app': c.app,
                   'auth': c.auth,
                   'logout': c.logout,
-                  'sqlalchemy': c.sqlalchemy}
+                  'sqlalchemy': c.sqlalchemy,
+                  # the dependencies of the tests are not reachable
+                  'health': {'interval': 0}}
         # deactivate loggin that polute test output
         # even nologcapture option of nose effetcs
         # 'logging': c.logging}
@@ -160,10 +179,292 @@ class FakeResponse():
         return self._json
 
 
+SAMPLE_CONFIG = os.path.join(os.path.dirname(__file__), '../../etc/config.py')
+
+
+class TestSettings(TestCase):
+    def test_sample_config(self):
+        conf = configuration.conf_from_file(SAMPLE_CONFIG)
+        formatter = conf.logging['formatters']['json']
+        self.assertEqual('cauth.utils.logs.JSONFormatter', formatter['()'])
+        s = settings.compile_settings(conf)
+        self.assertEqual('http://redmine.url', s.redmine.apiurl)
+        self.assertEqual({}, s.plugins)
+
+    def test_compile(self):
+        conf = dummy_conf()
+        conf.auth['github']['allowed_organizations'] = 'acme, ,other,'
+        s = settings.compile_settings(conf)
+        self.assertEqual(frozenset(['acme', 'other']),
+                         s.github.allowed_organizations)
+        self.assertEqual('http://tests.dom/manage/bind', s.localdb.bind_url)
+        self.assertEqual('XXX/api/a/accounts', s.gerrit.accounts_url)
+        self.assertEqual(('sn', 'mail'), s.ldap.attrlist)
+        self.assertEqual(3600, s.app.cookie_period)
+        self.assertEqual(settings.WSGI_THREADS,
+                         s.provisioning.branch_workers)
+        parsed = urlparse.urlparse(s.github.authorize_url)
+        self.assertEqual(['XXX'], urlparse.parse_qs(parsed.query)['client_id'])
+
+    def test_frozen(self):
+        s = settings.compile_settings(dummy_conf())
+        self.assertRaises(AttributeError, setattr, s.app, 'cookie_period', 1)
+        self.assertRaises(AttributeError, setattr, s, 'github', None)
+        self.assertRaises(AttributeError, setattr, s.app, 'unknown', 1)
+        self.assertRaises(TypeError, s.users.pop, 'user1')
+        self.assertRaises(TypeError, s.users.__setitem__, 'root', None)
+
+    def test_booleans(self):
+        conf = dummy_conf()
+        conf.gerrit['delete_removed_sshkeys'] = 'false'
+        conf.provisioning = {'index': 'no', 'outbox': 1}
+        s = settings.compile_settings(conf)
+        self.assertIs(False, s.gerrit.delete_removed_sshkeys)
+        self.assertIs(False, s.provisioning.index)
+        self.assertIs(True, s.provisioning.outbox)
+        conf.provisioning = {'outbox': 'sometimes'}
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+
+    def test_plugin_sections(self):
+        conf = dummy_conf()
+        conf.auth['radius'] = {'host': 'radius.tests.dom', 'ports': [1812]}
+        conf.jenkins = {'url': 'http://jenkins.tests.dom'}
+        s = settings.compile_settings(conf)
+        self.assertEqual(['jenkins', 'radius'], sorted(s.plugins))
+        self.assertEqual('radius.tests.dom', s.plugins['radius']['host'])
+        self.assertEqual((1812,), s.plugins['radius']['ports'])
+        self.assertEqual('http://jenkins.tests.dom',
+                         s.plugins['jenkins']['url'])
+        self.assertRaises(TypeError, s.plugins['jenkins'].__setitem__,
+                          'url', None)
+        conf.radius = {'host': 'other.tests.dom'}
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+
+    def test_optional_backends(self):
+        conf = dummy_conf()
+        del conf.auth['ldap']
+        del conf.auth['github']
+        s = settings.compile_settings(conf)
+        self.assertEqual(None, s.ldap)
+        self.assertEqual(None, s.github)
+        self.assertEqual(None, auth.check_ldap_user(s, 'user1', 'userpass'))
+        del conf.redmine
+        s = settings.compile_settings(conf)
+        self.assertEqual(None, s.redmine)
+        self.assertEqual(None, clients.ClientRegistry(s).redmine)
+
+    def test_misconfiguration(self):
+        conf = dummy_conf()
+        del conf.auth['github']['client_id']
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+        conf = dummy_conf()
+        conf.auth['ldap']['dn'] = 'cn=%(user)s,dc=tests,dc=dom'
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+        conf = dummy_conf()
+        conf.app['cookie_period'] = 'forever'
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+        conf = dummy_conf()
+        del conf.gerrit
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+
+
+class TestPlugins(TestCase):
+    def test_configured(self):
+        backends = plugins.load(plugins.BACKENDS,
+                                lambda name: name != 'localdb',
+                                discover=False)
+        self.assertEqual([('users', auth.check_static_user),
+                          ('ldap', auth.check_ldap_user)], backends)
+
+    def test_entry_points(self):
+        custom = Mock()
+        points = {'custom': Mock(), 'ldap': Mock()}
+        points['custom'].resolve.return_value = custom
+        with patch('cauth.plugins.entry_points') as entry_points:
+            entry_points.return_value = points
+            backends = plugins.load(plugins.BACKENDS, lambda name: True)
+        # the builtin ones first, an entry point replaces a builtin one
+        self.assertEqual(['users', 'localdb', 'ldap', 'custom'],
+                         [name for name, backend in backends])
+        self.assertIs(points['ldap'].resolve.return_value, backends[2][1])
+        self.assertIs(custom, backends[3][1])
+
+    def test_setup(self):
+        conf = dummy_conf()
+        del conf.auth['ldap']
+        del conf.auth['localdb']
+        del conf.redmine
+        loaded = plugins.setup(conf)
+        self.assertEqual([('users', auth.check_static_user)],
+                         loaded[plugins.BACKENDS])
+        self.assertEqual([('gerrit', provisioning.create_gerrit_user)],
+                         loaded[plugins.PROVISIONERS])
+        plugins.setup(dummy_conf())
+
+    def test_lazy_imports(self):
+        # the modules of the backends are only imported when configured
+        heavy = ('ldap', 'MySQLdb', 'M2Crypto', 'basicauth',
+                 'pkg_resources')
+        code = ('import sys, time\n'
+                'start = time.time()\n'
+                'import cauth.app, cauth.controllers.root\n'
+                'print time.time() - start\n'
+                'print " ".join(m for m in %r if m in sys.modules)' % (heavy,))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        duration, loaded = (out.splitlines() + [''])[:2]
+        self.assertEqual('', loaded)
+        # a generous bound, the import takes a fraction of it
+        self.assertLess(float(duration), 10)
+
+
+class TestStateStores(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_store(self, s):
+        state = s.put_url(u'/r/\xe9')
+        self.assertEqual(state, urllib.quote(state))
+        self.assertEqual(None, s.get_url('unknown'))
+        self.assertEqual(u'/r/\xe9', s.get_url(state))
+        # a state can only be used once
+        self.assertEqual(None, s.get_url(state))
+        state = s.put_url('/r/')
+        later = time.time() + s.ttl + 1
+        with patch('time.time') as t:
+            t.return_value = later
+            self.assertEqual(None, s.get_url(state))
+
+    def test_memory_store(self):
+        s = store.MemoryStateStore(ttl=60)
+        self.check_store(s)
+        s.put_url('/r/')
+        later = time.time() + 61
+        with patch('time.time') as t:
+            t.return_value = later
+            s.put_url('/r/')
+        self.assertEqual(1, len(s.states))
+
+    def test_shm_store(self):
+        s = store.ShmStateStore(self.path, ttl=60)
+        self.check_store(s)
+        self.assertEqual(None, s.get_url('../../etc/passwd'))
+        # another worker sees the same states
+        state = s.put_url('/r/')
+        self.assertEqual('/r/', store.ShmStateStore(self.path).get_url(state))
+        s.put_url('/r/')
+        later = time.time() + 61
+        with patch('time.time') as t:
+            t.return_value = later
+            s.purge()
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_signed_store(self):
+        s = store.SignedStateStore('secret', ttl=60)
+        self.check_store(s)
+        # another node sharing the secret accepts the state
+        state = s.put_url('/r/')
+        self.assertEqual('/r/',
+                         store.SignedStateStore('secret').get_url(state))
+        self.assertEqual(None,
+                         store.SignedStateStore('other').get_url(state))
+        # tampering with the url invalidates the signature
+        payload, sig = state.split('.')
+        forged = store.b64decode(payload).replace('/r/', '/x/')
+        self.assertEqual(None, s.get_url(
+            '%s.%s' % (store.b64encode(forged), sig)))
+        for bad in ('', 'abc', 'a.b.c', u'\xe9.\xe9', state + 'x'):
+            self.assertEqual(None, s.get_url(bad))
+
+    def test_signed_store_nonce_cache(self):
+        s = store.SignedStateStore('secret', ttl=60, nonce_cache_size=2)
+        states = [s.put_url('/r/%d' % i) for i in range(3)]
+        for state in states:
+            self.assertTrue(s.get_url(state))
+        self.assertEqual(2, len(s.nonces))
+
+    def test_setup(self):
+        conf = dummy_conf()
+        conf.state_store = {'backend': 'shm', 'path': self.path, 'ttl': 30}
+        s = store.setup(settings.compile_settings(conf))
+        self.assertIsInstance(s, store.ShmStateStore)
+        self.assertEqual(30, s.ttl)
+        self.assertIs(s, store.get())
+        conf.state_store = {'backend': 'memory'}
+        self.assertIsInstance(store.setup(settings.compile_settings(conf)),
+                              store.MemoryStateStore)
+        gen_rsa_key()
+        conf.state_store = {'backend': 'signed'}
+        s1 = store.setup(settings.compile_settings(conf))
+        s2 = store.setup(settings.compile_settings(conf))
+        self.assertIsInstance(s1, store.SignedStateStore)
+        self.assertEqual(s1.secret, s2.secret)
+        conf.state_store = {'backend': 'redis'}
+        self.assertRaises(settings.ConfigurationError,
+                          settings.compile_settings, conf)
+        store.setup(settings.compile_settings(dummy_conf()))
+
+
+class TestStateMapping(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///%s' % tempfile.mkstemp()[1])
+        db.Session.remove()
+        db.Session.configure(bind=self.engine)
+        db.Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        db.Session.remove()
+
+    def test_get_url(self):
+        state = db.put_url('/r/')
+        self.assertEqual('/r/', db.get_url(state))
+        self.assertEqual(None, db.get_url(state))
+        self.assertEqual(None, db.get_url('unknown'))
+        state = db.put_url('/r/')
+        later = time.time() + 11
+        with patch('time.time') as t:
+            t.return_value = later
+            self.assertEqual(None, db.get_url(state, ttl=10))
+        self.assertEqual(0, db.Session.query(db.state_mapping).count())
+
+    def test_sweep(self):
+        for i in range(7):
+            db.put_url('/r/%d' % i)
+        later = time.time() + 11
+        with patch('time.time') as t:
+            t.return_value = later
+            fresh = db.put_url('/r/')
+            session = db.Session.session_factory()
+            self.assertEqual(7, db.sweep(session, ttl=10, batch_size=3))
+            session.close()
+        self.assertEqual('/r/', db.get_url(fresh))
+
+    def test_upgrade(self):
+        engine = create_engine('sqlite:///%s' % tempfile.mkstemp()[1])
+        engine.execute('CREATE TABLE state_mapping ('
+                       '"index" INTEGER NOT NULL, state VARCHAR(16), '
+                       'url VARCHAR, PRIMARY KEY ("index"))')
+        db.upgrade(engine)
+        db.Base.metadata.create_all(engine)
+        columns = [c['name'] for c in
+                   sqlalchemy.inspect(engine).get_columns('state_mapping')]
+        self.assertIn('created_at', columns)
+
+
 class TestUserDetails(TestCase):
     @classmethod
     def setupClass(cls):
         cls.conf = dummy_conf()
+        cls.settings = settings.compile_settings(cls.conf)
 
     @classmethod
     def tearDownClass(cls):
@@ -171,31 +472,82 @@ class TestUserDetails(TestCase):
 
     def gerrit_add_sshkeys_mock(self, *args, **kwargs):
         self.assertIn('data', kwargs)
-        self.assertIn('auth', kwargs)
+        self.assertIn('timeout', kwargs)
         self.key_amount_added += 1
+        return FakeResponse(201)
 
     def gerrit_get_account_id_mock(self, *args, **kwargs):
         data = json.dumps({'_account_id': 42})
-        # Simulate the garbage that occurs in live tests
-        data = 'garb' + data
+        # Gerrit prefixes its JSON responses against XSSI
+        data = ")]}'\n" + data
         return FakeResponse(200, data)
 
     def gerrit_get_account_id_mock2(self, *args, **kwargs):
         data = json.dumps({})
-        # Simulate the garbage that occurs in live tests
-        data = 'garb' + data
+        # Gerrit prefixes its JSON responses against XSSI
+        data = ")]}'\n" + data
         return FakeResponse(200, data)
 
+    def gerrit(self):
+        ger = Gerrit(self.settings, clients.ClientRegistry(self.settings))
+        ger.http = Mock()
+        return ger
+
     def test_gerrit_install_ssh_keys(self):
-        ger = Gerrit(self.conf)
+        ger = self.gerrit()
         self.key_amount_added = 0
         keys = [{'key': 'k1'}, {'key': 'k2'}]
-        with patch('cauth.utils.userdetails.requests') as r:
-            r.post = self.gerrit_add_sshkeys_mock
-            ger.install_sshkeys('john', keys)
+        ger.http.post = self.gerrit_add_sshkeys_mock
+        ger.install_sshkeys('john', keys)
         self.assertEqual(self.key_amount_added, len(keys))
 
+    def test_gerrit_sync_ssh_keys(self):
+        k1 = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC1 john@laptop'
+        k2 = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC2 john@desktop'
+        k3 = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQC3 old'
+        self.assertEqual(userdetails.key_fingerprint(k1),
+                         userdetails.key_fingerprint(
+                             '  ssh-rsa  AAAAB3NzaC1yc2EAAAADAQABAAAAgQC1'))
+        existing = ")]}'\n" + json.dumps([
+            {'seq': 1, 'ssh_public_key': 'ssh-rsa '
+             'AAAAB3NzaC1yc2EAAAADAQABAAAAgQC1 other-comment'},
+            {'seq': 2, 'ssh_public_key': k3}])
+        uploaded = []
+        deleted = []
+        ger = self.gerrit()
+        ger.http.get = lambda *args, **kwargs: FakeResponse(200, existing)
+
+        def post(url, data, timeout):
+            uploaded.append(data)
+            return FakeResponse(201)
+
+        def delete(url, timeout):
+            deleted.append(url)
+            return FakeResponse(204)
+        ger.http.post = post
+        ger.http.delete = delete
+        ger.install_sshkeys('john', [{'key': k1}, {'key': k2}])
+        self.assertEqual([k2], uploaded)
+        self.assertEqual([], deleted)
+        ger.delete_removed_sshkeys = True
+        ger.install_sshkeys('john', [{'key': k1}, {'key': k2}])
+        self.assertEqual([k2, k2], uploaded)
+        self.assertEqual(['%s/john/sshkeys/2' % ger.gerrit_url], deleted)
+
+    def test_gerrit_ssh_keys_failure(self):
+        ger = self.gerrit()
+        ger.http.get.return_value = FakeResponse(200, ")]}'\n[]")
+        ger.http.post.return_value = FakeResponse(500, 'Internal error')
+        self.assertRaises(Exception, ger.install_sshkeys, 'john',
+                          [{'key': 'k1'}, {'key': 'k2'}])
+        # the keys of an account are uploaded one after the other
+        self.assertEqual(1, ger.http.post.call_count)
+        ger.http.post.return_value = FakeResponse(201)
+        ger.install_sshkeys('john', [{'key': 'k1'}])
+
     def test_gerrit_add_in_acc_external(self):
+        external_ids = set()
+
         class FakeDB():
             def __init__(self, success=True):
                 self.success = success
@@ -206,38 +558,924 @@ class TestUserDetails(TestCase):
             def commit(self):
                 pass
 
+            def close(self):
+                pass
+
         class FakeCursor():
             def __init__(self, success):
                 self.success = success
+                self.rowcount = -1
 
-            def execute(self, sql):
+            def execute(self, sql, params):
                 if not self.success:
                     raise Exception
+                self.assertIn('ON DUPLICATE KEY', sql)
+                self.rowcount = 0 if params in external_ids else 1
+                external_ids.add(params)
+
+            def close(self):
+                pass
+        FakeCursor.assertIn = self.assertIn
 
-        ger = Gerrit(self.conf)
-        with patch('cauth.utils.userdetails.MySQLdb') as m:
-            m.connect = lambda *args, **kwargs: FakeDB()
+        ger = self.gerrit()
+        with patch('MySQLdb.connect') as connect:
+            connect.side_effect = lambda *args, **kwargs: FakeDB()
             ret = ger.add_in_acc_external(42, 'john')
-        self.assertEqual(True, ret)
-        with patch('cauth.utils.userdetails.MySQLdb') as m:
-            m.connect = lambda *args, **kwargs: FakeDB(False)
+            self.assertEqual(True, ret)
+            self.assertEqual(set([(42, 'gerrit:john')]), external_ids)
+            # the row exists, the connection is reused
+            connect.side_effect = lambda *args, **kwargs: FakeDB(False)
             ret = ger.add_in_acc_external(42, 'john')
-        self.assertEqual(False, ret)
+            self.assertEqual(False, ret)
+            self.assertEqual(1, len(ger.db_pool.idle))
+        ger = self.gerrit()
+        with patch('MySQLdb.connect') as connect:
+            connect.side_effect = lambda *args, **kwargs: FakeDB(False)
+            self.assertRaises(Exception, ger.add_in_acc_external,
+                              43, 'jane')
+        # the failing connection is not returned to the pool
+        self.assertEqual(0, len(ger.db_pool.idle))
+        self.assertEqual(0, ger.db_pool.in_use)
 
     def test_create_gerrit_user(self):
-        ger = Gerrit(self.conf)
-        with patch('cauth.utils.userdetails.requests') as r:
-            r.put = lambda *args, **kwargs: None
-            r.get = self.gerrit_get_account_id_mock
-            ger.add_in_acc_external = Mock()
-            ger.create_gerrit_user('john', 'john@tests.dom', 'John Doe', [])
-            self.assertEqual(True, ger.add_in_acc_external.called)
-        with patch('cauth.utils.userdetails.requests') as r:
-            r.put = lambda *args, **kwargs: None
-            r.get = self.gerrit_get_account_id_mock2
-            ger.add_in_acc_external = Mock()
-            ger.create_gerrit_user('john', 'john@tests.dom', 'John Doe', [])
-            self.assertEqual(False, ger.add_in_acc_external.called)
+        ger = self.gerrit()
+        ger.http.put.return_value = FakeResponse(409, 'Conflict')
+        ger.http.get = self.gerrit_get_account_id_mock
+        ger.add_in_acc_external = Mock()
+        ger.create_gerrit_user('john', 'john@tests.dom', 'John Doe', [])
+        self.assertEqual(True, ger.add_in_acc_external.called)
+        self.assertEqual(ger.timeout, ger.http.put.call_args[1]['timeout'])
+        # the step fails, to be replayed, when the database does
+        ger.add_in_acc_external.side_effect = Exception('MySQL is down')
+        self.assertRaises(Exception, ger.create_gerrit_user,
+                          'john', 'john@tests.dom', 'John Doe', [])
+        ger = self.gerrit()
+        ger.http.put.return_value = FakeResponse(409, 'Conflict')
+        ger.http.get = self.gerrit_get_account_id_mock2
+        ger.add_in_acc_external = Mock()
+        ger.create_gerrit_user('john', 'john@tests.dom', 'John Doe', [])
+        self.assertEqual(False, ger.add_in_acc_external.called)
+
+    def test_create_gerrit_account(self):
+        ger = self.gerrit()
+        ger.http.put.return_value = self.gerrit_get_account_id_mock()
+        ger.http.put.return_value.status_code = 201
+        self.assertEqual(42, ger.create_account('john', 'john@tests.dom',
+                                                'John Doe'))
+        self.assertFalse(ger.http.get.called)
+        # the returning users are known
+        ger.http.reset_mock()
+        self.assertEqual(42, ger.create_account('john', 'john@tests.dom',
+                                                'John Doe'))
+        self.assertFalse(ger.http.put.called)
+        # the account is only read when it already exists
+        ger.http.put.return_value = FakeResponse(409, 'Conflict')
+        ger.http.get = Mock(side_effect=self.gerrit_get_account_id_mock)
+        self.assertEqual(42, ger.create_account('jane', 'jane@tests.dom',
+                                                'Jane Doe'))
+        self.assertEqual(1, ger.http.get.call_count)
+
+    def test_lru_cache(self):
+        cache = clients.LRUCache(2)
+        cache.put('john', 1)
+        cache.put('jane', 2)
+        self.assertEqual(1, cache.get('john'))
+        cache.put('alice', 3)
+        self.assertEqual(None, cache.get('jane'))
+        self.assertEqual(1, cache.get('john'))
+        self.assertEqual(3, cache.get('alice'))
+
+    def test_redmine_create_user(self):
+        registry = clients.ClientRegistry(self.settings)
+        self.assertEqual(self.settings.redmine.apikey,
+                         registry.redmine.headers['X-Redmine-API-Key'])
+        redmine = userdetails.Redmine(self.settings, registry)
+        redmine.http = Mock()
+        redmine.http.post.return_value = FakeResponse(201)
+        redmine.create_user('john', 'john@tests.dom', 'John Doe')
+        url, = redmine.http.post.call_args[0]
+        self.assertTrue(url.endswith('/users.json'))
+        user = json.loads(redmine.http.post.call_args[1]['data'])['user']
+        self.assertEqual('john', user['login'])
+        self.assertEqual('john@tests.dom', user['mail'])
+        redmine.http.post.return_value = FakeResponse(422, 'exists')
+        self.assertFalse(redmine.create_user('john', 'john@tests.dom',
+                                             'John Doe'))
+        redmine.http.post.return_value = FakeResponse(503, 'down')
+        self.assertRaises(Exception, redmine.create_user,
+                          'john', 'john@tests.dom', 'John Doe')
+
+    def test_provision_concurrently(self):
+        gerrit_started = threading.Event()
+
+        def create_redmine_user(username, email, lastname, keys):
+            # only returns if gerrit runs at the same time
+            if not gerrit_started.wait(5):
+                raise Exception('gerrit did not start')
+            return True
+
+        def create_gerrit_user(username, email, lastname, keys):
+            gerrit_started.set()
+            return True
+
+        steps = [('redmine', create_redmine_user),
+                 ('gerrit', create_gerrit_user)]
+        udc = userdetails.UserDetailsCreator(
+            steps, clients.ClientRegistry(self.settings))
+        results = udc.provision('john', 'john@tests.dom', 'John Doe', [])
+        self.assertIsNone(results['redmine'].error)
+        self.assertEqual(True, results['gerrit'].result)
+        self.assertLess(results['redmine'].duration, 5)
+        self.assertTrue(udc.create_user('john', 'john@tests.dom',
+                                        'John Doe', []))
+        steps[1] = ('gerrit', Mock(side_effect=Exception('down')))
+        gerrit_started.set()
+        self.assertFalse(udc.create_user('john', 'john@tests.dom',
+                                         'John Doe', []))
+
+    def test_gerrit_step_on_branch_pool(self):
+        registry = clients.ClientRegistry(self.settings)
+        ger = userdetails.Gerrit(self.settings, registry)
+        # the gerrit steps of concurrent logins fill the branch pool
+        lock = threading.Lock()
+        entered = []
+        all_entered = threading.Event()
+
+        def create_account(username, email, lastname):
+            with lock:
+                entered.append(username)
+                if len(entered) == registry.branch_workers:
+                    all_entered.set()
+            all_entered.wait(5)
+            return 42
+
+        ger.create_account = create_account
+        ger.add_in_acc_external = Mock(return_value=True)
+        udc = userdetails.UserDetailsCreator(
+            [('gerrit', ger.create_gerrit_user),
+             ('custom', lambda *args: True)], registry)
+        results = []
+        logins = [threading.Thread(target=lambda i=i: results.append(
+            udc.create_user('user%d' % i, 'mail', 'User', [])))
+            for i in range(registry.branch_workers)]
+        for login in logins:
+            login.daemon = True
+            login.start()
+        for login in logins:
+            login.join(5)
+        self.assertEqual([True] * registry.branch_workers, results)
+        registry.close()
+
+    def test_client_registry(self):
+        self.assertIs(clients.setup(self.settings), clients.get())
+        registry = clients.get()
+        adapter = registry.gerrit.get_adapter('http://gerrit.url')
+        self.assertEqual(self.settings.gerrit.http_pool_size,
+                         adapter._pool_maxsize)
+        self.assertEqual(('admin', 'wxcvbn'), registry.gerrit.auth)
+        self.assertIs(registry.sshkeys_pool, registry.sshkeys_pool)
+        clients.setup(self.settings)
+        self.assertIsNot(registry, clients.get())
+        self.assertEqual({}, registry.pools)
+
+
+class TestBulkProvisioning(TestCase):
+    def setUp(self):
+        self.settings = settings.compile_settings(dummy_conf())
+        self.tmp = tempfile.mkdtemp()
+        self.accounts = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def provisioner(self, **kwargs):
+        provisioner = bulkprovision.BulkProvisioner(
+            self.settings, clients.ClientRegistry(self.settings),
+            out=open(os.devnull, 'w'), **kwargs)
+        provisioner.redmine = Mock()
+        provisioner.gerrit = Mock()
+        provisioner.gerrit.create_account = \
+            lambda username, email, lastname: \
+            None if username == 'bad' else len(username)
+        provisioner.gerrit.add_in_acc_external_many = \
+            lambda accounts: self.accounts.extend(accounts) or True
+        return provisioner
+
+    def test_read_users(self):
+        path = self.write('users.csv', 'username,email,lastname,key\n'
+                          'john,john@tests.dom,John Doe,ssh-rsa AAAA\n'
+                          'jane,jane@tests.dom,Jane Doe,\n')
+        self.assertEqual(
+            [('john', 'john@tests.dom', 'John Doe', [{'key': 'ssh-rsa AAAA'}]),
+             ('jane', 'jane@tests.dom', 'Jane Doe', [])],
+            bulkprovision.read_csv(path))
+        path = self.write('users.json', json.dumps(
+            [{'username': 'john', 'email': 'john@tests.dom',
+              'keys': ['ssh-rsa AAAA']}]))
+        self.assertEqual(
+            [('john', 'john@tests.dom', None, [{'key': 'ssh-rsa AAAA'}])],
+            bulkprovision.read_json(path))
+        self.assertEqual([('user1', 'user1@tests.dom', 'Demo user1', [])],
+                         bulkprovision.static_users(self.settings))
+
+    def test_run(self):
+        users = [(name, '%s@tests.dom' % name, name, [{'key': 'k'}])
+                 for name in ('john', 'bad', 'jane', 'alice', 'bob')]
+        state = os.path.join(self.tmp, 'state')
+        provisioner = self.provisioner(batch_size=2, state_path=state)
+        self.assertEqual((4, 1), provisioner.run(users))
+        self.assertEqual([(4, 'john'), (4, 'jane'), (5, 'alice'), (3, 'bob')],
+                         self.accounts)
+        self.assertEqual(4, provisioner.gerrit.install_sshkeys.call_count)
+        # a new run only retries the failed user
+        provisioner = self.provisioner(batch_size=2, state_path=state)
+        self.assertEqual((0, 1), provisioner.run(users))
+        self.assertEqual(4, len(self.accounts))
+
+    def test_index_and_defaults(self):
+        index = Mock()
+        provisioner = self.provisioner(index=index)
+        provisioner.gerrit.install_sshkeys.side_effect = \
+            lambda username, keys: username != 'jane' or 1 / 0
+        users = [('john', None, None, []),
+                 ('jane', None, None, [{'key': 'k'}])]
+        self.assertEqual((1, 1), provisioner.run(users))
+        provisioner.redmine.create_user.assert_any_call(
+            'john', 'john@tests.dom', 'User john')
+        # the first login of john does not provision him again
+        index.put.assert_called_once_with('john', provisioning.fingerprint(
+            'john@tests.dom', 'User john', []))
+        # a Redmine failure is retried by the next run
+        index.reset_mock()
+        provisioner.redmine.create_user.side_effect = Exception('503')
+        self.assertEqual((0, 1), provisioner.run([('alice', None, None, [])]))
+        self.assertFalse(index.put.called)
+
+    def test_failed_batch(self):
+        provisioner = self.provisioner(state_path=os.path.join(self.tmp, 's'))
+        provisioner.gerrit.add_in_acc_external_many = lambda accounts: False
+        self.assertEqual((0, 1), provisioner.run([('john', None, None, [])]))
+        self.assertEqual(set(), provisioner.done())
+
+
+class TestOutbox(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite:///%s' % tempfile.mkstemp()[1])
+        db.Session.remove()
+        db.Session.configure(bind=self.engine)
+        db.Base.metadata.create_all(self.engine)
+        self.calls = []
+        self.completed = []
+        self.failures = {'gerrit': 2}
+
+    def tearDown(self):
+        db.Session.remove()
+
+    def step(self, name):
+        def replay(username, email, lastname, keys):
+            self.calls.append((name, username, email))
+            if self.failures.get(name):
+                self.failures[name] -= 1
+                raise Exception('%s is down' % name)
+            return True
+        return replay
+
+    def outbox(self, **kwargs):
+        return outbox.Outbox(
+            {'redmine': self.step('redmine'), 'gerrit': self.step('gerrit')},
+            on_complete=lambda *details: self.completed.append(details),
+            backoff=10, **kwargs)
+
+    def replay_at(self, ob, delay):
+        later = time.time() + delay
+        with patch('time.time') as t:
+            t.return_value = later
+            return ob.replay()
+
+    def test_replay_with_backoff(self):
+        ob = self.outbox()
+        ob.record('gerrit', 'john', 'john@tests.dom', 'John', [], 'down')
+        ob.record('redmine', 'john', 'john@tests.dom', 'John', [], 'down')
+        # the same failure is only recorded once
+        ob.record('gerrit', 'john', 'john@tests.dom', 'John', [], 'down')
+        self.assertEqual({'waiting': 2, 'due': 0, 'given_up': 0}, ob.stats())
+        self.assertEqual(0, ob.replay())
+        # first retry after 10s, gerrit fails again
+        self.assertEqual(2, self.replay_at(ob, 11))
+        self.assertEqual([], self.completed)
+        # the next gerrit retry is 20s later
+        self.assertEqual(0, self.replay_at(ob, 25))
+        self.assertEqual(1, self.replay_at(ob, 32))
+        # gerrit fails a last time, then succeeds
+        self.assertEqual(1, self.replay_at(ob, 72))
+        self.assertEqual([('john', 'john@tests.dom', 'John', [])],
+                         self.completed)
+        self.assertEqual({'waiting': 0, 'due': 0, 'given_up': 0}, ob.stats())
+
+    def test_give_up(self):
+        ob = self.outbox(max_attempts=2)
+        ob.record('gerrit', 'john', 'john@tests.dom', 'John', [], 'down')
+        self.replay_at(ob, 11)
+        self.assertEqual({'waiting': 0, 'due': 0, 'given_up': 1}, ob.stats())
+        self.assertEqual(0, self.replay_at(ob, 10000))
+        # a new failure of the same step schedules it again
+        ob.record('gerrit', 'john', 'john@tests.dom', 'John', [], 'down')
+        self.assertEqual(1, ob.stats()['waiting'])
+
+    def test_supersede(self):
+        ob = self.outbox()
+        self.failures = {}
+        ob.record('gerrit', 'john', 'john@tests.dom', 'John', [], 'down')
+        ob.record('gerrit', 'john', 'john@new.dom', 'John', [], 'down')
+        self.assertEqual(1, self.replay_at(ob, 11))
+        self.assertEqual([('gerrit', 'john', 'john@new.dom')], self.calls)
+
+    def test_claim(self):
+        ob = self.outbox()
+        ob.record('redmine', 'john', 'john@tests.dom', 'John', [], 'down')
+        later = int(time.time()) + 11
+        self.assertEqual(1, len(db.claim_steps(later, 300, 10)))
+        # claimed by another worker
+        self.assertEqual(0, len(db.claim_steps(later, 300, 10)))
+
+    def test_record_failed_steps(self):
+        current = settings.compile_settings(dummy_conf())
+        steps = [('redmine', Mock(return_value=True)),
+                 ('gerrit', Mock(side_effect=Exception('down')))]
+        udc = userdetails.UserDetailsCreator(
+            steps, clients.ClientRegistry(current), outbox=self.outbox())
+        self.assertFalse(udc.create_user('john', 'john@tests.dom',
+                                         'John', []))
+        # only the failed step is replayed
+        steps = db.Session.query(db.provisioning_step.step).all()
+        self.assertEqual([('gerrit', )], steps)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.registered = list(metrics.REGISTRY)
+        self.counter = metrics.Counter('test_total', 'Tests', ('result', ))
+        self.histogram = metrics.Histogram('test_seconds', 'Durations',
+                                           buckets=(.1, 1))
+        self.gauge = metrics.Gauge('test_shared', 'Shared', lambda: 7,
+                                   shared=True)
+
+    def tearDown(self):
+        metrics.setup(settings.MetricsSettings(directory=None,
+                                               flush_interval=5))
+        metrics.REGISTRY[:] = self.registered
+        shutil.rmtree(self.tmp)
+
+    def test_render(self):
+        self.counter.inc('ok')
+        self.counter.inc('ok', amount=2)
+        self.counter.inc('ko')
+        for value in (.05, .5, .5, 3):
+            self.histogram.observe(value)
+        text = metrics.collect()
+        self.assertIn('test_total{result="ok"} 3\n', text)
+        self.assertIn('test_total{result="ko"} 1\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1\n'
+                      'test_seconds_bucket{le="1"} 3\n'
+                      'test_seconds_bucket{le="+Inf"} 4\n'
+                      'test_seconds_sum 4.05\n'
+                      'test_seconds_count 4\n', text)
+        self.assertIn('# TYPE test_shared gauge\ntest_shared 7\n', text)
+
+    def test_aggregate_processes(self):
+        metrics.setup(settings.MetricsSettings(directory=self.tmp,
+                                               flush_interval=3600))
+        self.counter.inc('ok')
+        self.histogram.observe(.5)
+        # another worker process
+        other = metrics.snapshot()
+        with open(os.path.join(self.tmp, '1.json'), 'w') as f:
+            json.dump(other, f)
+        text = metrics.collect()
+        self.assertIn('test_total{result="ok"} 2\n', text)
+        self.assertIn('test_seconds_count 2\n', text)
+        # shared gauges are not added up
+        self.assertIn('test_shared 7\n', text)
+        metrics.flush()
+        self.assertIn('%d.json' % os.getpid(), os.listdir(self.tmp))
+
+    def test_exited_processes(self):
+        metrics.setup(settings.MetricsSettings(directory=self.tmp,
+                                               flush_interval=3600))
+        metrics.Gauge('test_queued', 'Test gauge', lambda: 3)
+        self.counter.inc('ok')
+        # a worker process which exited
+        worker = subprocess.Popen(['true'])
+        worker.wait()
+        path = os.path.join(self.tmp, '%d.json' % worker.pid)
+        with open(path, 'w') as f:
+            json.dump(metrics.snapshot(), f)
+        text = metrics.collect()
+        self.assertFalse(os.path.exists(path))
+        # its counters are kept, not its gauges
+        self.assertIn('test_total{result="ok"} 2\n', text)
+        self.assertIn('test_queued 3\n', text)
+        self.assertEqual(text, metrics.collect())
+        # the values of the process are archived when it exits
+        metrics.shutdown()
+        self.assertEqual(['archive.json'], [
+            name for name in os.listdir(self.tmp) if name.endswith('.json')])
+
+
+class TestTimingHook(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.state = Mock()
+        self.state.request.method = 'POST'
+        self.state.request.path = '/auth/login'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_spans(self):
+        # nothing is recorded outside of a request
+        with tracing.span('credentials'):
+            pass
+        self.assertIsNone(tracing.current())
+        path = os.path.join(self.tmp, 'trace.json')
+        hook = hooks.TimingHook(slow_request=1, trace_file=path)
+        for i in range(2):
+            hook.on_route(self.state)
+            tracing.current().start -= 2
+            with tracing.span('credentials'):
+                tracing.record('gerrit', time.time(), 0.5)
+            with patch('cauth.hooks.logger') as logger:
+                hook.after(self.state)
+            args = logger.warning.call_args[0]
+            message = args[0] % args[1:]
+            self.assertIn('Slow request POST /auth/login', message)
+            self.assertIn('gerrit 0.500s, credentials', message)
+        self.assertIsNone(tracing.current())
+        with open(path) as f:
+            content = f.read()
+        self.assertTrue(content.startswith('[\n'))
+        events = json.loads(content.rstrip(',\n') + ']')
+        self.assertEqual(['POST /auth/login', 'gerrit', 'credentials'] * 2,
+                         [e['name'] for e in events])
+        self.assertEqual(500000, events[1]['dur'])
+        self.assertEqual(['X'], list(set(e['ph'] for e in events)))
+
+    def test_fast_request(self):
+        hook = hooks.TimingHook(slow_request=10)
+        hook.on_route(self.state)
+        with patch('cauth.hooks.logger') as logger:
+            hook.after(self.state)
+        self.assertFalse(logger.warning.called)
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler(self.tmp, rate=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def busy(self, started, done):
+        self.profiler.track('/auth/login')
+        started.set()
+        while not done.is_set():
+            sum(range(100))
+        self.profiler.untrack()
+
+    def test_sample(self):
+        # disabled, the requests are not tracked
+        self.profiler.track('/auth/login')
+        self.assertEqual({}, self.profiler.tracked)
+        self.profiler.enable()
+        # the other processes see the control file
+        other = profiling.Profiler(self.tmp)
+        other.refresh()
+        self.assertTrue(other.enabled)
+        started = threading.Event()
+        done = threading.Event()
+        worker = threading.Thread(target=self.busy, args=(started, done))
+        worker.start()
+        started.wait(5)
+        for i in range(5):
+            self.profiler.sample()
+        done.set()
+        worker.join()
+        self.assertEqual({}, self.profiler.tracked)
+        self.profiler.disable()
+        self.assertFalse(self.profiler.enabled)
+        # the stacks are written when the profiling is disabled
+        path = os.path.join(self.tmp, 'auth_login.%d.folded' % os.getpid())
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(5, sum(int(line.rsplit(' ', 1)[1])
+                                for line in lines))
+        self.assertTrue(all('test_units.py:busy' in line for line in lines))
+
+    def test_rate(self):
+        self.profiler.enable(rate=0.5)
+        with patch('random.random') as r:
+            r.return_value = 0.7
+            self.profiler.track('/auth/login')
+            self.assertEqual({}, self.profiler.tracked)
+            r.return_value = 0.2
+            self.profiler.track('/auth/login')
+            self.assertEqual(1, len(self.profiler.tracked))
+
+    def test_hook(self):
+        self.profiler.enable()
+        hook = hooks.ProfilingHook()
+        state = Mock()
+        state.controller = root.RootController().ready
+        with patch('cauth.utils.profiling._profiler', self.profiler):
+            hook.before(state)
+            self.assertEqual(['RootController.ready'],
+                             self.profiler.tracked.values())
+            # a controller raising is not sampled anymore
+            hook.on_error(state, Exception())
+            self.assertEqual({}, self.profiler.tracked)
+
+
+class TestLogs(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.logger = logging.getLogger('cauth.tests.logs')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.handlers = []
+        shutil.rmtree(self.tmp)
+
+    def test_async_file_handler(self):
+        path = os.path.join(self.tmp, 'cauth.log')
+        handler = logs.AsyncRotatingFileHandler(path)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger.addHandler(handler)
+        args = ['user1']
+        self.logger.error('Unable to provision %s', args)
+        # the record is rendered before it is queued
+        args.append('user2')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('Failure')
+        handler.close()
+        self.assertFalse(handler.listener.is_alive())
+        lines = open(path).read().splitlines()
+        self.assertEqual("ERROR Unable to provision ['user1']", lines[0])
+        self.assertEqual('ERROR Failure', lines[1])
+        self.assertIn('ValueError: boom', lines[-1])
+
+    def test_full_queue(self):
+        handler = logs.QueueHandler(Queue.Queue(1))
+        self.logger.addHandler(handler)
+        dropped = logs.DROPPED.values.get((), 0)
+        self.logger.error('first')
+        self.logger.error('second')
+        self.assertEqual('first', handler.queue.get().msg)
+        self.assertEqual(dropped + 1, logs.DROPPED.values[()])
+
+    def test_json_event(self):
+        handler = logging.StreamHandler(StringIO.StringIO())
+        handler.setFormatter(logs.JSONFormatter())
+        with patch.object(logs, 'EVENTS', self.logger):
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            logs.event('login', method='password', username='user1',
+                       result='failure', reason='wrong credentials')
+        event = json.loads(handler.stream.getvalue())
+        self.assertEqual('login', event['event'])
+        self.assertEqual('user1', event['username'])
+        self.assertEqual('wrong credentials', event['reason'])
+        self.assertEqual('INFO', event['level'])
+        self.assertEqual('login method=password reason=wrong credentials '
+                         'result=failure username=user1', event['message'])
+
+
+class TestLoginPage(TestCase):
+    def test_render_cache(self):
+        page = loginpage.LoginPage(os.path.join(os.path.dirname(__file__),
+                                                '../templates'))
+        body, etag = page.render('r/')
+        self.assertIn('value="r/"', body)
+        with patch.object(page.template, 'render') as render:
+            self.assertEqual((body, etag), page.render('r/'))
+            self.assertFalse(render.called)
+        failed, failed_etag = page.render('r/', 'Authorization failed.')
+        self.assertIn('Authorization failed.', failed)
+        self.assertNotEqual(etag, failed_etag)
+
+
+class TestHealth(TestCase):
+    def failing(self, timeout):
+        raise IOError('unreachable')
+
+    def test_readiness(self):
+        prober = health.Prober([('signing_key', lambda timeout: None),
+                                ('redmine', self.failing)],
+                               optional=['redmine'])
+        self.assertFalse(prober.ready())
+        prober.run_probes()
+        self.assertTrue(prober.ready())
+        self.assertEqual('IOError: unreachable',
+                         prober.results['redmine']['error'])
+        prober.probes.append(('ldap', self.failing))
+        prober.run_probes()
+        status = prober.status()
+        self.assertFalse(status['ready'])
+        self.assertTrue(status['checks']['signing_key']['ok'])
+        self.assertFalse(status['checks']['ldap']['ok'])
+
+    def test_probes(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        health.tcp_probe('ldap://127.0.0.1:%d' % port, 389, 1)
+        health.tcp_probe('127.0.0.1', port, 1)
+        server.close()
+        self.assertRaises(socket.error, health.tcp_probe,
+                          '127.0.0.1', port, 1)
+        session = Mock()
+        session.get.return_value = FakeResponse(401)
+        health.http_probe('http://gerrit', 1, session)
+        session.get.return_value = FakeResponse(503)
+        self.assertRaises(Exception, health.http_probe,
+                          'http://gerrit', 1, session)
+
+    def test_configured_probes(self):
+        conf = dummy_conf()
+        del conf.auth['localdb']
+        del conf.redmine
+        probes = health.get_probes(settings.compile_settings(conf), False)
+        self.assertEqual(['signing_key', 'ldap', 'gerrit', 'gerrit_db',
+                          'github'], [name for name, probe in probes])
+
+
+class TestRevocation(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'revoked')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bloom_filter(self):
+        bloom = revocation.BloomFilter(100, 0.01)
+        keys = [revocation.digest(str(i)) for i in range(100)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        others = [revocation.digest('other%d' % i) for i in range(1000)]
+        self.assertLess(sum(key in bloom for key in others), 50)
+
+    def test_revoke(self):
+        revoked = revocation.RevocationList()
+        revoked.revoke('ticket1', time.time() + 60)
+        revoked.revoke('ticket2', time.time() - 1)
+        self.assertTrue(revoked.revoked('ticket1'))
+        self.assertFalse(revoked.revoked('ticket2'))
+        self.assertFalse(revoked.revoked('ticket3'))
+        revoked.prune(time.time() + 120)
+        self.assertEqual(0, len(revoked))
+        self.assertFalse(revoked.revoked('ticket1'))
+
+    def test_shared(self):
+        worker1 = revocation.RevocationList(self.path, check_interval=0)
+        worker2 = revocation.RevocationList(self.path, check_interval=0)
+        self.assertFalse(worker2.revoked('ticket1'))
+        worker1.revoke('ticket1', time.time() + 60)
+        self.assertTrue(worker2.revoked('ticket1'))
+        with open(self.path, 'a') as f:
+            f.write('garbage\n%s %d\n' % (
+                revocation.digest('ticket2'), time.time() - 1))
+        worker1.compact(time.time())
+        self.assertEqual(1, len(open(self.path).readlines()))
+        worker2.revoke('ticket3', time.time() + 60)
+        self.assertTrue(worker1.revoked('ticket1'))
+        self.assertTrue(worker1.revoked('ticket3'))
+        self.assertEqual(2, len(revocation.RevocationList(self.path)))
+
+
+class TestMemoryTracker(TestCase):
+    def test_growth(self):
+        tracker = memory.MemoryTracker(max_snapshots=2)
+        self.assertNotIn('growth', tracker.report(keep=True))
+        sessions = [requests.Session() for i in range(3)]
+        report = tracker.report(keep=True)
+        growth = report['growth']
+        self.assertEqual(3, growth['connections']['requests.sessions.Session'])
+        self.assertIn(('requests.sessions.Session', 3), growth['types'])
+        self.assertGreaterEqual(
+            report['current']['connections']['requests.sessions.Session'], 3)
+        del sessions
+        tracker.report(keep=True)
+        self.assertEqual(2, len(tracker.snapshots))
+
+    def test_rss(self):
+        self.assertGreater(memory.rss(), 1024 * 1024)
+
+
+class TestProvisioningQueue(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def provision(self, username, email, lastname, keys):
+        self.release.wait(5)
+        self.calls.append((username, email))
+        return True
+
+    def test_synchronous_without_workers(self):
+        q = provisioning.ProvisioningQueue(self.provision, workers=0,
+                                           sync='never')
+        self.release.set()
+        q.submit('john', 'john@tests.dom', 'John', [])
+        self.assertEqual([('john', 'john@tests.dom')], self.calls)
+
+    def test_background_and_deduplication(self):
+        q = provisioning.ProvisioningQueue(self.provision, workers=1,
+                                           sync='never')
+        # the worker blocks on the first job, the others wait in the queue
+        q.submit('john', 'old@tests.dom', 'John', [])
+        q.submit('jane', 'jane@tests.dom', 'Jane', [])
+        q.submit('jane', 'new@tests.dom', 'Jane', [])
+        self.assertEqual([], self.calls)
+        self.release.set()
+        q.join()
+        self.assertEqual([('john', 'old@tests.dom'),
+                          ('jane', 'new@tests.dom')], self.calls)
+        self.assertTrue(q.is_provisioned('jane'))
+
+    def test_in_flight_deduplication(self):
+        q = provisioning.ProvisioningQueue(self.provision, workers=2,
+                                           sync='never')
+        q.submit('john', 'john@tests.dom', 'John', [])
+        while 'john' not in q.running:
+            time.sleep(0.01)
+        # the same details are being provisioned
+        q.submit('john', 'john@tests.dom', 'John', [])
+        self.assertEqual(0, q.queue.qsize())
+        # new details wait for the running provisioning
+        q.submit('john', 'new@tests.dom', 'John', [])
+        self.assertEqual(0, q.queue.qsize())
+        self.release.set()
+        q.join()
+        self.assertEqual([('john', 'john@tests.dom'),
+                          ('john', 'new@tests.dom')], self.calls)
+
+    def test_sync_first_time_users(self):
+        q = provisioning.ProvisioningQueue(self.provision, workers=1,
+                                           sync='first')
+        self.release.set()
+        q.submit('john', 'john@tests.dom', 'John', [])
+        # first login: provisioned before submit returns
+        self.assertEqual([('john', 'john@tests.dom')], self.calls)
+        self.release.clear()
+        q.submit('john', 'john@tests.dom', 'John', [])
+        self.assertEqual(1, len(self.calls))
+        self.release.set()
+        q.join()
+        self.assertEqual(2, len(self.calls))
+
+    def test_failure_is_not_provisioned(self):
+        def fail(*args):
+            raise Exception('Gerrit is down')
+        q = provisioning.ProvisioningQueue(fail, workers=0)
+        self.assertFalse(q.submit('john', 'john@tests.dom', 'John', []))
+        self.assertFalse(q.is_provisioned('john'))
+
+    def test_failing_index(self):
+        index = Mock()
+        index.get.side_effect = Exception('database is locked')
+        index.put.side_effect = Exception('database is locked')
+        self.release.set()
+        q = provisioning.ProvisioningQueue(self.provision, workers=1,
+                                           sync='first', index=index)
+        # the user is provisioned as if the index did not know him
+        self.assertTrue(q.submit('john', 'john@tests.dom', 'John', []))
+        self.assertEqual(1, len(self.calls))
+        q.sync = 'never'
+        q.submit('jane', 'jane@tests.dom', 'Jane', [])
+        q.join()
+        q.submit('alice', 'alice@tests.dom', 'Alice', [])
+        q.join()
+        self.assertEqual(3, len(self.calls))
+        self.assertTrue(q.workers[0].is_alive())
+
+    def test_fingerprint_index(self):
+        engine = create_engine('sqlite:///%s' % tempfile.mkstemp()[1])
+        db.Session.remove()
+        db.Session.configure(bind=engine)
+        db.Base.metadata.create_all(engine)
+        self.release.set()
+        keys = [{'key': 'k1'}, {'key': 'k2'}]
+        index = provisioning.FingerprintIndex()
+        q = provisioning.ProvisioningQueue(self.provision, index=index)
+        q.submit('john', 'john@tests.dom', 'John', keys)
+        self.assertTrue(q.is_provisioned('john'))
+        # a returning user with the same details is not provisioned again,
+        # even by another process
+        q = provisioning.ProvisioningQueue(
+            self.provision, index=provisioning.FingerprintIndex())
+        q.submit('john', 'john@tests.dom', 'John', list(reversed(keys)))
+        self.assertEqual(1, len(self.calls))
+        q.submit('john', 'john@tests.dom', 'John', [{'key': 'k3'}])
+        self.assertEqual(2, len(self.calls))
+        q.submit('john', 'john@tests.dom', 'John Doe', [{'key': 'k3'}])
+        self.assertEqual(3, len(self.calls))
+        self.assertFalse(q.is_provisioned('jane'))
+        # the first process sees the details provisioned by the other one
+        q = provisioning.ProvisioningQueue(self.provision, index=index)
+        q.submit('john', 'john@tests.dom', 'John', keys)
+        self.assertEqual(4, len(self.calls))
+
+
+class TestConnectionPool(TestCase):
+    class FakeConnection(object):
+        def __init__(self):
+            self.closed = False
+            self.alive = True
+
+        def ping(self):
+            if not self.alive:
+                raise Exception('MySQL server has gone away')
+
+        def close(self):
+            self.closed = True
+
+    def test_reuse_and_bound(self):
+        p = pool.ConnectionPool(self.FakeConnection, size=2, timeout=0.1)
+        with p.connection() as c1:
+            with p.connection() as c2:
+                self.assertIsNot(c1, c2)
+                self.assertRaises(pool.PoolTimeout, p.acquire)
+        with p.connection() as c3:
+            self.assertIn(c3, (c1, c2))
+        self.assertEqual(2, len(p.idle))
+
+    def test_discard_on_error(self):
+        p = pool.ConnectionPool(self.FakeConnection)
+        try:
+            with p.connection() as c:
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(c.closed)
+        self.assertEqual(([], 0), (p.idle, p.in_use))
+
+    def test_health_checks(self):
+        p = pool.ConnectionPool(self.FakeConnection, recycle=60,
+                                ping_after=10)
+        with p.connection() as c1:
+            pass
+        c1.alive = False
+        later = time.time() + 11
+        with patch('time.time') as t:
+            t.return_value = later
+            with p.connection() as c2:
+                pass
+        self.assertTrue(c1.closed)
+        later = time.time() + 80
+        with patch('time.time') as t:
+            t.return_value = later
+            with p.connection() as c3:
+                pass
+        self.assertTrue(c2.closed)
+        self.assertFalse(c3.closed)
+        p.dispose()
+        self.assertTrue(c3.closed)
+
+    def test_ping_out_of_lock(self):
+        p = pool.ConnectionPool(self.FakeConnection, ping_after=0)
+        with p.connection() as c1:
+            with p.connection() as c2:
+                pass
+        pinging = threading.Event()
+        answer = threading.Event()
+
+        def slow_ping():
+            pinging.set()
+            answer.wait(5)
+        # the last connection released is the first reused
+        c1.ping = slow_ping
+        borrower = threading.Thread(target=lambda: p.connection().__enter__())
+        borrower.start()
+        self.assertTrue(pinging.wait(5))
+        # the other borrowers do not wait for the ping
+        start = time.time()
+        with p.connection() as c:
+            self.assertIs(c2, c)
+        self.assertLess(time.time() - start, 1)
+        answer.set()
+        borrower.join()
 
 
 class TestControllerRoot(TestCase):
@@ -245,7 +1483,7 @@ class TestControllerRoot(TestCase):
     def setupClass(cls):
         cls.conf = dummy_conf()
         gen_rsa_key()
-        root.conf = cls.conf
+        settings.load(cls.conf)
 
     @classmethod
     def tearDownClass(cls):
@@ -264,6 +1502,25 @@ class TestControllerRoot(TestCase):
                 'User john',
                 None)
 
+    def test_signing_key(self):
+        with patch('M2Crypto.RSA.load_key') as load_key:
+            common.setup(settings.get().app)
+            self.assertIs(load_key.return_value, common.signing_key())
+            self.assertIs(load_key.return_value, common.signing_key())
+            self.assertEqual(1, load_key.call_count)
+        common.setup(settings.get().app)
+
+    def test_parse_ticket(self):
+        validuntil = int(time.time()) + 60
+        ticket = common.create_ticket(uid='john', validuntil=validuntil)
+        self.assertEqual({'uid': 'john', 'validuntil': validuntil},
+                         common.parse_ticket(ticket))
+        self.assertIsNone(common.parse_ticket(ticket.replace('john', 'jane')))
+        self.assertIsNone(common.parse_ticket(ticket[:-8]))
+        self.assertIsNone(common.parse_ticket('uid=john'))
+        self.assertIsNone(common.parse_ticket(ticket,
+                                              now=validuntil + 1))
+
     def test_create_ticket(self):
         with patch('cauth.utils.common.signature') as sign:
             sign.return_value = '123'
@@ -275,18 +1532,18 @@ class TestLoginController(TestCase):
     @classmethod
     def setupClass(cls):
         cls.conf = dummy_conf()
-        root.conf = cls.conf
+        cls.settings = settings.compile_settings(cls.conf)
 
     @classmethod
     def tearDownClass(cls):
         pass
 
     def test_check_valid_user(self):
-        ret = auth.check_static_user(self.conf, 'user1', 'userpass')
+        ret = auth.check_static_user(self.settings, 'user1', 'userpass')
         self.assertIn('user1@tests.dom', ret)
         self.assertIn('Demo user1', ret)
         with patch('requests.get'):
-            ret = auth.check_static_user(self.conf, 'user1', 'badpass')
+            ret = auth.check_static_user(self.settings, 'user1', 'badpass')
             self.assertEqual(None, ret)
 
     def test_check_localdb_user(self):
@@ -296,13 +1553,13 @@ class TestLoginController(TestCase):
                          'email': 'les@primus.com',
                          'sshkey': 'Jerry was a race car driver'}
             g.return_value = FakeResponse(200, json.dumps(_response), True)
-            ret = auth.check_db_user(self.conf, 'les', 'Wynona')
+            ret = auth.check_db_user(self.settings, 'les', 'Wynona')
             self.assertIn('Les Claypool', ret)
             self.assertIn('les@primus.com', ret)
             self.assertIn([{'key': 'Jerry was a race car driver'}, ], ret)
         with patch('requests.get') as g:
             g.return_value = FakeResponse(401, 'Unauthorized')
-            ret = auth.check_db_user(self.conf, 'bootsy', 'collins')
+            ret = auth.check_db_user(self.settings, 'bootsy', 'collins')
             self.assertEqual(None, ret)
 
 
@@ -356,31 +1613,111 @@ def githubmock_request(url, request):
     return httmock.response(200, content, headers, None, 5, request)
 
 
+class LocalGithubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stands in for the GitHub REST and GraphQL APIs, only the token
+    'user7_token' is known."""
+    user = {'login': 'user7',
+            'email': 'user7@tests.dom',
+            'name': 'Demo user7',
+            'keys': ['ssh-rsa AAAA user7'],
+            'orgs': ['acme']}
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, content):
+        self.server.requests.append((self.command, self.path))
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        auth_header = self.headers.get('Authorization', '')
+        basic = 'Basic ' + base64.b64encode('user7_token:x-oauth-basic')
+        return auth_header in ('token user7_token', basic)
+
+    def do_GET(self):
+        if not self.authorized():
+            return self.reply(401, {'message': 'Bad credentials'})
+        u = self.user
+        if self.path == '/user':
+            content = {'login': u['login'], 'email': u['email'],
+                       'name': u['name']}
+        elif self.path.endswith('/keys'):
+            content = [{'key': k} for k in u['keys']]
+        elif self.path == '/user/orgs':
+            content = [{'login': o} for o in u['orgs']]
+        else:
+            return self.reply(404, {'message': 'Not Found'})
+        self.reply(200, content)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        query = json.loads(self.rfile.read(length))['query']
+        if self.path != '/graphql' or 'viewer' not in query:
+            return self.reply(404, {'message': 'Not Found'})
+        if not self.authorized():
+            return self.reply(401, {'message': 'Bad credentials'})
+        u = self.user
+        viewer = {'login': u['login'], 'email': u['email'],
+                  'name': u['name'],
+                  'publicKeys': {'nodes': [{'key': k} for k in u['keys']]},
+                  'organizations': {'nodes': [{'login': o}
+                                              for o in u['orgs']]}}
+        self.reply(200, {'data': {'viewer': viewer}})
+
+
+class LocalGithubServer(object):
+    def __init__(self):
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                               LocalGithubHandler)
+        self.httpd.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+
 class TestPersonalAccessTokenGithubController(TestCase):
     @classmethod
     def setupClass(cls):
         cls.conf = dummy_conf()
         gen_rsa_key()
-        github.conf = cls.conf
+        settings.load(cls.conf)
 
     @classmethod
     def tearDownClass(cls):
         pass
 
-    def test_authenticate(self):
+    @patch('cauth.utils.common.log_login')
+    def test_authenticate(self, log_login):
         with httmock.HTTMock(githubmock_request):
             common.setup_response = Mock()
             gc = github.PersonalAccessTokenGithubController()
-            gc.organization_allowed = lambda token: True
+            gc.organization_allowed = lambda token, orgs: True
             gc.index(back='/r/', token='user6_token')
             common.setup_response.assert_called_once_with(
                 'user6', '/r/', 'user6@tests.dom', 'Demo user6', {'key': ''})
 
         with httmock.HTTMock(githubmock_request):
             gc = github.PersonalAccessTokenGithubController()
-            gc.organization_allowed = lambda token: False
+            gc.organization_allowed = lambda token, orgs: False
             self.assertRaises(HTTPUnauthorized,
                               gc.index, back='/r/', token='bad_token')
+        log_login.assert_called_with('github_token', None, 'unknown token')
 
     @patch('requests.get')
     def test_organization_allowed(self, mocked_get):
@@ -392,10 +1729,12 @@ class TestPersonalAccessTokenGithubController(TestCase):
 
         # allowed_organizations set empty -> allowed
         self.conf.auth['github']['allowed_organizations'] = ''
+        settings.load(self.conf)
         self.assertEqual(True, gc.organization_allowed('token'))
 
         # allowed_organizations set, doesn't match token orgs -> not allowed
         self.conf.auth['github']['allowed_organizations'] = 'some,other'
+        settings.load(self.conf)
         self.assertEqual(False, gc.organization_allowed('token'))
         mocked_get.assert_called_with(
             'https://api.github.com/user/orgs',
@@ -403,6 +1742,7 @@ class TestPersonalAccessTokenGithubController(TestCase):
 
         # allowed_organizations set, doesn't match token orgs -> not allowed
         self.conf.auth['github']['allowed_organizations'] = 'some,other,acme'
+        settings.load(self.conf)
         self.assertEqual(True, gc.organization_allowed('token'))
         mocked_get.assert_called_with(
             'https://api.github.com/user/orgs',
@@ -414,7 +1754,7 @@ class TestGithubController(TestCase):
     def setupClass(cls):
         cls.conf = dummy_conf()
         gen_rsa_key()
-        github.conf = cls.conf
+        settings.load(cls.conf)
 
     @classmethod
     def tearDownClass(cls):
@@ -426,22 +1766,23 @@ class TestGithubController(TestCase):
             self.assertEqual('user6_token',
                              gc.get_access_token('user6_code'))
 
-    def test_callback(self):
+    @patch('cauth.model.db.get_url', Mock(return_value='/r/'))
+    @patch('cauth.utils.common.log_login')
+    def test_callback(self, log_login):
         with httmock.HTTMock(githubmock_request):
-            db.get_url = Mock(return_value='/r/')
             common.setup_response = Mock()
             gc = github.GithubController()
-            gc.organization_allowed = lambda login: True
+            gc.organization_allowed = lambda token, orgs: True
             gc.callback(state='stateXYZ', code='user6_code')
             common.setup_response.assert_called_once_with(
                 'user6', '/r/', 'user6@tests.dom', 'Demo user6', {'key': ''})
 
         with httmock.HTTMock(githubmock_request):
-            db.get_url = Mock(return_value='/r/')
             gc = github.GithubController()
-            gc.organization_allowed = lambda login: False
+            gc.organization_allowed = lambda token, orgs: False
             self.assertRaises(HTTPUnauthorized,
                               gc.callback, state='stateXYZ', code='user6_code')
+        log_login.assert_called_with('github', 'user6', 'organization')
 
     @patch('requests.get')
     def test_organization_allowed(self, mocked_get):
@@ -453,10 +1794,12 @@ class TestGithubController(TestCase):
 
         # allowed_organizations set empty -> allowed
         self.conf.auth['github']['allowed_organizations'] = ''
+        settings.load(self.conf)
         self.assertEqual(True, gc.organization_allowed('token'))
 
         # allowed_organizations set, doesn't match token orgs -> not allowed
         self.conf.auth['github']['allowed_organizations'] = 'some,other'
+        settings.load(self.conf)
         self.assertEqual(False, gc.organization_allowed('token'))
         mocked_get.assert_called_with(
             'https://api.github.com/user/orgs',
@@ -464,12 +1807,92 @@ class TestGithubController(TestCase):
 
         # allowed_organizations set, doesn't match token orgs -> not allowed
         self.conf.auth['github']['allowed_organizations'] = 'some,other,acme'
+        settings.load(self.conf)
         self.assertEqual(True, gc.organization_allowed('token'))
         mocked_get.assert_called_with(
             'https://api.github.com/user/orgs',
             headers={'Authorization': 'token token'})
 
 
+class TestGithubResolvers(TestCase):
+    @classmethod
+    def setupClass(cls):
+        cls.conf = dummy_conf()
+        gen_rsa_key()
+        settings.load(cls.conf)
+        cls.server = LocalGithubServer()
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        del self.server.requests[:]
+        self.conf.auth['github']['api_url'] = self.server.url
+        self.conf.auth['github']['api'] = 'graphql'
+        settings.load(self.conf)
+
+    def tearDown(self):
+        self.conf.auth['github'].pop('api_url')
+        self.conf.auth['github'].pop('api')
+        self.conf.auth['github'].pop('allowed_organizations', None)
+        settings.load(self.conf)
+
+    def test_get_resolver(self):
+        self.assertIsInstance(githubapi.get_resolver({}),
+                              githubapi.RestResolver)
+        self.assertIsInstance(githubapi.get_resolver({'api': 'graphql'}),
+                              githubapi.GraphQLResolver)
+        self.assertRaises(ValueError, githubapi.get_resolver,
+                          {'api': 'soap'})
+
+    def test_resolvers_agree(self):
+        rest = githubapi.RestResolver(self.server.url)
+        graphql = githubapi.GraphQLResolver(self.server.url)
+        for basic_auth in (False, True):
+            r = rest.resolve('user7_token', basic_auth)
+            g = graphql.resolve('user7_token', basic_auth)
+            self.assertEqual(r[:4], g[:4])
+            self.assertEqual(None, r[4])
+            self.assertEqual(['acme'], g[4])
+            self.assertEqual(['acme'],
+                             rest.organizations('user7_token', basic_auth))
+
+    def test_graphql_bad_token(self):
+        graphql = githubapi.GraphQLResolver(self.server.url)
+        self.assertEqual((None, None, None, [], []),
+                         graphql.resolve('bad_token'))
+
+    @patch('cauth.utils.common.log_login')
+    def test_callback_single_round_trip(self, log_login):
+        self.conf.auth['github']['allowed_organizations'] = 'acme'
+        settings.load(self.conf)
+        gc = github.GithubController()
+        gc.get_access_token = lambda code: 'user7_token'
+        with patch('cauth.model.store.get') as get_store:
+            get_store.return_value.get_url.return_value = '/r/'
+            with patch('cauth.utils.common.setup_response') as sr:
+                gc.callback(state='stateXYZ', code='user7_code')
+                sr.assert_called_once_with(
+                    'user7', '/r/', 'user7@tests.dom', 'Demo user7',
+                    [{'key': 'ssh-rsa AAAA user7'}])
+        self.assertEqual([('POST', '/graphql')], self.server.requests)
+
+    @patch('cauth.utils.common.log_login')
+    def test_authenticate_graphql(self, log_login):
+        self.conf.auth['github']['allowed_organizations'] = 'other'
+        settings.load(self.conf)
+        gc = github.PersonalAccessTokenGithubController()
+        with patch('cauth.utils.common.setup_response') as sr:
+            self.assertRaises(HTTPUnauthorized,
+                              gc.index, back='/r/', token='user7_token')
+            self.assertRaises(HTTPUnauthorized,
+                              gc.index, back='/r/', token='bad_token')
+            self.assertFalse(sr.called)
+        self.assertEqual([('POST', '/graphql')] * 2, self.server.requests)
+
+
 class TestCauthApp(FunctionalTest):
     def test_get_login(self):
         response = self.app.get('/login', params={'back': 'r/'})
@@ -480,7 +1903,7 @@ class TestCauthApp(FunctionalTest):
     def test_post_login(self):
         # Ldap and Gitub Oauth backend are mocked automatically
         # if the domain is tests.dom
-        with patch('cauth.utils.userdetails.requests'):
+        with patch('cauth.utils.userdetails.UserDetailsCreator.create_user'):
             response = self.app.post('/login', params={'username': 'user1',
                                                        'password': 'userpass',
                                                        'back': 'r/'})
@@ -503,6 +1926,18 @@ class TestCauthApp(FunctionalTest):
                                          status="*")
             self.assertEqual(response.status_int, 401)
 
+    def test_login_events(self):
+        with patch('cauth.utils.logs.EVENTS') as events:
+            self.app.post('/login', params={'back': 'r/'}, status=401)
+            self.app.get('/logout')
+        login, logout = [c[1]['extra']['fields']
+                         for c in events.info.call_args_list]
+        self.assertEqual({'event': 'login', 'method': 'password',
+                          'username': None, 'result': 'failure',
+                          'reason': 'missing credentials',
+                          'remote_addr': None}, login)
+        self.assertEqual('logout', logout['event'])
+
     def test_github_login(self):
         with httmock.HTTMock(githubmock_request):
             with patch('cauth.utils.userdetails'):
@@ -523,6 +1958,132 @@ class TestCauthApp(FunctionalTest):
                     ['http://tests.dom/auth/login/github/callback"'],
                     parsed_qs.get('redirect_uri'))
 
+    def test_login_page_caching(self):
+        response = self.app.get('/login', params={'back': 'r/'})
+        self.assertEqual('private, max-age=300',
+                         response.headers['Cache-Control'])
+        self.assertEqual('Cookie', response.headers['Vary'])
+        etag = response.headers['ETag']
+        response = self.app.get('/login', params={'back': 'r/'},
+                                headers={'If-None-Match': etag}, status=304)
+        self.assertEqual('', response.body)
+        response = self.app.get('/login', params={'back': 'other/'},
+                                headers={'If-None-Match': etag})
+        self.assertNotEqual(etag, response.headers['ETag'])
+        self.assertGreater(response.body.find('value="other/"'), 0)
+
+    def test_no_session_without_state(self):
+        with patch('cauth.model.db.Session') as session:
+            self.app.get('/login', params={'back': 'r/'})
+            self.app.post('/login', params={'back': 'r/'}, status="*")
+            self.app.get('/logout')
+        self.assertEqual([], session.mock_calls)
+
+    def test_health(self):
+        self.assertEqual({'status': 'ok'}, self.app.get('/health').json)
+        self.assertTrue(self.app.get('/ready').json['ready'])
+
+        def unreachable(timeout):
+            raise IOError('unreachable')
+
+        prober = health.Prober([('ldap', unreachable)])
+        prober.run_probes()
+        with patch('cauth.utils.health._prober', prober):
+            response = self.app.get('/ready', status=503)
+        self.assertFalse(response.json['checks']['ldap']['ok'])
+
+    def ticket_cookie(self, uid='user1', validity=3600):
+        ticket = common.create_ticket(uid=uid,
+                                      validuntil=time.time() + validity)
+        return {'Cookie': 'auth_pubtkt=%s' % urllib.quote_plus(ticket)}
+
+    def test_already_authenticated(self):
+        headers = self.ticket_cookie()
+        response = self.app.get('/login', params={'back': 'r/'},
+                                headers=headers, status=303)
+        self.assertEqual('http://localhost/r/', response.headers['Location'])
+        self.assertNotIn('Set-Cookie', response.headers)
+        with patch('cauth.model.store.get') as store:
+            response = self.app.get('/login/github/index',
+                                    params={'back': 'r/'},
+                                    headers=headers, status=303)
+        self.assertFalse(store.called)
+        # an expired ticket is ignored
+        response = self.app.get('/login', params={'back': 'r/'},
+                                headers=self.ticket_cookie(validity=-1))
+        self.assertEqual(200, response.status_int)
+
+    def test_renew(self):
+        self.app.get('/renew', status=401)
+        response = self.app.get('/renew', params={'back': 'r/'}, status=303)
+        self.assertEqual('http://localhost/auth/login?back=r%2F',
+                         response.headers['Location'])
+        # the ticket is far from its expiration
+        response = self.app.get('/renew', headers=self.ticket_cookie(
+            validity=3500))
+        self.assertFalse(response.json['renewed'])
+        self.assertNotIn('Set-Cookie', response.headers)
+        response = self.app.get('/renew', params={'back': 'r/'},
+                                headers=self.ticket_cookie(validity=60),
+                                status=303)
+        self.assertEqual('http://localhost/r/', response.headers['Location'])
+        cookie = urllib.unquote_plus(
+            response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1])
+        ticket = common.parse_ticket(cookie)
+        self.assertEqual('user1', ticket['uid'])
+        self.assertGreater(ticket['validuntil'], time.time() + 3000)
+        self.assertIn('graceperiod', ticket)
+
+    def test_logout_revokes(self):
+        headers = self.ticket_cookie()
+        self.app.get('/renew', headers=headers)
+        self.app.get('/logout', headers=headers)
+        self.app.get('/renew', headers=headers, status=401)
+        response = self.app.get('/login', params={'back': 'r/'},
+                                headers=headers)
+        self.assertEqual(200, response.status_int)
+
+    def test_get_metrics(self):
+        auth.check_static_user(settings.get(), 'user1', 'wrong')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_int, 200)
+        self.assertIn('cauth_auth_backend_checks_total{backend="static",'
+                      'result="rejected"}', response.body)
+        self.assertIn('# TYPE cauth_signature_seconds histogram',
+                      response.body)
+
+    def test_admin_profiling(self):
+        tmp = tempfile.mkdtemp()
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        try:
+            self.app.get('/admin/profiling', status=403,
+                         extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+            self.app.get('/admin/profiling', status=404, extra_environ=local)
+            profiling.setup(settings.ProfilingSettings(
+                directory=tmp, rate=1, interval=0.001, dump_interval=60))
+            response = self.app.post('/admin/profiling', {'enabled': '1'},
+                                     extra_environ=local)
+            self.assertEqual(True, response.json['enabled'])
+            self.assertIn('enabled', os.listdir(tmp))
+            response = self.app.post('/admin/profiling', {'enabled': '0'},
+                                     extra_environ=local)
+            self.assertEqual(False, response.json['enabled'])
+        finally:
+            profiling.setup(settings.ProfilingSettings(
+                directory=None, rate=1, interval=0.001, dump_interval=60))
+            shutil.rmtree(tmp)
+
+    def test_admin_memory(self):
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        self.app.get('/admin/memory', status=403,
+                     extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        response = self.app.post('/admin/memory', extra_environ=local)
+        self.assertGreater(response.json['current']['rss'], 0)
+        self.assertNotIn('growth', response.json)
+        response = self.app.get('/admin/memory', extra_environ=local)
+        self.assertEqual(1, len(response.json['snapshots']))
+        self.assertIn('growth', response.json)
+
     def test_get_logout(self):
         # Ensure client SSO cookie content is deleted
         response = self.app.get('/logout')
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Provision a list of users in Redmine and Gerrit before they log in.
+
+The users are read from a CSV file (with username, email, lastname and
+optionally key columns), a JSON file (a list of objects with username,
+email, lastname and keys), the static users of the configuration or an
+LDAP search. The usernames provisioned are appended to a state file, so
+that an interrupted run continues where it stopped, and recorded in the
+provisioning index when it is enabled, so that their first login does not
+provision them again."""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+from pecan.configuration import conf_from_file
+
+from cauth import settings
+from cauth.utils import clients, provisioning
+from cauth.utils.userdetails import Gerrit, Redmine
+
+
+def user(username, email=None, lastname=None, keys=None):
+    return (username, email, lastname,
+            [{'key': key} for key in keys or [] if key])
+
+
+def read_csv(path):
+    with open(path) as f:
+        return [user(row['username'], row.get('email'), row.get('lastname'),
+                     [row.get('key')])
+                for row in csv.DictReader(f)]
+
+
+def read_json(path):
+    with open(path) as f:
+        return [user(entry['username'], entry.get('email'),
+                     entry.get('lastname'), entry.get('keys'))
+                for entry in json.load(f)]
+
+
+def static_users(current):
+    return [user(username, mail, lastname)
+            for username, (password, mail, lastname)
+            in sorted(current.users.items())]
+
+
+def ldap_users(config, filterstr, bind_dn=None, password=None):
+    """Search the users below the base of the configured dn. The username
+    is the attribute naming the users in the dn."""
+    import ldap
+
+    rdn, base = (config.dn % {'username': '*'}).split(',', 1)
+    uid = rdn.split('=', 1)[0]
+    conn = ldap.initialize(config.host)
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    conn.simple_bind_s(bind_dn or '', password or '')
+    result = conn.search_s(base, ldap.SCOPE_SUBTREE, filterstr,
+                           attrlist=[uid] + list(config.attrlist))
+    return [user(attrs[uid][0], attrs.get(config.mail, [None])[0],
+                 attrs.get(config.sn, [None])[0])
+            for dn, attrs in result if attrs.get(uid)]
+
+
+def open_index(options):
+    """Return the provisioning index of the database of cauth."""
+    from sqlalchemy import create_engine
+    from cauth.model import db
+
+    options = dict(options)
+    engine = create_engine(options.pop('url'), **options)
+    db.Session.configure(bind=engine)
+    db.Base.metadata.create_all(engine)
+    return provisioning.FingerprintIndex()
+
+
+class BulkProvisioner(object):
+    """Provisions the users by batches: the Redmine users and the Gerrit
+    accounts are created by a pool of workers, then the Gerrit external
+    ids of the batch are inserted with a single statement."""
+
+    def __init__(self, current, registry, workers=4, batch_size=100,
+                 state_path=None, out=sys.stdout, index=None):
+        self.current = current
+        self.index = index
+        self.redmine = None
+        if current.redmine is not None:
+            self.redmine = Redmine(current, registry)
+        self.gerrit = Gerrit(current, registry)
+        self.pool = ThreadPool(workers)
+        self.batch_size = batch_size
+        self.state_path = state_path
+        self.out = out
+
+    def done(self):
+        """Return the usernames provisioned by the previous runs."""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return set()
+        with open(self.state_path) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def create_account(self, user):
+        """Return the Gerrit account id of user, None when it could not be
+        provisioned, and is then retried by the next run."""
+        username, email, lastname, keys = user
+        if self.redmine is not None:
+            try:
+                # a refusal is final, Redmine already knows the user
+                self.redmine.create_user(username, email, lastname)
+            except Exception as e:
+                self.out.write('Unable to create the Redmine user %s: %s\n' %
+                               (username, e))
+                return None
+        try:
+            return self.gerrit.create_account(username, email, lastname)
+        except Exception as e:
+            self.out.write('Unable to create the Gerrit account %s: %s\n' %
+                           (username, e))
+            return None
+
+    def install_sshkeys(self, user):
+        """Return whether the keys of user are installed."""
+        username, email, lastname, keys = user
+        if keys:
+            try:
+                self.gerrit.install_sshkeys(username, keys)
+            except Exception as e:
+                self.out.write('Unable to install the SSH keys of %s: %s\n' %
+                               (username, e))
+                return False
+        return True
+
+    def run_batch(self, batch):
+        """Provision the users of batch, return the provisioned ones."""
+        account_ids = self.pool.map(self.create_account, batch)
+        created = [u for u, account_id in zip(batch, account_ids)
+                   if account_id]
+        accounts = [(account_id, u[0])
+                    for u, account_id in zip(batch, account_ids)
+                    if account_id]
+        if not accounts or not self.gerrit.add_in_acc_external_many(accounts):
+            return []
+        installed = self.pool.map(self.install_sshkeys, created)
+        created = [u for u, ok in zip(created, installed) if ok]
+        if self.index is not None:
+            for username, email, lastname, keys in created:
+                self.index.put(username, provisioning.fingerprint(
+                    email, lastname, keys))
+        return created
+
+    def run(self, users):
+        """Provision users, skipping the ones already done, and return the
+        amounts of provisioned and failed users."""
+        done = self.done()
+        # the details a login without them would provision
+        todo = [(u[0], ) + provisioning.defaults(self.current, *u[:3]) +
+                (u[3], ) for u in users if u[0] not in done]
+        provisioned = failed = 0
+        self.out.write('%d users to provision, %d already done\n' %
+                       (len(todo), len(users) - len(todo)))
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start:start + self.batch_size]
+            created = self.run_batch(batch)
+            if self.state_path and created:
+                with open(self.state_path, 'a') as f:
+                    f.write(''.join('%s\n' % u[0] for u in created))
+            provisioned += len(created)
+            failed += len(batch) - len(created)
+            self.out.write('%d/%d users provisioned, %d failed\n' %
+                           (provisioned, len(todo), failed))
+            self.out.flush()
+        return provisioned, failed
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config', help='path to the cauth config.py')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--csv', help='read the users from a CSV file')
+    source.add_argument('--json', help='read the users from a JSON file')
+    source.add_argument('--static', action='store_true',
+                        help='provision the users of the auth section')
+    source.add_argument('--ldap', metavar='FILTER',
+                        help='provision the users matching an LDAP filter')
+    parser.add_argument('--ldap-bind-dn', help='dn used for the LDAP search')
+    parser.add_argument('--ldap-password',
+                        help='password used for the LDAP search')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='users provisioned at the same time')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='users per batch of external ids')
+    parser.add_argument('--state', metavar='PATH',
+                        help='file recording the users provisioned, to '
+                        'resume an interrupted run')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    config = conf_from_file(args.config)
+    current = settings.compile_settings(config)
+    if args.csv:
+        users = read_csv(args.csv)
+    elif args.json:
+        users = read_json(args.json)
+    elif args.static:
+        users = static_users(current)
+    else:
+        if not current.ldap:
+            sys.exit('The auth section has no ldap configuration')
+        users = ldap_users(current.ldap, args.ldap, args.ldap_bind_dn,
+                           args.ldap_password)
+    index = None
+    if current.provisioning.index:
+        index = open_index(settings.get_section(config, 'sqlalchemy'))
+    registry = clients.ClientRegistry(current)
+    provisioner = BulkProvisioner(current, registry, args.workers,
+                                  args.batch_size, args.state, index=index)
+    provisioned, failed = provisioner.run(users)
+    registry.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
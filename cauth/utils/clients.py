@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Clients of the services provisioned with the users, created once per
+process and shared by the provisioning code."""
+
+import collections
+import requests
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from cauth import settings
+from cauth.utils.pool import ConnectionPool
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def http_session(pool_size, **attrs):
+    """Return a requests session keeping up to pool_size connections alive
+    per host."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for name, value in attrs.items():
+        if name == 'headers':
+            session.headers.update(value)
+        else:
+            setattr(session, name, value)
+    return session
+
+
+class LRUCache(object):
+    """A thread-safe mapping keeping the size most recently used keys."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class ClientRegistry(object):
+    """The keep-alive HTTP sessions to the Gerrit and Redmine REST APIs
+    (None when Redmine is not configured), the pool of connections to the
+    Gerrit database, the threads used to upload the SSH keys, to register
+    the Gerrit external ids and to run the provisioning steps concurrently,
+    and the ids of the Gerrit accounts already known."""
+
+    def __init__(self, settings):
+        gerrit = settings.gerrit
+        redmine = settings.redmine
+        self.gerrit = http_session(
+            gerrit.http_pool_size,
+            auth=(gerrit.admin_user, gerrit.admin_password))
+        self.gerrit_timeout = gerrit.http_timeout
+        self.redmine = self.redmine_timeout = None
+        if redmine is not None:
+            self.redmine = http_session(
+                redmine.http_pool_size,
+                headers={'X-Redmine-API-Key': redmine.apikey,
+                         'Content-type': 'application/json'})
+            self.redmine_timeout = redmine.http_timeout
+
+        def connect():
+            import MySQLdb
+            return MySQLdb.connect(passwd=gerrit.db_password,
+                                   db=gerrit.db_name,
+                                   host=gerrit.db_host,
+                                   user=gerrit.db_user)
+        self.gerrit_db = ConnectionPool(connect,
+                                        size=gerrit.db_pool_size,
+                                        recycle=gerrit.db_pool_recycle)
+        self.sshkeys_workers = gerrit.sshkeys_workers
+        self.branch_workers = settings.provisioning.branch_workers
+        self.db_workers = gerrit.db_pool_size
+        self.gerrit_accounts = LRUCache(gerrit.account_cache_size)
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def thread_pool(self, name, size):
+        # the threads are only started when they are first needed
+        with self.lock:
+            if name not in self.pools:
+                self.pools[name] = ThreadPool(size)
+            return self.pools[name]
+
+    @property
+    def sshkeys_pool(self):
+        return self.thread_pool('sshkeys', self.sshkeys_workers)
+
+    @property
+    def external_ids_pool(self):
+        # never the branch pool: the gerrit step, which waits for the
+        # external id, may run on it
+        return self.thread_pool('external_ids', self.db_workers)
+
+    @property
+    def branch_pool(self):
+        return self.thread_pool('branches', self.branch_workers)
+
+    def close(self):
+        self.gerrit.close()
+        if self.redmine is not None:
+            self.redmine.close()
+        self.gerrit_db.dispose()
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.terminate()
+
+
+def setup(settings):
+    """Create the clients described by the settings and make them the
+    current ones."""
+    global _registry
+    with _registry_lock:
+        if _registry is not None:
+            _registry.close()
+        _registry = ClientRegistry(settings)
+        return _registry
+
+
+def get():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ClientRegistry(settings.get())
+        return _registry
@@ -17,21 +17,72 @@
 import time
 import hashlib
 import base64
+import logging
 import urllib
 
-from M2Crypto import RSA
-from pecan import response, conf
-from cauth.utils import userdetails
+from pecan import request, response
+from cauth import settings
+from cauth.utils import logs, metrics, provisioning, revocation, tracing
 
 
+logger = logging.getLogger(__name__)
+
+SIGNATURE_SECONDS = metrics.Histogram(
+    'cauth_signature_seconds', 'Duration of the ticket signatures')
+
+_key = None
+
+
+def load_key(path):
+    """Load the private key signing the tickets."""
+    global _key
+    from M2Crypto import RSA
+    key = RSA.load_key(path)
+    _key = (path, key)
+    return key
+
+
+def signing_key():
+    """Return the key loaded from the configured path, loading it on
+    the first call."""
+    path = settings.get().app.priv_key_path
+    loaded = _key
+    if loaded is not None and loaded[0] == path:
+        return loaded[1]
+    return load_key(path)
+
+
+def setup(app):
+    """Load the signing key when cauth starts, rather than on the first
+    login."""
+    try:
+        load_key(app.priv_key_path)
+    except Exception as e:
+        # reported by /auth/ready, the first signature tries again
+        logger.error('Unable to load the signing key %s: %s',
+                     app.priv_key_path, e)
+
+
+@metrics.timed(SIGNATURE_SECONDS)
 def signature(data):
-    rsa_priv = RSA.load_key(conf.app['priv_key_path'])
+    rsa_priv = signing_key()
     dgst = hashlib.sha1(data).digest()
     sig = rsa_priv.sign(dgst, 'sha1')
     sig = base64.b64encode(sig)
     return sig
 
 
+def verify(data, sig):
+    """Return whether sig is the signature of data by the signing key."""
+    from M2Crypto import RSA
+    dgst = hashlib.sha1(data).digest()
+    try:
+        return bool(signing_key().verify(dgst, base64.b64decode(sig),
+                                         'sha1'))
+    except (RSA.RSAError, TypeError):
+        return False
+
+
 def create_ticket(**kwargs):
     ticket = ''
     for k in sorted(kwargs.keys()):
@@ -43,26 +94,92 @@ def create_ticket(**kwargs):
     return ticket
 
 
-def pre_register_user(username, email=None, lastname=None, keys=None):
-    if lastname is None:
-        lastname = 'User %s' % username
-    if not email:
-        email = '%s@%s' % (username, conf.app['cookie_domain'])
+def parse_ticket(ticket, now=None):
+    """Return the fields of ticket when its signature is valid and it has
+    not expired, otherwise None."""
+    if not ticket:
+        return None
+    data, sep, sig = ticket.rpartition(';sig=')
+    if not sep or not verify(data, sig):
+        return None
+    fields = dict(field.partition('=')[::2] for field in data.split(';'))
+    try:
+        validuntil = float(fields.get('validuntil'))
+    except (TypeError, ValueError):
+        return None
+    if validuntil <= (now or time.time()) or not fields.get('uid'):
+        return None
+    fields['validuntil'] = validuntil
+    return fields
 
-    udc = userdetails.UserDetailsCreator(conf)
-    udc.create_user(username, email, lastname, keys)
 
+def client_ticket():
+    cookie = request.cookies.get('auth_pubtkt')
+    if not cookie:
+        return None
+    return urllib.unquote_plus(cookie)
 
-def setup_response(username, back, email=None, lastname=None, keys=None):
-    pre_register_user(username, email, lastname, keys)
-    ticket = create_ticket(uid=username,
-                           validuntil=(
-                               time.time() + conf.app['cookie_period']))
-    enc_ticket = urllib.quote_plus(ticket)
+
+def current_ticket():
+    """Return the fields of the valid ticket sent by the client, if any,
+    unless it was revoked."""
+    ticket = client_ticket()
+    fields = parse_ticket(ticket)
+    if fields is None or revocation.get().revoked(ticket):
+        return None
+    return fields
+
+
+def revoke_ticket():
+    """Revoke the ticket sent by the client, return its fields."""
+    ticket = client_ticket()
+    fields = parse_ticket(ticket)
+    if fields is not None:
+        revocation.get().revoke(ticket, fields['validuntil'])
+    return fields
+
+
+def log_login(method, username, reason=None):
+    """Emit the login event of the request, a failed one when a reason is
+    given."""
+    logs.event('login', method=method, username=username,
+               result='failure' if reason else 'success', reason=reason,
+               remote_addr=request.remote_addr)
+
+
+def pre_register_user(username, email=None, lastname=None, keys=None):
+    email, lastname = provisioning.defaults(settings.get(), username, email,
+                                            lastname)
+    provisioning.get().submit(username, email, lastname, keys)
+
+
+def set_ticket(username):
+    """Sign a new ticket for username and set it as the cookie of the
+    response."""
+    app = settings.get().app
+    validuntil = time.time() + app.cookie_period
+    fields = {'uid': username, 'validuntil': validuntil}
+    if app.renew_window:
+        # mod_auth_pubtkt sends the client to its TKTAuthRefreshURL, the
+        # renew endpoint, once the grace period is reached
+        fields['graceperiod'] = validuntil - app.renew_window
+    with tracing.span('signature'):
+        ticket = create_ticket(**fields)
     response.set_cookie('auth_pubtkt',
-                        value=enc_ticket,
-                        domain=conf.app['cookie_domain'],
-                        max_age=conf.app['cookie_period'],
+                        value=urllib.quote_plus(ticket),
+                        domain=app.cookie_domain,
+                        max_age=app.cookie_period,
                         overwrite=True)
+    return validuntil
+
+
+def redirect_back(back):
     response.status_code = 303
     response.location = urllib.unquote_plus(back).decode("utf8")
+
+
+def setup_response(username, back, email=None, lastname=None, keys=None):
+    with tracing.span('provisioning'):
+        pre_register_user(username, email, lastname, keys)
+    set_ticket(username)
+    redirect_back(back)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import requests
+
+from cauth.utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = metrics.Histogram(
+    'cauth_github_request_seconds', 'Duration of the GitHub API calls',
+    ('call', ))
+REQUESTS = metrics.Counter(
+    'cauth_github_requests_total', 'GitHub API calls per HTTP status',
+    ('call', 'status'))
+
+GITHUB_API_URL = "https://api.github.com"
+
+GRAPHQL_QUERY = """
+query {
+  viewer {
+    login
+    name
+    email
+    publicKeys(first: 100) { nodes { key } }
+    organizations(first: 100) { nodes { login } }
+  }
+}
+"""
+
+
+def request(call, method, url, **kwargs):
+    """Send a request to GitHub, call names it in the metrics."""
+    try:
+        with REQUEST_SECONDS.time(call):
+            resp = getattr(requests, method.lower())(url, **kwargs)
+    except Exception:
+        REQUESTS.inc(call, 'error')
+        raise
+    REQUESTS.inc(call, str(resp.status_code))
+    return resp
+
+
+def auth_params(token, basic_auth=False):
+    """Return the requests keyword arguments authenticating with a token,
+    either as an OAuth token or as a personal access token."""
+    if basic_auth:
+        return {'auth': requests.auth.HTTPBasicAuth(token, 'x-oauth-basic')}
+    return {'headers': {'Authorization': 'token ' + token}}
+
+
+class RestResolver(object):
+    """Resolves a GitHub identity with the REST API: the profile, the SSH
+    keys and the organizations are fetched with separate calls."""
+
+    def __init__(self, api_url=GITHUB_API_URL):
+        self.api_url = api_url.rstrip('/')
+
+    def get(self, path, token, basic_auth=False, call=None):
+        resp = request(call or path, 'GET', self.api_url + path,
+                       **auth_params(token, basic_auth))
+        return resp.json()
+
+    def resolve(self, token, basic_auth=False):
+        """Return (login, email, name, ssh_keys, orgs) for the token owner.
+        orgs is None, organizations() is only called when filtering on
+        organizations is configured."""
+        data = self.get('/user', token, basic_auth)
+        login = data.get('login')
+        if not login:
+            logger.error('GITHUB user request failed: %s',
+                         data.get('message'))
+            return None, None, None, [], None
+        if basic_auth:
+            ssh_keys = self.get('/user/keys', token, basic_auth)
+        else:
+            ssh_keys = self.get('/users/%s/keys' % login, token, basic_auth,
+                                call='/users/keys')
+        return login, data.get('email'), data.get('name'), ssh_keys, None
+
+    def organizations(self, token, basic_auth=False):
+        user_orgs = self.get('/user/orgs', token, basic_auth)
+        return [org['login'] for org in user_orgs]
+
+
+class GraphQLResolver(object):
+    """Resolves a GitHub identity, its public keys and its organizations
+    with a single GraphQL query."""
+
+    def __init__(self, api_url=GITHUB_API_URL, graphql_url=None):
+        self.api_url = api_url.rstrip('/')
+        self.graphql_url = graphql_url or api_url.rstrip('/') + '/graphql'
+
+    def query(self, token, basic_auth=False):
+        resp = request('/graphql', 'POST', self.graphql_url,
+                       data=json.dumps({'query': GRAPHQL_QUERY}),
+                       **auth_params(token, basic_auth))
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+        viewer = (data.get('data') or {}).get('viewer')
+        if not viewer:
+            logger.error('GITHUB GraphQL query failed: %s',
+                         data.get('errors', data.get('message')))
+        return viewer
+
+    def resolve(self, token, basic_auth=False):
+        """Return (login, email, name, ssh_keys, orgs) for the token owner."""
+        viewer = self.query(token, basic_auth)
+        if not viewer:
+            return None, None, None, [], []
+        ssh_keys = [{'key': node['key']}
+                    for node in viewer['publicKeys']['nodes']]
+        orgs = [node['login'] for node in viewer['organizations']['nodes']]
+        # GraphQL returns an empty string for a private email
+        return (viewer['login'], viewer.get('email') or None,
+                viewer.get('name'), ssh_keys, orgs)
+
+    def organizations(self, token, basic_auth=False):
+        return self.resolve(token, basic_auth)[4]
+
+
+RESOLVERS = {'rest': RestResolver,
+             'graphql': GraphQLResolver}
+
+
+def get_resolver(github):
+    """Return the resolver selected by the 'api' key of the github
+    configuration, defaulting to the REST API."""
+    api = github.get('api', 'rest')
+    if api not in RESOLVERS:
+        raise ValueError('Unknown GITHUB api "%s", expected one of %s' %
+                         (api, ', '.join(sorted(RESOLVERS))))
+    api_url = github.get('api_url', GITHUB_API_URL)
+    if api == 'graphql':
+        return GraphQLResolver(api_url, github.get('graphql_url'))
+    return RestResolver(api_url)
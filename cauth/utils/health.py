@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Readiness of cauth: whether the signing key is loaded and the services
+it depends on are reachable.
+
+A background thread of each process probes the configured dependencies
+every interval seconds and keeps the results, which /auth/ready returns,
+so that the health checks of a load balancer never reach the
+dependencies."""
+
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+import requests
+
+from cauth.model import db
+from cauth.utils import clients, common, metrics
+
+
+logger = logging.getLogger(__name__)
+
+_prober = None
+
+
+def tcp_probe(url, default_port, timeout):
+    """Open and close a TCP connection to the host of url."""
+    if '//' not in url:
+        # a bare host name
+        url = '//' + url
+    parsed = urlparse.urlparse(url)
+    port = parsed.port or default_port
+    socket.create_connection((parsed.hostname, port), timeout).close()
+
+
+def http_probe(url, timeout, session=requests):
+    """Any answer but a server error tells that the service is up."""
+    resp = session.get(url, timeout=timeout)
+    if resp.status_code >= 500:
+        raise Exception('%s answered %s' % (url, resp.status_code))
+
+
+def probe_signing_key(timeout):
+    common.signing_key()
+
+
+def probe_state_db(timeout):
+    with db.transaction() as session:
+        session.execute('SELECT 1')
+
+
+def probe_gerrit_db(timeout):
+    with clients.get().gerrit_db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+
+
+def get_probes(current, database=True):
+    """Return the (name, probe) of the dependencies of the settings, a
+    probe is a function(timeout) raising when the dependency is not
+    available."""
+    probes = [('signing_key', probe_signing_key)]
+    if database:
+        probes.append(('state_db', probe_state_db))
+    if current.ldap:
+        probes.append(('ldap', lambda timeout: tcp_probe(
+            current.ldap.host, 636 if current.ldap.host.startswith('ldaps')
+            else 389, timeout)))
+    if current.localdb:
+        probes.append(('managesf', lambda timeout: http_probe(
+            current.localdb.managesf_url, timeout)))
+    probes.append(('gerrit', lambda timeout: http_probe(
+        current.gerrit.url, timeout, clients.get().gerrit)))
+    probes.append(('gerrit_db', probe_gerrit_db))
+    if current.redmine:
+        probes.append(('redmine', lambda timeout: http_probe(
+            current.redmine.apiurl, timeout, clients.get().redmine)))
+    if current.github:
+        probes.append(('github', lambda timeout: http_probe(
+            current.github.resolver.api_url, timeout)))
+    return probes
+
+
+class Prober(threading.Thread):
+    """Runs the probes every interval seconds. The dependencies listed in
+    optional are reported but do not make cauth unready."""
+
+    def __init__(self, probes, interval=10, timeout=2, optional=()):
+        super(Prober, self).__init__(name='health-prober')
+        self.daemon = True
+        self.probes = probes
+        self.interval = interval
+        self.timeout = timeout
+        self.optional = frozenset(optional)
+        self.results = {}
+        self.stopped = threading.Event()
+
+    def check(self, name, probe):
+        start = time.time()
+        error = None
+        try:
+            probe(self.timeout)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        result = {'ok': error is None, 'error': error, 'checked_at': start,
+                  'duration': time.time() - start,
+                  'optional': name in self.optional}
+        if error and self.results.get(name, {}).get('ok', True):
+            logger.error('Dependency %s is not available: %s', name, error)
+        return result
+
+    def run_probes(self):
+        # a new dict replaces the results, readers never see a partial run
+        self.results = dict((name, self.check(name, probe))
+                            for name, probe in self.probes)
+
+    def ready(self):
+        """Return False until the first probes are run, then whether all
+        the required dependencies are available."""
+        results = self.results
+        if not results:
+            return False
+        return all(r['ok'] or r['optional'] for r in results.values())
+
+    def status(self):
+        return {'ready': self.ready(), 'checks': self.results}
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_probes()
+            except Exception as e:
+                logger.error('Unable to run the health probes: %s', e)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def setup(current, database=True):
+    """Start probing the dependencies, unless the interval is 0."""
+    global _prober
+    if _prober is not None:
+        _prober.stop()
+        _prober = None
+    health = current.health
+    if health.interval:
+        _prober = Prober(get_probes(current, database), health.interval,
+                         health.timeout, health.optional)
+        _prober.start()
+    return _prober
+
+
+def get():
+    return _prober
+
+
+def status():
+    """Return the readiness and the results of the last probes, cauth is
+    ready when the dependencies are not probed."""
+    if _prober is None:
+        return {'ready': True, 'checks': {}}
+    return _prober.status()
+
+
+def up():
+    return dict((name, int(r['ok']))
+                for name, r in status()['checks'].items())
+
+
+UP = metrics.Gauge(
+    'cauth_dependency_up', 'Whether a dependency answered the last probe',
+    up, ('dependency', ), shared=True)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""The login page, rendered from a template compiled when cauth starts.
+
+The page only depends on the back URL and the message, which takes a few
+values, so the renders are cached with their ETag."""
+
+import hashlib
+
+from mako.lookup import TemplateLookup
+
+from cauth.utils.clients import LRUCache
+
+
+TEMPLATE = 'login.html'
+
+# seconds a browser or a proxy may reuse the login page without
+# revalidating it
+MAX_AGE = 300
+
+_page = None
+
+
+class LoginPage(object):
+    def __init__(self, template_path, cache_size=1000):
+        # the same options as the mako renderer of pecan
+        lookup = TemplateLookup(directories=[template_path],
+                                output_encoding='utf-8')
+        self.template = lookup.get_template(TEMPLATE)
+        self.cache = LRUCache(cache_size)
+
+    def render(self, back, message=''):
+        """Return the (body, ETag) of the page."""
+        key = (back, message)
+        page = self.cache.get(key)
+        if page is None:
+            body = self.template.render(back=back, message=message)
+            page = (body, hashlib.sha1(body).hexdigest())
+            self.cache.put(key, page)
+        return page
+
+
+def setup(template_path):
+    global _page
+    _page = LoginPage(template_path)
+    return _page
+
+
+def get():
+    global _page
+    if _page is None:
+        from pecan import conf
+        _page = LoginPage(conf.app.template_path)
+    return _page
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Logging handlers keeping the file writes off the request threads, and
+structured events.
+
+QueueHandler only puts the records in a queue, from which a QueueListener
+thread hands them to the handlers doing the formatting and the I/O. They
+backport the classes of the Python 3 logging.handlers module.
+AsyncRotatingFileHandler bundles them with a RotatingFileHandler, so that
+it can be set in the logging section of config.py.
+
+The events, such as the logins, are records of the cauth.events logger
+carrying their fields, which JSONFormatter writes as one JSON object per
+line."""
+
+import datetime
+import json
+import logging
+import logging.handlers
+import Queue
+import threading
+
+from cauth.utils import metrics
+
+
+EVENTS = logging.getLogger('cauth.events')
+
+DROPPED = metrics.Counter(
+    'cauth_log_records_dropped_total',
+    'Log records dropped because the log queue was full')
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # the arguments may change and the traceback holds the frames of
+        # the request once the record is queued, both are rendered now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            # never block a request on a slow disk
+            DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    """Hands the records of the queue to the handlers until stopped."""
+
+    def __init__(self, queue, *handlers):
+        super(QueueListener, self).__init__(name='log-writer')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=5):
+        """Write the queued records and stop."""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+
+class AsyncRotatingFileHandler(QueueHandler):
+    """A RotatingFileHandler writing from a background thread. The
+    records are dropped when more than queue_size are waiting."""
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0,
+                 encoding=None, delay=0, queue_size=10000):
+        QueueHandler.__init__(self, Queue.Queue(queue_size))
+        self.target = logging.handlers.RotatingFileHandler(
+            filename, mode, maxBytes, backupCount, encoding, delay)
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        QueueHandler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def close(self):
+        # called by logging.shutdown at exit
+        self.listener.stop()
+        self.target.close()
+        QueueHandler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as a JSON object, including the fields of the
+    events."""
+
+    def format(self, record):
+        created = datetime.datetime.utcfromtimestamp(record.created)
+        data = {'time': created.isoformat() + 'Z',
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage()}
+        data.update(getattr(record, 'fields', {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, sort_keys=True)
+
+
+class Fields(object):
+    """Renders the fields of an event in the text logs, only when a
+    handler takes the record."""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('%s=%s' % (k, v)
+                        for k, v in sorted(self.fields.items())
+                        if v is not None)
+
+
+def event(name, **fields):
+    """Emit the event name with its fields on the cauth.events logger."""
+    if EVENTS.isEnabledFor(logging.INFO):
+        text = Fields(dict(fields))
+        fields['event'] = name
+        EVENTS.info('%s %s', name, text, extra={'fields': fields})
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Memory usage reports of the process, to track its growth.
+
+A snapshot holds the RSS of the process and the amount of live objects per
+type, found by walking the objects tracked by the garbage collector. When
+the tracemalloc module is available (Python 3, or a Python 2 patched with
+pytracemalloc) and enabled, it also holds the allocations per line of
+code. Two snapshots are compared to find what grew in between."""
+
+import collections
+import gc
+import os
+import resource
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# the objects holding a connection to a service
+CONNECTION_TYPES = (
+    'MySQLdb.connections.Connection',
+    'ldap.ldapobject.SimpleLDAPObject',
+    'ldap.ldapobject.LDAPObject',
+    'requests.sessions.Session',
+    'sqlalchemy.engine.base.Connection',
+    'urllib3.connection.HTTPConnection',
+    'urllib3.connection.HTTPSConnection',
+    'requests.packages.urllib3.connection.HTTPConnection',
+    'requests.packages.urllib3.connection.HTTPSConnection',
+    'socket._socketobject',
+)
+
+_tracker = None
+
+
+def rss():
+    """Return the resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # the peak RSS, in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def type_name(obj):
+    cls = getattr(obj, '__class__', type(obj))
+    return '%s.%s' % (getattr(cls, '__module__', '?'), cls.__name__)
+
+
+def type_counts():
+    """Return the amount of live objects tracked by the garbage collector
+    per type."""
+    return collections.Counter(type_name(obj) for obj in gc.get_objects())
+
+
+def connection_counts(counts):
+    return dict((name, counts.get(name, 0)) for name in CONNECTION_TYPES
+                if counts.get(name))
+
+
+class Snapshot(object):
+    def __init__(self):
+        self.time = time.time()
+        self.rss = rss()
+        self.counts = type_counts()
+        self.traces = None
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            self.traces = tracemalloc.take_snapshot()
+
+    def summary(self):
+        return {'time': self.time, 'rss': self.rss,
+                'objects': sum(self.counts.values()),
+                'connections': connection_counts(self.counts)}
+
+
+def diff(old, new, limit=20):
+    """Return what grew between the old and new snapshots."""
+    growth = collections.Counter(new.counts)
+    growth.subtract(old.counts)
+    report = {'seconds': new.time - old.time,
+              'rss': new.rss - old.rss,
+              'types': [(name, count) for name, count
+                        in growth.most_common(limit) if count > 0],
+              'connections': dict((name, growth[name])
+                                  for name in CONNECTION_TYPES
+                                  if growth[name])}
+    if old.traces is not None and new.traces is not None:
+        report['lines'] = [
+            (str(stat.traceback), stat.size_diff, stat.count_diff)
+            for stat in new.traces.compare_to(old.traces, 'lineno')[:limit]]
+    return report
+
+
+class MemoryTracker(object):
+    """Keeps the max_snapshots last snapshots of the process."""
+
+    def __init__(self, max_snapshots=10, trace_frames=0):
+        self.snapshots = collections.deque(maxlen=max_snapshots)
+        self.lock = threading.Lock()
+        if trace_frames and tracemalloc is not None and \
+                not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+
+    @property
+    def tracing(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def report(self, keep=False):
+        """Return the current usage and the growth since the previous
+        snapshot, if any. With keep, the current usage becomes the
+        reference of the next report."""
+        current = Snapshot()
+        with self.lock:
+            snapshots = list(self.snapshots)
+            if keep:
+                self.snapshots.append(current)
+        report = {'pid': os.getpid(), 'tracemalloc': self.tracing,
+                  'current': current.summary(),
+                  'snapshots': [s.summary() for s in snapshots]}
+        if snapshots:
+            report['growth'] = diff(snapshots[-1], current)
+        return report
+
+
+def setup(memory):
+    global _tracker
+    _tracker = MemoryTracker(memory.max_snapshots, memory.trace_frames)
+    return _tracker
+
+
+def get():
+    global _tracker
+    if _tracker is None:
+        _tracker = MemoryTracker()
+    return _tracker
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Counters, histograms and gauges exported in the Prometheus text format.
+
+The values are kept in the memory of each process. When a directory is
+configured, every process periodically writes a snapshot of its values in
+it, and the process serving /auth/metrics adds up the snapshots of all the
+worker processes. The counters and histograms of the processes which
+exited are added to an archive, their gauges are dropped."""
+
+import atexit
+import contextlib
+import errno
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REGISTRY = []
+
+# the counters and histograms of the processes which exited
+ARCHIVE = 'archive.json'
+
+_writer = None
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(k), v if not isinstance(v, list) else list(v)]
+                    for k, v in self.values.items()]
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def merge(self, values, snapshot):
+        for labels, value in snapshot:
+            labels = tuple(labels)
+            if labels in values:
+                values[labels] = self.add(values[labels], value)
+            else:
+                values[labels] = value
+
+    def add(self, a, b):
+        return a + b
+
+    def format_labels(self, values, extra=()):
+        pairs = zip(self.labels, values) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in pairs)
+
+    def render(self, values):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for labels in sorted(values):
+            lines.extend(self.render_sample(labels, values[labels]))
+        return lines
+
+    def render_sample(self, labels, value):
+        return ['%s%s %s' % (self.name, self.format_labels(labels),
+                             format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value computed when the metrics are collected. The values of the
+    processes are added up, unless the gauge is shared by all of them, for
+    instance a database table size, in which case it is only computed by
+    the process serving the metrics."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, labels=(), shared=False):
+        super(Gauge, self).__init__(name, help, labels)
+        self.callback = callback
+        self.shared = shared
+
+    def collect(self):
+        """Return a {labels: value} dict, the callback returns a number or
+        such a dict."""
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error('Unable to collect %s: %s', self.name, e)
+            return {}
+        if not isinstance(values, dict):
+            values = {(): values}
+        return dict((k if isinstance(k, tuple) else (k, ), v)
+                    for k, v in values.items())
+
+    def snapshot(self):
+        if self.shared:
+            return []
+        return [[list(k), v] for k, v in self.collect().items()]
+
+
+class Histogram(Metric):
+    """Observations counted in fixed buckets. A value is stored as the
+    list of the bucket counts, followed by the count above the last bucket
+    and the sum of the observations."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *labels)
+
+    def add(self, a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render_sample(self, labels, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                self.format_labels(labels, [('le', format_value(bound))]),
+                total))
+        lines.append('%s_sum%s %s' % (self.name, self.format_labels(labels),
+                                      format_value(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name,
+                                        self.format_labels(labels), total))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def timed(histogram, *labels):
+    """Decorate a function to observe its duration in histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(*labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    return dict((metric.name, metric.snapshot()) for metric in REGISTRY)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def add_snapshots(snapshots, gauges=True):
+    """Return the snapshot of the values of snapshots added up."""
+    added = {}
+    for metric in REGISTRY:
+        if not gauges and isinstance(metric, Gauge):
+            continue
+        values = {}
+        for s in snapshots:
+            metric.merge(values, s.get(metric.name, []))
+        if values:
+            added[metric.name] = [[list(k), v] for k, v in values.items()]
+    return added
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        # removed or being replaced
+        return None
+
+
+@contextlib.contextmanager
+def directory_lock(directory):
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def archive(directory, path):
+    """Add the counters and histograms of the snapshot at path, of a
+    process which exited, to the archive and remove the snapshot."""
+    archive_path = os.path.join(directory, ARCHIVE)
+    with directory_lock(directory):
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            # archived by another process
+            return
+        snapshots = [snapshot]
+        archived = read_snapshot(archive_path)
+        if archived is not None:
+            snapshots.append(archived)
+        tmp = '%s.tmp' % archive_path
+        with open(tmp, 'w') as f:
+            json.dump(add_snapshots(snapshots, gauges=False), f)
+        os.rename(tmp, archive_path)
+        os.remove(path)
+
+
+class SnapshotWriter(threading.Thread):
+    """Periodically writes the snapshot of the process in directory."""
+
+    def __init__(self, directory, interval):
+        super(SnapshotWriter, self).__init__(name='metrics-writer')
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.path = os.path.join(directory, '%d.json' % os.getpid())
+        self.stopped = threading.Event()
+        if os.path.exists(self.path):
+            # left by a process which had the same pid
+            archive(directory, self.path)
+
+    def write(self):
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(), f)
+        os.rename(tmp, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.error('Unable to write the metrics: %s', e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def read_snapshots(directory, exclude=None):
+    """Return the snapshots of the running processes, archiving the
+    snapshots of the processes which exited."""
+    snapshots = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        pid = name[:-len('.json')]
+        if not name.endswith('.json') or name == ARCHIVE or path == exclude:
+            continue
+        if pid.isdigit() and not alive(int(pid)):
+            try:
+                archive(directory, path)
+            except (IOError, OSError) as e:
+                logger.error('Unable to archive the metrics of %s: %s',
+                             pid, e)
+            continue
+        snapshot = read_snapshot(path)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def collect():
+    """Return the metrics of all the processes in the Prometheus text
+    format."""
+    snapshots = [snapshot()]
+    if _writer is not None:
+        snapshots.extend(read_snapshots(_writer.directory, _writer.path))
+        # read last, a snapshot archived in between is still counted
+        archived = read_snapshot(os.path.join(_writer.directory, ARCHIVE))
+        if archived is not None:
+            snapshots.append(archived)
+    lines = []
+    for metric in REGISTRY:
+        values = {}
+        for s in snapshots:
+            metric.merge(values, s.get(metric.name, []))
+        if isinstance(metric, Gauge) and metric.shared:
+            values = metric.collect()
+        lines.extend(metric.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+def setup(metrics):
+    """Start writing the snapshots of the process when a directory is
+    configured."""
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+    if metrics.directory:
+        if not os.path.isdir(metrics.directory):
+            os.makedirs(metrics.directory)
+        _writer = SnapshotWriter(metrics.directory, metrics.flush_interval)
+        _writer.start()
+    return _writer
+
+
+def flush():
+    if _writer is not None:
+        try:
+            _writer.write()
+        except Exception as e:
+            logger.error('Unable to write the metrics: %s', e)
+
+
+def shutdown():
+    """Archive the values of the process when it exits."""
+    if _writer is not None:
+        try:
+            _writer.write()
+            archive(_writer.directory, _writer.path)
+        except Exception as e:
+            logger.error('Unable to archive the metrics: %s', e)
+
+
+atexit.register(shutdown)
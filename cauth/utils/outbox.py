@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Durable record of the provisioning steps that failed, replayed in the
+background until they succeed."""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from cauth.model import db
+
+
+logger = logging.getLogger(__name__)
+
+
+def idempotency_key(step, username, payload):
+    return hashlib.sha1('%s:%s:%s' % (step, username, payload)).hexdigest()
+
+
+class Outbox(object):
+    """The failed steps are kept in the provisioning_outbox table and
+    replayed with an exponential backoff, starting at backoff seconds and
+    capped to max_backoff, until they succeed or max_attempts is reached.
+
+    steps maps a step name to a callable taking the user details and
+    returning True on success. on_complete is called with the user details
+    once no step is left for a user."""
+
+    def __init__(self, steps, max_attempts=8, backoff=30, max_backoff=3600,
+                 on_complete=None, lease=300, batch_size=50):
+        self.steps = steps
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_complete = on_complete
+        self.lease = lease
+        self.batch_size = batch_size
+
+    def delay(self, attempts):
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+    def record(self, step, username, email, lastname, keys, error=None):
+        """Record a step that failed once."""
+        payload = json.dumps([email, lastname, keys])
+        db.add_step(idempotency_key(step, username, payload), step,
+                    username, payload, int(time.time()) + self.delay(1),
+                    error and str(error))
+
+    def replay(self):
+        """Replay the due steps and return the amount replayed."""
+        now = int(time.time())
+        rows = db.claim_steps(now, self.lease, self.batch_size)
+        for row in rows:
+            details = json.loads(row.payload)
+            try:
+                done = self.steps[row.step](row.username, *details)
+                error = None if done else 'step did not complete'
+            except Exception as e:
+                done, error = False, str(e)
+            if done:
+                if not db.finish_step(row.id) and self.on_complete:
+                    self.on_complete(row.username, *details)
+                continue
+            attempts = row.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error('Giving up the %s provisioning of %s after %d '
+                             'attempts: %s', row.step, row.username,
+                             attempts, error)
+                db.retry_step(row.id, attempts, None, error)
+            else:
+                db.retry_step(row.id, attempts,
+                              now + self.delay(attempts), error)
+        return len(rows)
+
+    def stats(self):
+        return db.outbox_stats(int(time.time()))
+
+
+class OutboxWorker(threading.Thread):
+    """Periodically replays the due steps of the outbox."""
+
+    def __init__(self, outbox, interval):
+        super(OutboxWorker, self).__init__(name='provisioning-outbox')
+        self.daemon = True
+        self.outbox = outbox
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.outbox.replay():
+                    logger.info('Provisioning outbox: %s',
+                                self.outbox.stats())
+            except Exception as e:
+                logger.error('Unable to replay the provisioning outbox: %s', e)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of DB-API connections.
+
+    At most size connections are open at the same time. Connections older
+    than recycle seconds are closed instead of being reused, and idle ones
+    are pinged before being handed out again after ping_after seconds."""
+
+    def __init__(self, connect, size=5, recycle=3600, ping_after=30,
+                 timeout=10):
+        self.connect = connect
+        self.size = size
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self.idle = []
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def healthy(self, conn, created, last_used):
+        now = time.time()
+        if now - created > self.recycle:
+            return False
+        if now - last_used > self.ping_after:
+            try:
+                conn.ping()
+            except Exception:
+                return False
+        return True
+
+    def reserve(self, deadline):
+        """Return an idle connection, or None when a new one may be
+        opened, counted in use in both cases."""
+        with self.cond:
+            while True:
+                if self.idle:
+                    self.in_use += 1
+                    return self.idle.pop()
+                if self.in_use < self.size:
+                    self.in_use += 1
+                    return None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('No connection available after %ds' %
+                                      self.timeout)
+                self.cond.wait(remaining)
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        while True:
+            idle = self.reserve(deadline)
+            if idle is None:
+                break
+            # pinged and closed out of the lock, a slow connection only
+            # delays its borrower
+            conn, created, last_used = idle
+            if self.healthy(conn, created, last_used):
+                return conn, created
+            self.discard(conn)
+        try:
+            return self.connect(), time.time()
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, conn, created):
+        with self.cond:
+            self.in_use -= 1
+            self.idle.append((conn, created, time.time()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        if conn is not None:
+            self.close(conn)
+        with self.cond:
+            self.in_use -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, it is closed instead of being returned to
+        the pool if the block raises."""
+        conn, created = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        self.release(conn, created)
+
+    def dispose(self):
+        """Close the idle connections."""
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, created, last_used in idle:
+            self.close(conn)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sampling CPU profiler of a fraction of the requests.
+
+While profiling is enabled, a background thread of each process samples
+the stacks of the threads handling a sampled request every interval
+seconds, and counts them per endpoint. The counts are written to the
+profiles directory in the folded format of FlameGraph
+(https://github.com/brendangregg/FlameGraph), one file per endpoint and
+process.
+
+Profiling is enabled for all the processes by the presence of a control
+file in the profiles directory, so that it can be toggled at runtime by
+the admin endpoint or by sending SIGUSR2 to any cauth process."""
+
+import collections
+import errno
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+CONTROL_FILE = 'enabled'
+
+_profiler = None
+
+
+def folded(frame):
+    """Return the stack of frame, outermost call first, in the folded
+    format."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def endpoint_name(path):
+    return re.sub('[^A-Za-z0-9]+', '_', path).strip('_') or 'root'
+
+
+class Profiler(threading.Thread):
+    def __init__(self, directory, rate=0.01, interval=0.005,
+                 dump_interval=60, check_interval=1):
+        super(Profiler, self).__init__(name='profiler')
+        self.daemon = True
+        self.directory = directory
+        self.control = os.path.join(directory, CONTROL_FILE)
+        self.default_rate = rate
+        self.rate = 0
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.check_interval = check_interval
+        self.tracked = {}
+        self.stacks = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def enable(self, rate=None):
+        """Enable the profiling in all the processes."""
+        tmp = '%s.%d' % (self.control, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(str(rate or self.default_rate))
+        os.rename(tmp, self.control)
+        self.refresh()
+
+    def disable(self):
+        try:
+            os.unlink(self.control)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.refresh()
+
+    def toggle(self, *args):
+        if os.path.exists(self.control):
+            self.disable()
+        else:
+            self.enable()
+
+    def refresh(self):
+        """Read the sampling rate from the control file."""
+        try:
+            with open(self.control) as f:
+                rate = float(f.read().strip() or self.default_rate)
+        except (IOError, ValueError):
+            rate = 0
+        if self.enabled and not rate:
+            self.dump()
+        elif rate and not self.enabled:
+            with self.lock:
+                self.stacks.clear()
+        self.rate = min(rate, 1)
+
+    def track(self, endpoint):
+        """Sample the current thread for endpoint if the request is part of
+        the sampled fraction."""
+        if self.enabled and random.random() < self.rate:
+            self.tracked[threading.current_thread().ident] = endpoint
+
+    def untrack(self):
+        self.tracked.pop(threading.current_thread().ident, None)
+
+    def sample(self):
+        tracked = dict(self.tracked)
+        if not tracked:
+            return
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, endpoint in tracked.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[endpoint][folded(frame)] += 1
+
+    def dump(self):
+        """Write the stacks sampled since the profiling was enabled."""
+        with self.lock:
+            stacks = dict((e, dict(c)) for e, c in self.stacks.items())
+        for endpoint, counts in stacks.items():
+            path = os.path.join(self.directory, '%s.%d.folded' %
+                                (endpoint_name(endpoint), os.getpid()))
+            with open(path + '.tmp', 'w') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write('%s %d\n' % (stack, count))
+            os.rename(path + '.tmp', path)
+        return stacks
+
+    def run(self):
+        next_check = next_dump = 0
+        while not self.stopped.is_set():
+            now = time.time()
+            try:
+                if now >= next_check:
+                    self.refresh()
+                    next_check = now + self.check_interval
+                if self.enabled:
+                    self.sample()
+                    if now >= next_dump:
+                        self.dump()
+                        next_dump = now + self.dump_interval
+            except Exception as e:
+                logger.error('Profiler error: %s', e)
+            self.stopped.wait(self.interval if self.enabled
+                              else self.check_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def install_signal():
+    try:
+        signal.signal(signal.SIGUSR2, lambda *args: _profiler.toggle())
+    except (ValueError, RuntimeError) as e:
+        # not the main thread, or mod_wsgi restricts the signals
+        logger.info('Unable to toggle the profiling with SIGUSR2: %s', e)
+
+
+def setup(profiling):
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+    if profiling.directory:
+        _profiler = Profiler(profiling.directory, profiling.rate,
+                             profiling.interval, profiling.dump_interval)
+        _profiler.start()
+        install_signal()
+    return _profiler
+
+
+def get():
+    return _profiler
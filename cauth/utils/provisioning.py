@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Runs the provisioning of the users in the services (Redmine, Gerrit)
+off the login critical path."""
+
+import hashlib
+import json
+import logging
+import Queue
+import threading
+
+from cauth import plugins, settings
+from cauth.model import db
+from cauth.utils import metrics, outbox, userdetails
+
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_outbox = None
+_outbox_worker = None
+
+
+def create_redmine_user(username, email, lastname, keys):
+    redmine = userdetails.Redmine(settings.get())
+    # a refusal is final, Redmine already knows the user
+    redmine.create_user(username, email, lastname)
+    return True
+
+
+def create_gerrit_user(username, email, lastname, keys):
+    gerrit = userdetails.Gerrit(settings.get())
+    return gerrit.create_gerrit_user(username, email, lastname, keys)
+
+
+def create_user(username, email, lastname, keys):
+    udc = userdetails.UserDetailsCreator(outbox=_outbox)
+    return udc.create_user(username, email, lastname, keys)
+
+
+def defaults(current, username, email=None, lastname=None):
+    """Return the email and the last name of a user, made up when the
+    backend does not know them."""
+    if lastname is None:
+        lastname = 'User %s' % username
+    if not email:
+        email = '%s@%s' % (username, current.app.cookie_domain)
+    return email, lastname
+
+
+def fingerprint(email, lastname, keys):
+    keys = sorted(set(k.get('key') for k in keys or [] if k.get('key')))
+    return hashlib.sha1(json.dumps([email, lastname, keys])).hexdigest()
+
+
+class FingerprintIndex(object):
+    """Persistent username -> fingerprint of the provisioned details, in
+    the provisioned_user table. It is not cached: another process may
+    provision the user with other details at any time."""
+
+    def get(self, username):
+        return db.get_fingerprint(username)
+
+    def put(self, username, value):
+        db.set_fingerprint(username, value)
+
+
+class ProvisioningQueue(object):
+    """Provisions the users on a pool of background threads.
+
+    Jobs are deduplicated per username: while a user is waiting in the
+    queue, a new submission only updates the details to provision. While a
+    worker provisions a user, a submission with other details is queued
+    once the worker is done, and dropped with the same details. The
+    sync mode tells which users are provisioned before submit returns:
+    'never', 'first' (users not provisioned yet by this process) or
+    'always'. Without workers, every user is provisioned synchronously."""
+
+    def __init__(self, provision=create_user, workers=0, sync='first',
+                 index=None):
+        self.provision = provision
+        self.index = index
+        self.sync = sync if workers else 'always'
+        self.queue = Queue.Queue()
+        self.pending = {}
+        # the details of the users being provisioned by the workers
+        self.running = {}
+        self.provisioned = set()
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work,
+                                      name='provisioning-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def provisioned_fingerprint(self, username):
+        """Return the fingerprint recorded for username, None when the
+        index cannot be read: the user is then provisioned again."""
+        try:
+            return self.index.get(username)
+        except Exception:
+            logger.exception('Unable to read the provisioning index of %s',
+                             username)
+            return None
+
+    def is_provisioned(self, username):
+        if self.index is not None:
+            return self.provisioned_fingerprint(username) is not None
+        return username in self.provisioned
+
+    def run(self, username, email, lastname, keys):
+        if self.index is not None:
+            current = fingerprint(email, lastname, keys)
+            if self.provisioned_fingerprint(username) == current:
+                # nothing changed since the user was provisioned
+                return True
+        try:
+            if not self.provision(username, email, lastname, keys):
+                return False
+        except Exception:
+            logger.exception('Unable to provision user %s', username)
+            return False
+        if self.index is not None:
+            try:
+                self.index.put(username, current)
+            except Exception:
+                # provisioned again by the next login
+                logger.exception('Unable to update the provisioning index '
+                                 'of %s', username)
+        else:
+            self.provisioned.add(username)
+        return True
+
+    def work(self):
+        while True:
+            username = self.queue.get()
+            try:
+                with self.lock:
+                    details = self.running[username] = \
+                        self.pending.pop(username)
+                self.run(username, *details)
+            except Exception:
+                # the worker keeps serving the queue
+                logger.exception('Unable to provision user %s', username)
+            finally:
+                with self.lock:
+                    self.running.pop(username, None)
+                    # submitted again while being provisioned
+                    if username in self.pending:
+                        self.queue.put(username)
+                self.queue.task_done()
+
+    def submit(self, username, email, lastname, keys):
+        if self.sync == 'always' or (
+                self.sync == 'first' and not self.is_provisioned(username)):
+            return self.run(username, email, lastname, keys)
+        details = (email, lastname, keys)
+        with self.lock:
+            if username in self.running:
+                # queued when the worker is done, a single worker
+                # provisions a user at a time
+                if username in self.pending or \
+                        self.running[username] != details:
+                    self.pending[username] = details
+                return
+            queued = username in self.pending
+            self.pending[username] = details
+            if not queued:
+                self.queue.put(username)
+
+    def join(self):
+        """Wait until all the submitted users are provisioned."""
+        self.queue.join()
+
+
+def setup(provisioning):
+    global _queue, _outbox, _outbox_worker
+    index = FingerprintIndex() if provisioning.index else None
+    _queue = ProvisioningQueue(workers=provisioning.workers,
+                               sync=provisioning.sync, index=index)
+    if _outbox_worker is not None:
+        _outbox_worker.stop()
+    _outbox = _outbox_worker = None
+    if provisioning.outbox:
+        def on_complete(username, email, lastname, keys):
+            if index is not None:
+                index.put(username, fingerprint(email, lastname, keys))
+        _outbox = outbox.Outbox(dict(plugins.provisioners()),
+                                provisioning.outbox_max_attempts,
+                                provisioning.outbox_backoff,
+                                on_complete=on_complete)
+        if provisioning.outbox_interval:
+            _outbox_worker = outbox.OutboxWorker(
+                _outbox, provisioning.outbox_interval)
+            _outbox_worker.start()
+    return _queue
+
+
+def stats():
+    """Return the depths of the provisioning queue and outbox."""
+    values = {'queued': get().queue.qsize()}
+    if _outbox is not None:
+        values.update(('outbox_%s' % k, v)
+                      for k, v in _outbox.stats().items())
+    return values
+
+
+def outbox_stats():
+    if _outbox is None:
+        return {}
+    return _outbox.stats()
+
+
+QUEUED = metrics.Gauge(
+    'cauth_provisioning_queued', 'Users waiting to be provisioned',
+    lambda: get().queue.qsize())
+OUTBOX = metrics.Gauge(
+    'cauth_provisioning_outbox_steps',
+    'Provisioning steps in the outbox per state', outbox_stats,
+    ('state', ), shared=True)
+
+
+def get():
+    global _queue
+    if _queue is None:
+        _queue = ProvisioningQueue()
+    return _queue
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""The tickets revoked before their expiration, by a logout.
+
+The list holds the SHA1 digests of the revoked tickets with their
+expiration, after which they are dropped. A Bloom filter of the digests
+answers most checks, for tickets which are not revoked, without looking
+the list up.
+
+When a path is configured, the revocations are appended to this file,
+which every process reads again when it grew, so that a ticket revoked by
+a worker is refused by the others. The file is rewritten without the
+expired revocations once they are the most of it."""
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# seconds between the removals of the expired revocations from memory
+PRUNE_INTERVAL = 60
+
+# expired lines kept in the file before it is rewritten
+MIN_COMPACT = 1000
+
+_revocations = None
+
+
+def digest(ticket):
+    return hashlib.sha1(ticket).hexdigest()
+
+
+class BloomFilter(object):
+    """A set of digests which may answer that it holds a digest it does
+    not, error_rate of the time once it holds capacity digests."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        # the key is already a digest, its bits make the two hashes of
+        # the double hashing
+        h1 = int(key[:16], 16)
+        h2 = int(key[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(key))
+
+
+class RevocationList(object):
+    """The revoked tickets of the process, shared with the other processes
+    through the file at path when given. The file is checked at most
+    every check_interval seconds."""
+
+    def __init__(self, path=None, capacity=100000, error_rate=0.001,
+                 check_interval=1):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.rebuild()
+        # the inode of the file and how much of it was read
+        self.inode = None
+        self.offset = 0
+        self.lines = 0
+        self.checked_at = 0
+        self.pruned_at = time.time()
+        if path:
+            self.refresh(force=True)
+
+    def rebuild(self):
+        # a Bloom filter cannot forget a digest, a new one is built
+        bloom = BloomFilter(max(self.capacity, 2 * len(self.entries)),
+                            self.error_rate)
+        for key in self.entries:
+            bloom.add(key)
+        self.bloom = bloom
+
+    def add(self, key, expires, now):
+        if expires <= now:
+            return
+        self.entries[key] = max(expires, self.entries.get(key, 0))
+        if len(self.entries) > self.bloom.capacity:
+            self.rebuild()
+        else:
+            self.bloom.add(key)
+
+    def prune(self, now):
+        self.entries = dict((key, expires)
+                            for key, expires in self.entries.items()
+                            if expires > now)
+        self.rebuild()
+        self.pruned_at = now
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def load(self, now):
+        """Read the revocations appended to the file since the last
+        call, or all of them when it was rewritten."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # nothing was revoked yet
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode = stat.st_ino
+            self.offset = 0
+            self.lines = 0
+        if stat.st_size == self.offset:
+            return
+        with open(self.path) as f:
+            f.seek(self.offset)
+            data = f.read()
+        # a line being written is read by the next call
+        end = data.rfind('\n') + 1
+        self.offset += end
+        for line in data[:end].splitlines():
+            self.lines += 1
+            try:
+                key, expires = line.split()
+                self.add(key, float(expires), now)
+            except ValueError:
+                logger.warning('Invalid revocation in %s: %r',
+                               self.path, line)
+
+    def compact(self, now):
+        """Rewrite the file with the revocations which did not expire."""
+        with self.file_lock():
+            with self.lock:
+                self.load(now)
+                self.prune(now)
+                tmp = '%s.%d' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    for key, expires in self.entries.items():
+                        f.write('%s %d\n' % (key, math.ceil(expires)))
+                os.rename(tmp, self.path)
+                # read again by the next refresh, as by the other processes
+                self.inode = None
+
+    def refresh(self, force=False):
+        now = time.time()
+        if not force and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        with self.lock:
+            if self.path:
+                self.load(now)
+            if now - self.pruned_at >= PRUNE_INTERVAL:
+                self.prune(now)
+
+    def revoke(self, ticket, expires):
+        """Refuse ticket until it expires."""
+        key = digest(ticket)
+        now = time.time()
+        with self.lock:
+            self.add(key, expires, now)
+        if not self.path:
+            return
+        with self.file_lock():
+            with open(self.path, 'a') as f:
+                f.write('%s %d\n' % (key, math.ceil(expires)))
+        if self.lines > 2 * len(self.entries) + MIN_COMPACT:
+            self.compact(now)
+
+    def revoked(self, ticket):
+        self.refresh()
+        key = digest(ticket)
+        if key not in self.bloom:
+            return False
+        return self.entries.get(key, 0) > time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def setup(revocation):
+    global _revocations
+    _revocations = RevocationList(revocation.path, revocation.capacity,
+                                  revocation.error_rate,
+                                  revocation.check_interval)
+    return _revocations
+
+
+def get():
+    global _revocations
+    if _revocations is None:
+        _revocations = RevocationList()
+    return _revocations
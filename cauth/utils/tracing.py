@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2015 eNovance SAS <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Timing spans of the phases of the request handled by the thread.
+
+A trace is started for each request by cauth.hooks.TimingHook. Outside of
+a request, span() and record() do nothing."""
+
+import contextlib
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class Trace(object):
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.start = time.time()
+        self.duration = None
+        self.thread = threading.current_thread().ident
+        self.spans = []
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+    def breakdown(self):
+        return ', '.join('%s %.3fs' % (name, duration)
+                         for name, start, duration in self.spans)
+
+
+def start(method, path):
+    _local.trace = Trace(method, path)
+    return _local.trace
+
+
+def stop():
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def record(name, start, duration):
+    """Add a span measured by the caller, for instance in another
+    thread."""
+    trace = current()
+    if trace is not None:
+        trace.spans.append((name, start, duration))
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, start, time.time() - start)
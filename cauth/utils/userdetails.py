@@ -14,83 +14,293 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import collections
+import hashlib
 import json
-import requests
 import logging
-import MySQLdb
+import time
 
-from pysflib.sfredmine import RedmineUtils
+from cauth import plugins
+from cauth.utils import clients, metrics, tracing
 
 logger = logging.getLogger(__name__)
 
+STEP_SECONDS = metrics.Histogram(
+    'cauth_provisioning_step_seconds',
+    'Duration of the provisioning per service', ('step', ))
+STEPS = metrics.Counter(
+    'cauth_provisioning_steps_total',
+    'Provisioning per service and result', ('step', 'result'))
+
+GERRIT_XSSI_PREFIX = ")]}'"
+
+EXTERNAL_ID_SQL = ("INSERT INTO account_external_ids VALUES"
+                   "(%s, NULL, NULL, %s) "
+                   "ON DUPLICATE KEY UPDATE account_id = account_id")
+
+
+def gerrit_json(content):
+    """Decode a Gerrit REST API response, which starts with a )]}' line
+    protecting against XSSI."""
+    if content.startswith(GERRIT_XSSI_PREFIX):
+        content = content[len(GERRIT_XSSI_PREFIX):]
+    return json.loads(content)
+
+
+def check(resp, statuses, action):
+    """Raise when the status of resp is not in statuses."""
+    if resp.status_code not in statuses:
+        raise Exception('Unable to %s, Gerrit answered %s: %s' % (
+            action, resp.status_code, resp.content))
+
+
+BranchResult = collections.namedtuple('BranchResult',
+                                      ('result', 'error', 'duration'))
+
+
+def run_branch(func, *args):
+    """Call func and return its BranchResult."""
+    start = time.time()
+    try:
+        return BranchResult(func(*args), None, time.time() - start)
+    except Exception as e:
+        return BranchResult(None, e, time.time() - start)
+
+
+def key_fingerprint(key):
+    """Return the MD5 fingerprint of a public key in the OpenSSH format,
+    the options and the comment of the key are ignored."""
+    for field in key.split():
+        if field.startswith('AAAA'):
+            try:
+                return hashlib.md5(base64.b64decode(field)).hexdigest()
+            except TypeError:
+                break
+    return ' '.join(key.split())
+
+
+class Redmine:
+    def __init__(self, settings, registry=None):
+        registry = registry or clients.get()
+        self.users_url = '%s/users.json' % settings.redmine.apiurl.rstrip('/')
+        self.http = registry.redmine
+        self.timeout = registry.redmine_timeout
+
+    def create_user(self, username, email, lastname):
+        """Return True if the user was created, False if Redmine refused
+        it (an existing user, an invalid email). Other errors raise, as they
+        may be temporary."""
+        user = {'login': username, 'firstname': username,
+                'lastname': lastname, 'mail': email}
+        resp = self.http.post(self.users_url, data=json.dumps({'user': user}),
+                              timeout=self.timeout)
+        if resp.status_code == 422:
+            logger.info('Redmine refused user %s: %s',
+                        username, resp.content)
+            return False
+        if resp.status_code != 201:
+            raise Exception('Redmine answered %s: %s' % (resp.status_code,
+                                                         resp.content))
+        return True
+
 
 class Gerrit:
-    def __init__(self, conf):
-        self.gerrit_url = "%s/api/a/accounts" % conf.gerrit['url']
-        self.admin_user = conf.gerrit['admin_user']
-        self.admin_password = conf.gerrit['admin_password']
+    def __init__(self, settings, registry=None):
+        registry = registry or clients.get()
+        gerrit = settings.gerrit
+        self.gerrit_url = gerrit.accounts_url
+        self.delete_removed_sshkeys = gerrit.delete_removed_sshkeys
+
+        self.registry = registry
+        self.http = registry.gerrit
+        self.timeout = registry.gerrit_timeout
+        self.db_pool = registry.gerrit_db
+        self.accounts = registry.gerrit_accounts
 
-        self.db_host = conf.gerrit['db_host']
-        self.db_name = conf.gerrit['db_name']
-        self.db_user = conf.gerrit['db_user']
-        self.db_password = conf.gerrit['db_password']
+    def get_sshkeys(self, username):
+        """Return the keys of the account as a fingerprint -> seq dict, or
+        None if Gerrit did not answer."""
+        url = "%s/%s/sshkeys" % (self.gerrit_url, username)
+        try:
+            resp = self.http.get(url, timeout=self.timeout)
+            infos = gerrit_json(resp.content)
+            return dict((key_fingerprint(info['ssh_public_key']),
+                         info['seq']) for info in infos)
+        except Exception as e:
+            logger.error('Unable to get the SSH keys of %s: %s',
+                         username, e)
+            return None
 
     def install_sshkeys(self, username, keys):
+        """Upload the keys missing in Gerrit and, when enabled, remove the
+        keys that are not in keys anymore."""
         url = "%s/%s/sshkeys" % (self.gerrit_url, username)
-        for entry in keys:
-            requests.post(url, data=entry.get('key'),
-                          auth=(self.admin_user, self.admin_password))
+        wanted = dict((key_fingerprint(entry['key']), entry['key'])
+                      for entry in keys if entry.get('key'))
+        existing = self.get_sshkeys(username)
+        if existing is None:
+            existing = {}
+        missing = [key for fp, key in wanted.items() if fp not in existing]
+        removed = []
+        if self.delete_removed_sshkeys and wanted:
+            removed = [seq for fp, seq in existing.items()
+                       if fp not in wanted]
+
+        def upload():
+            # Gerrit numbers the keys of an account from its last one, the
+            # keys are added one at a time
+            for key in missing:
+                resp = self.http.post(url, data=key, timeout=self.timeout)
+                check(resp, (200, 201), 'add a SSH key of %s' % username)
+
+        def delete(seq):
+            resp = self.http.delete("%s/%s" % (url, seq),
+                                    timeout=self.timeout)
+            # 404 when the key is already removed
+            check(resp, (200, 204, 404),
+                  'remove the SSH key %s of %s' % (seq, username))
+
+        calls = [lambda seq=seq: delete(seq) for seq in removed]
+        if missing:
+            calls.append(upload)
+        # the errors raise, for the outbox to replay the step
+        if len(calls) > 1:
+            self.registry.sshkeys_pool.map(lambda call: call(), calls)
+        elif calls:
+            calls[0]()
 
     def add_in_acc_external(self, account_id, username):
-        db = MySQLdb.connect(passwd=self.db_password, db=self.db_name,
-                             host=self.db_host, user=self.db_user)
-        c = db.cursor()
-        sql = ("INSERT INTO account_external_ids VALUES"
-               "(%d, NULL, NULL, 'gerrit:%s');" %
-               (account_id, username))
+        """Return True if the external id was added, False if it already
+        existed. The database errors raise."""
+        with self.db_pool.connection() as db:
+            c = db.cursor()
+            try:
+                c.execute(EXTERNAL_ID_SQL,
+                          (account_id, 'gerrit:%s' % username))
+                db.commit()
+                # 1 row is affected by an insert, 0 by an existing row
+                return c.rowcount == 1
+            finally:
+                c.close()
+
+    def add_in_acc_external_many(self, accounts):
+        """Add the external ids of a list of (account_id, username) in a
+        single statement, return False on error."""
         try:
-            c.execute(sql)  # Will be only successful if entry does not exist
-            db.commit()
-            return True
-        except:
+            with self.db_pool.connection() as db:
+                c = db.cursor()
+                try:
+                    c.executemany(EXTERNAL_ID_SQL,
+                                  [(account_id, 'gerrit:%s' % username)
+                                   for account_id, username in accounts])
+                    db.commit()
+                    return True
+                finally:
+                    c.close()
+        except Exception as e:
+            logger.error('Unable to add %d Gerrit external ids: %s',
+                         len(accounts), e)
             return False
 
-    def create_gerrit_user(self, username, email, lastname, keys):
+    def create_account(self, username, email, lastname):
+        """Create the account if needed and return its id."""
+        account_id = self.accounts.get(username)
+        if account_id is not None:
+            return account_id
+
         user = {"name": lastname, "email": email}
         data = json.dumps(user)
 
         headers = {"Content-type": "application/json"}
         url = "%s/%s" % (self.gerrit_url, username)
-        requests.put(url, data=data, headers=headers,
-                     auth=(self.admin_user, self.admin_password))
+        resp = self.http.put(url, data=data, headers=headers,
+                             timeout=self.timeout)
+        if resp.status_code == 201:
+            account_id = self.account_id(resp)
+        if account_id is None:
+            # 409 when the account exists, it is not returned then
+            resp = self.http.get(url, headers=headers, timeout=self.timeout)
+            account_id = self.account_id(resp)
+        if account_id is not None:
+            self.accounts.put(username, account_id)
+        return account_id
 
-        resp = requests.get(url, headers=headers,
-                            auth=(self.admin_user, self.admin_password))
-        data = resp.content[4:]  # there is some garbage at the beginning
+    def account_id(self, resp):
         try:
-            account_id = json.loads(data).get('_account_id')
-        except:
-            account_id = None
+            return gerrit_json(resp.content).get('_account_id')
+        except (AttributeError, TypeError, ValueError):
+            return None
 
-        fetch_ssh_keys = False
+    def create_gerrit_user(self, username, email, lastname, keys):
+        account_id = self.create_account(username, email, lastname)
         if account_id:
-            fetch_ssh_keys = self.add_in_acc_external(account_id, username)
+            # the external id and the keys are independent
+            start = time.time()
+            registered = self.registry.external_ids_pool.apply_async(
+                run_branch, (self.add_in_acc_external, account_id, username))
+            if keys:
+                # only the keys Gerrit does not have yet are uploaded
+                with tracing.span('gerrit_sshkeys'):
+                    self.install_sshkeys(username, keys)
+            registered = registered.get()
+            tracing.record('gerrit_db', start, registered.duration)
+            if registered.error:
+                # the step is replayed from the outbox
+                raise registered.error
 
-        if keys and fetch_ssh_keys:
-            self.install_sshkeys(username, keys)
+        return account_id is not None
 
 
 class UserDetailsCreator:
-    def __init__(self, conf):
-        self.r = RedmineUtils(conf.redmine['apiurl'],
-                              key=conf.redmine['apikey'])
-        self.g = Gerrit(conf)
+    """Provisions the users with steps, the (name, provisioner) of the
+    configured services."""
+
+    def __init__(self, steps=None, registry=None, outbox=None):
+        registry = registry or clients.get()
+        if steps is None:
+            steps = plugins.provisioners()
+        self.steps = steps
+        self.outbox = outbox
+        self.pool = registry.branch_pool
+
+    def provision(self, username, email, lastname, keys):
+        """Provision the user in all the services at the same time and
+        return the BranchResult of each service."""
+        args = (username, email, lastname, keys)
+        branches = [(name, self.pool.apply_async(run_branch, (step, ) + args))
+                    for name, step in self.steps[:-1]]
+        start = time.time()
+        results = {}
+        if self.steps:
+            name, step = self.steps[-1]
+            results[name] = run_branch(step, *args)
+        results.update((name, branch.get()) for name, branch in branches)
+        for name, r in sorted(results.items()):
+            tracing.record(name, start, r.duration)
+        return results
+
+    def report(self, username, results):
+        for name, r in results.items():
+            STEP_SECONDS.observe(r.duration, name)
+            STEPS.inc(name, 'error' if r.error else
+                      'done' if r.result else 'refused')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Provisioned user %s: %s', username, ', '.join(
+                '%s %s in %.3fs' % (name, 'failed' if r.error else 'done',
+                                    r.duration)
+                for name, r in sorted(results.items())))
+        for name, r in sorted(results.items()):
+            if r.error:
+                logger.info('When adding user %s in %s: %s',
+                            username, name, r.error)
 
     def create_user(self, username, email, lastname, keys):
-        try:
-            self.r.create_user(username, email, lastname)
-        except Exception, e:
-            logger.info('When adding user %s: %s' % (username, str(e)))
-        self.g.create_gerrit_user(username, email, lastname, keys)
-        # Here we don't care of the error
-        return True
+        results = self.provision(username, email, lastname, keys)
+        self.report(username, results)
+        if self.outbox is not None:
+            for step, r in results.items():
+                if r.result is not True:
+                    self.outbox.record(step, username, email, lastname, keys,
+                                       r.error)
+        return all(r.result is True for r in results.values())
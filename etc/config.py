@@ -22,30 +22,49 @@ app = {
     'priv_key_path': '/srv/cauth_keys/privkey.pem',
     'cookie_domain': 'tests.dom',
     'debug': False,
-    'cookie_period': 43200
+    'cookie_period': 43200,
+    # renew the cookies in their last 3 hours
+    'renew_window': 10800,
 }
 
 logging = {
     'loggers': {
-        'cauth': {'level': 'DEBUG',
+        # DEBUG logs several lines per request, keep it for troubleshooting
+        'cauth': {'level': 'INFO',
                   'handlers': ['file_handler']},
-        'pysflib': {'level': 'DEBUG',
-                    'handlers': ['file_handler']},
+        # the login and logout events, one JSON object per line
+        'cauth.events': {'level': 'INFO',
+                         'handlers': ['events_handler'],
+                         'propagate': False},
         '__force_dict__': True
     },
     'handlers': {
         'file_handler': {
-            'class': 'logging.handlers.RotatingFileHandler',
-            'level': 'DEBUG',
+            'class': 'cauth.utils.logs.AsyncRotatingFileHandler',
+            'level': 'INFO',
             'formatter': 'simple',
             'filename': '/var/log/cauth/cauth.log',
-        }
+            'maxBytes': 50 * 1024 * 1024,
+            'backupCount': 5,
+        },
+        'events_handler': {
+            'class': 'cauth.utils.logs.AsyncRotatingFileHandler',
+            'level': 'INFO',
+            'formatter': 'json',
+            'filename': '/var/log/cauth/events.log',
+            'maxBytes': 50 * 1024 * 1024,
+            'backupCount': 5,
+        },
     },
     'formatters': {
         'simple': {
             'format': ('%(asctime)s %(levelname)-5.5s [%(name)s]'
                        '[%(threadName)s] %(message)s')
-        }
+        },
+        'json': {
+            '()': 'cauth.utils.logs.JSONFormatter',
+            '__force_dict__': True
+        },
     }
 }
 
@@ -63,7 +82,9 @@ auth = {
         'redirect_uri': 'https://github/redirect/url',
         'client_id': 'your_github_app_id',
         'client_secret': 'your_github_app_secret',
-        'allowed_organizations': 'your_allowed_organizations'
+        'allowed_organizations': 'your_allowed_organizations',
+        # 'rest' or 'graphql'
+        'api': 'rest',
     },
     'localdb': {
         'managesf_url': 'https://tests.dom',
@@ -89,14 +110,69 @@ logout = {
 
 sqlalchemy = {
     'url': 'sqlite:////var/lib/cauth/state_mapping.db',
-    'echo': True,
+    # True logs every SQL statement
+    'echo': False,
     'encoding': 'utf-8'
 }
 
+state_store = {
+    # 'sql', 'memory', 'shm' or 'signed'
+    'backend': 'sql',
+    'ttl': 600,
+    'sweep_interval': 60,
+}
+
+provisioning = {
+    'workers': 2,
+    # 'never', 'first' or 'always'
+    'sync': 'first',
+    'index': True,
+    'outbox': True,
+    'outbox_interval': 30,
+    # the threads of the WSGI process plus the workers
+    'branch_workers': 17,
+}
+
+tracing = {
+    'slow_request': 1.0,
+}
+
+health = {
+    'interval': 10,
+    'timeout': 2,
+    # reported by /auth/ready, but not required to be ready
+    'optional': ['redmine', 'github'],
+}
+
+revocation = {
+    # shared by the cauth processes
+    'path': '/var/lib/cauth/revoked',
+    'capacity': 100000,
+}
+
+admin = {
+    'allowed_ips': ['127.0.0.1', '::1'],
+}
+
+# profiling = {
+#     'directory': '/var/lib/cauth/profiles',
+#     'rate': 0.01,
+# }
+
+# memory = {
+#     'max_snapshots': 10,
+#     'trace_frames': 0,
+# }
+
+metrics = {
+    'directory': '/var/lib/cauth/metrics',
+    'flush_interval': 5,
+}
+
 redmine = {
     'apihost': 'redmine_api_host',
-    'apiurl': '',
-    'apikey': '',
+    'apiurl': 'http://redmine.url',
+    'apikey': 'redmine_api_key',
 }
 
 gerrit = {
@@ -49,4 +49,18 @@ setup(
     url='http://softwarefactory.enovance.com/r/gitweb?p=cauth.git;a=summary',
     download_url='https://github.com/enovance/cauth/tarball/%s' % VERSION,
     keywords=['software factory', 'SSO', 'Authentication'],
+    entry_points={
+        'console_scripts': [
+            'cauth-provision = cauth.utils.bulkprovision:main',
+        ],
+        'cauth.backends': [
+            'users = cauth.auth:check_static_user',
+            'localdb = cauth.auth:check_db_user',
+            'ldap = cauth.auth:check_ldap_user',
+        ],
+        'cauth.provisioners': [
+            'redmine = cauth.utils.provisioning:create_redmine_user',
+            'gerrit = cauth.utils.provisioning:create_gerrit_user',
+        ],
+    },
 )